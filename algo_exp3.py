@@ -1,5 +1,7 @@
 import numpy as np
-from math import exp
+from sampling import UniformStreams, sample_cdf
+
+LOG_WEIGHT_LIMIT = 500.0    # log-weights are shifted down by their max once it exceeds this, far below exp overflow
 
 def computeGamma(index):
     '''
@@ -11,46 +13,109 @@ def computeGamma(index):
     # end computeGamma
 
 
-class Exp3Algo(object):
-    def __init__(self, K, T):
+class Exp3Batch(object):
+    # Runs N Exp3 learners with K arms, each step of all of them in one call.
+    # The weights are kept as log-weights in an [N][K] array; a choice only adds to one log-weight, so nothing is
+    # renormalized per step. Device i behaves exactly like Exp3Algo(K, T, seed=seed, device=devices[i]).
+    # gamma: learning rate of the next step. give_rewards(rewards, gamma) sets it, or computeGamma(t) if gamma <= 0.
+    # devices: index of each learner's device in the run, which keys its uniforms (sampling.UniformStreams). 0..N-1 by default.
+    def __init__(self, N, K, T, seed=0, devices=None):
+        self.N = N
         self.K = K
         self.T = T
         self.t = 1
         self.gamma = computeGamma(self.t)
-        self.probabilities = None
-        self.choice = None
+        self.logWeights = np.zeros((N, K))
+        self.probabilities = np.full((N, K), 1/K)
+        self.choices = None
+        self.devices = np.arange(N)
+        self.uniforms = UniformStreams(seed, range(N) if devices is None else devices)
 
-        self.arms = list(range(K))
+    # returns a NumPy array of the arm chosen by each device.
+    def get_next_arms(self):
+        weights = np.exp(self.logWeights - self.logWeights.max(axis=1, keepdims=True))
+        np.multiply((1-self.gamma)/weights.sum(axis=1, keepdims=True), weights, out=self.probabilities)
+        self.probabilities += self.gamma/self.K
+        self.choices = sample_cdf(np.cumsum(self.probabilities, axis=1), self.uniforms.next())
+        return self.choices
 
-        # initialize
-        self.weights = [1.0]*K
+    # rewards: NumPy array of the reward of each device for its chosen arm.
+    def give_rewards(self, rewards, gamma=-1):
+        estimatedRewards = np.asarray(rewards, dtype=np.float64) / self.probabilities[self.devices, self.choices]
 
-    def get_next_arm(self):
-        self.probabilities = list((1-self.gamma)*(weight/sum(self.weights)) + (self.gamma/self.K)
-                            for weight in self.weights)
-        self.choice = np.random.choice(self.arms, p=self.probabilities)
+        self.t = self.t+1
+        self.gamma = gamma if gamma > 0 else computeGamma(self.t)
 
-        return self.choice
+        # update weight: w[choice] *= exp(gamma * estimatedReward / K)
+        self.logWeights[self.devices, self.choices] += self.gamma * estimatedRewards / self.K
+        maxLogWeights = self.logWeights.max(axis=1)
+        if maxLogWeights.max() > LOG_WEIGHT_LIMIT:
+            rows = maxLogWeights > LOG_WEIGHT_LIMIT
+            self.logWeights[rows] -= maxLogWeights[rows,None]
 
-    def give_reward(self, reward):
-        #reward = getFeedback()
-        estimatedReward = reward / self.probabilities[self.choice]
+    # [N][2+2K] states of the learners for checkpoints: t, gamma, probabilities, log-weights.
+    def get_state(self):
+        return np.concatenate((np.full((self.N, 1), self.t), np.full((self.N, 1), self.gamma), self.probabilities, self.logWeights), axis=1)
 
-        self.t = self.t+1
-        self.gamma = computeGamma(self.t)
+    # restores states from get_state; the learners then continue exactly as the ones the states were taken from.
+    def set_state(self, states):
+        states = np.atleast_2d(states)
+        self.t = int(states[0,0])
+        self.gamma = states[0,1]
+        self.probabilities[:] = states[:,2:2+self.K]
+        self.logWeights[:] = states[:,2+self.K:]
+        self.uniforms.seek(self.t-1)
 
-        # update weight
-        weights = self.weights
-        try: weights[self.choice] *= exp((self.gamma * estimatedReward) / len(weights))
-        except OverflowError: weights[self.choice] = 1
-        self.weights = [w/max(weights) if w/max(weights) > 0 else (float_info.min * float_info.epsilon)
-                    for w in weights]
+    # takes the log-weights of states from get_state (e.g. learned over another day) as the starting weights.
+    def warm_start(self, states):
+        self.logWeights[:] = np.atleast_2d(states)[:,2+self.K:]
 
     def get_log_headers(self):
         return ['weight%d' % i for i in range(1,self.K+1)] + \
                ['probability%d' % i for i in range(1,self.K+1)]
-        
-    def get_timestep_log(self):
-        return self.weights + self.probabilities
 
+    # weights are logged relative to the largest weight of the device, as [N][2K] rows of get_log_headers columns.
+    # out: optional [N][2K] float64 array to write into.
+    def get_timestep_logs(self, out=None):
+        if out is None:
+            out = np.empty((self.N, 2*self.K))
+        np.exp(self.logWeights - self.logWeights.max(axis=1, keepdims=True), out=out[:,:self.K])
+        out[:,self.K:] = self.probabilities
+        return out
+
+
+class Exp3Algo(object):
+    # A single Exp3 learner, with the interface of PeriodicExp4; an Exp3Batch of one device.
+    def __init__(self, K, T, seed=0, device=0):
+        self.K = K
+        self.T = T
+        self.batch = Exp3Batch(1, K, T, seed, devices=[device])
 
+    @property
+    def t(self):
+        return self.batch.t
+
+    @property
+    def gamma(self):
+        return self.batch.gamma
+
+    def get_next_arm(self):
+        return int(self.batch.get_next_arms()[0])
+
+    def give_reward(self, reward, gamma=-1):
+        self.batch.give_rewards((reward,), gamma)
+
+    def get_state(self):
+        return self.batch.get_state()[0]
+
+    def set_state(self, state):
+        self.batch.set_state(state)
+
+    def warm_start(self, state):
+        self.batch.warm_start(state)
+
+    def get_log_headers(self):
+        return self.batch.get_log_headers()
+
+    def get_timestep_log(self):
+        return self.batch.get_timestep_logs()[0].tolist()
@@ -1,33 +1,170 @@
 import os
-from ctypes import cdll, c_int, c_double
+import hashlib
+from contextlib import contextmanager
+from ctypes import cdll, c_int, c_uint, c_longlong, c_ulonglong, c_double, c_void_p, POINTER
+import numpy as np
 lib = cdll.LoadLibrary(os.path.dirname(__file__) + '/libperiodicexp4.so')
-lib.DataLog_next.restype = c_double
+# Native objects are passed around as raw pointers. Declare every signature so that
+# the pointers are not truncated to c_int on 64-bit platforms.
+int_array = np.ctypeslib.ndpointer(dtype=np.int32, ndim=1, flags='C_CONTIGUOUS')
+double_array = np.ctypeslib.ndpointer(dtype=np.float64, ndim=1, flags='C_CONTIGUOUS')
+
+lib.PeriodicExp4_new.restype = c_void_p
+lib.PeriodicExp4_new.argtypes = [c_int, c_int, c_int, POINTER(c_int), c_int, c_int]
+lib.PeriodicExp4_new_g.restype = c_void_p
+lib.PeriodicExp4_new_g.argtypes = [c_int, c_int, c_int, POINTER(c_int), c_int, c_int, c_double]
+lib.PeriodicExp4_delete.restype = None
+lib.PeriodicExp4_delete.argtypes = [c_void_p]
+lib.PeriodicExp4_reset.restype = None
+lib.PeriodicExp4_reset.argtypes = [c_void_p, c_int, c_int, c_int, c_double]
+lib.PeriodicExp4_getNextArm.restype = c_int
+lib.PeriodicExp4_getNextArm.argtypes = [c_void_p, POINTER(c_int)]
+lib.PeriodicExp4_giveReward.restype = None
+lib.PeriodicExp4_giveReward.argtypes = [c_void_p, c_double, c_double]
+lib.PeriodicExp4_setLabelTable.restype = None
+lib.PeriodicExp4_setLabelTable.argtypes = [c_void_p, c_void_p, c_int, c_int]
+lib.PeriodicExp4_getNextArmAt.restype = c_int
+lib.PeriodicExp4_getNextArmAt.argtypes = [c_void_p, c_int]
+lib.PeriodicExp4_setLog.restype = None
+lib.PeriodicExp4_setLog.argtypes = [c_void_p, c_void_p, c_int, c_int]
+lib.PeriodicExp4_getTimestepDataSize.restype = c_int
+lib.PeriodicExp4_getTimestepDataSize.argtypes = [c_void_p]
+lib.PeriodicExp4_computeTimestepData.restype = POINTER(c_double)
+lib.PeriodicExp4_computeTimestepData.argtypes = [c_void_p]
+lib.PeriodicExp4_writeTimestepData.restype = None
+lib.PeriodicExp4_writeTimestepData.argtypes = [c_void_p, double_array]
+lib.PeriodicExp4_getStateSize.restype = c_int
+lib.PeriodicExp4_getStateSize.argtypes = [c_void_p]
+lib.PeriodicExp4_writeState.restype = None
+lib.PeriodicExp4_writeState.argtypes = [c_void_p, double_array]
+lib.PeriodicExp4_readState.restype = c_int
+lib.PeriodicExp4_readState.argtypes = [c_void_p, double_array, c_int]
+lib.PeriodicExp4_getWeightBytes.restype = c_longlong
+lib.PeriodicExp4_getWeightBytes.argtypes = [c_void_p]
+lib.PeriodicExp4_weightSize.restype = c_int
+lib.PeriodicExp4_weightSize.argtypes = []
+
+lib.PeriodicExp4Batch_new.restype = c_void_p
+lib.PeriodicExp4Batch_new.argtypes = [c_int, c_int, c_int, c_int, POINTER(c_int), c_int]
+lib.PeriodicExp4Batch_new_g.restype = c_void_p
+lib.PeriodicExp4Batch_new_g.argtypes = [c_int, c_int, c_int, c_int, POINTER(c_int), c_int, c_double]
+lib.PeriodicExp4Batch_delete.restype = None
+lib.PeriodicExp4Batch_delete.argtypes = [c_void_p]
+lib.PeriodicExp4Batch_getNextArms.restype = None
+lib.PeriodicExp4Batch_getNextArms.argtypes = [c_void_p, int_array, int_array]
+lib.PeriodicExp4Batch_setLabelTable.restype = None
+lib.PeriodicExp4Batch_setLabelTable.argtypes = [c_void_p, c_void_p, c_int, c_int]
+lib.PeriodicExp4Batch_getNextArmsAt.restype = c_int
+lib.PeriodicExp4Batch_getNextArmsAt.argtypes = [c_void_p, c_int, int_array]
+lib.PeriodicExp4Batch_writeTimestepData.restype = None
+lib.PeriodicExp4Batch_writeTimestepData.argtypes = [c_void_p, np.ctypeslib.ndpointer(dtype=np.float64, ndim=2, flags='C_CONTIGUOUS')]
+lib.PeriodicExp4Batch_setLog.restype = None
+lib.PeriodicExp4Batch_setLog.argtypes = [c_void_p, c_void_p, c_int, c_int]
+lib.PeriodicExp4Batch_giveRewards.restype = None
+lib.PeriodicExp4Batch_giveRewards.argtypes = [c_void_p, double_array, c_double]
+lib.PeriodicExp4Batch_reset.restype = None
+lib.PeriodicExp4Batch_reset.argtypes = [c_void_p, c_int, c_int, c_double]
+lib.PeriodicExp4Batch_getDevice.restype = c_void_p
+lib.PeriodicExp4Batch_getDevice.argtypes = [c_void_p, c_int]
+lib.Philox_uniform.restype = c_double
+lib.Philox_uniform.argtypes = [c_uint, c_uint, c_ulonglong, c_uint]
+lib.Sampling_searchCdf.restype = c_int
+lib.Sampling_searchCdf.argtypes = [double_array, c_int, c_double]
+WEIGHT_SIZE = lib.PeriodicExp4_weightSize() # bytes per weight: 4 if the library is built with -DMODE_FLOAT_WEIGHTS, else 8
 import math
 
-class PeriodicExp4(object):
+class NativeLearner(object):
+    # Owner of a native learner handle. Using a learner after close() raises a ValueError,
+    # instead of passing the freed handle to the native code.
+    @property
+    def obj(self):
+        if self._obj is None:
+            raise ValueError('%s is closed' % type(self).__name__)
+        return self._obj
+
+    @obj.setter
+    def obj(self, handle):
+        self._obj = handle
+
+
+class PeriodicExp4(NativeLearner):
     # each function is a (lambda function, label_count) pair
     # first timestep t = 0.
     # T: number of timesteps
     # K: number of arms
-    # functions: 
-    # seed: random seed for determinstic output.
+    # functions: a PartitionSpec, or a tuple of (function, label_count) pairs
+    # seed: random seed of the run, for determinstic output.
     # gamma: learning rate, between 0 and 1
-    def __init__(self, T, K, functions, seed=0, gamma=None):
+    # device: index of the device in the run. The choice at timestep t uses the uniform
+    #         sampling.philox_uniforms(seed, device, t), whatever else is drawn in the run.
+    def __init__(self, T, K, functions, seed=0, gamma=None, device=0):
+        check_partition_rows(functions, T)
+        self.T = T
         self.F = len(functions)
         self.K = K
         self.t = 0
-        self.functions = tuple(f[0] for f in functions)
+        self.log = None
+        self.obj = None
 
-        label_counts = (c_int*self.F)(*(f[1] for f in functions))
+        self.label_counts = partition_label_counts(functions)
+        label_counts = (c_int*self.F)(*self.label_counts)
         #random_seeds = (c_int*self.F)(*random_seeds)
         if gamma == None:
-            self.obj = lib.PeriodicExp4_new(T,K,self.F,label_counts, seed)
+            self.obj = lib.PeriodicExp4_new(T,K,self.F,label_counts, seed, device)
         elif gamma < 0:
             raise Exception('gamma cannot be negative.')
         else:
-            self.obj = lib.PeriodicExp4_new_g(T,K,self.F,label_counts, seed, c_double(gamma))
-        
+            self.obj = lib.PeriodicExp4_new_g(T,K,self.F,label_counts, seed, device, c_double(gamma))
+        self.set_partitions(functions)
+
+        # NumPy view of the native timestep data buffer. The buffer never moves, so the view is made once.
+        self.timestep_data = np.ctypeslib.as_array(lib.PeriodicExp4_computeTimestepData(self.obj),
+                                                   shape=(lib.PeriodicExp4_getTimestepDataSize(self.obj),))
+
+    # Frees the native learner; it cannot be used afterwards. Also done by the with statement and the garbage collector.
+    def close(self):
+        if getattr(self, '_obj', None) is not None:
+            lib.PeriodicExp4_delete(self._obj)
+            self._obj = None
+            self.timestep_data = None
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Takes other partitions with the same label counts (e.g. over another T or number of repeats).
+    def set_partitions(self, functions, T=None):
+        if partition_label_counts(functions) != self.label_counts:
+            raise ValueError('the partitions have other label counts than the learner')
+        check_partition_rows(functions, self.T if T == None else T)
+        self.partitions = functions
+        self.functions, self.label_table = partition_sources(functions)
+        if self.label_table is not None:
+            lib.PeriodicExp4_setLabelTable(self.obj, self.label_table.ctypes.data, self.label_table.itemsize, len(self.label_table))
+
+    # Puts the learner back in the state of PeriodicExp4(T, K, functions, seed, gamma, device), without allocating.
+    # T and functions are kept if not given. The log is detached.
+    def reset(self, T=None, functions=None, seed=0, gamma=None, device=0):
+        if gamma != None and gamma < 0:
+            raise Exception('gamma cannot be negative.')
+        if T == None: T = self.T
+        if functions != None: self.set_partitions(functions, T)
+        else: check_partition_rows(self.partitions, T)
+        self.T = T
+        lib.PeriodicExp4_reset(self.obj, self.T, seed, device, c_double(-1 if gamma == None else gamma))
+        self.t = 0
+        self.log = None
+
     def get_next_arm(self):
+        if self.label_table is not None:
+            arm = lib.PeriodicExp4_getNextArmAt(self.obj, self.t)
+            if arm < 0: raise_past_label_table(self.t, self.label_table)
+            return arm
         current_labels = (c_int*self.F)(*(f(self.t) for f in self.functions))
         return lib.PeriodicExp4_getNextArm(self.obj, current_labels)
 
@@ -35,13 +172,42 @@ class PeriodicExp4(object):
         lib.PeriodicExp4_giveReward(self.obj, c_double(reward), c_double(gamma))
         self.t += 1
 
-    # This function only works if compiled with #define ENABLE_LOGGING
+    # Returns the whole state of the learner (weights, running aggregates, timestep, gamma) as a float64 array,
+    # for checkpoints. The uniforms need no state: they are keyed by (seed, device, timestep).
+    def get_state(self):
+        state = np.empty(lib.PeriodicExp4_getStateSize(self.obj))
+        lib.PeriodicExp4_writeState(self.obj, state)
+        return state
+
+    # Restores a state from get_state of a learner with the same arms and partitions. The learner then
+    # continues exactly as the one the state was taken from.
+    def set_state(self, state):
+        self.t = read_state(self.obj, state, False)
+
+    # Takes the weights of a state from get_state as the starting weights of this learner (e.g. the weights
+    # learned over another day). The timestep and gamma of this learner are kept.
+    def warm_start(self, state):
+        read_state(self.obj, state, True)
+
+    # Bytes of native memory of the weights (and per-label aggregates) of this learner.
+    def weight_bytes(self):
+        return lib.PeriodicExp4_getWeightBytes(self.obj)
+
+    # Starts recording the timestep data (get_log_headers columns) of every every-th step, from the
+    # next reward onwards, into a preallocated [T/every][F+2K] array.
+    # path: if given, the log is a memory-mapped .npy file at path instead of an in-memory array.
+    # append: reopen the log at path and keep the rows it has (continuing a restored learner).
+    def enable_log(self, every=1, path=None, append=False):
+        self.log = make_log_buffer((self.T + every-1)//every, self.F+2*self.K, path, append=append)
+        self.log_every = every
+        lib.PeriodicExp4_setLog(self.obj, self.log.ctypes.data, self.log.shape[0], every)
+
+    def disable_log(self):
+        lib.PeriodicExp4_setLog(self.obj, None, 0, 1)
+
+    # Returns the rows of the log recorded so far.
     def extract_log(self):
-        datalog = lib.PeriodicExp4_getLog(self.obj)
-        size = lib.DataLog_size(datalog)
-        cols = lib.DataLog_cols(datalog)
-        lib.DataLog_reset(datalog)
-        return cols, [lib.DataLog_next(datalog) for i in range(size)]
+        return self.log[:(self.t + self.log_every-1)//self.log_every]
 
     def get_log_headers(self):
         return ['w_partitionF%d' % f for f in range(1,self.F+1)] +\
@@ -52,11 +218,271 @@ class PeriodicExp4(object):
         #['misc1%d' % i for i in range(1,self.K+1)] +\
         #['misc2%d' % i for i in range(1,self.K+1)] +\
         
-    def get_timestep_log(self):
-        datalog = lib.PeriodicExp4_getCurrentTimestepData(self.obj)
-        size = lib.DataLog_size(datalog)
-        lib.DataLog_reset(datalog)
-        return [lib.DataLog_next(datalog) for i in range(size)]
+    # Returns a NumPy view of the current timestep data (columns of get_log_headers).
+    # The view is overwritten by the next call; copy it to keep it.
+    def get_timestep_view(self):
+        lib.PeriodicExp4_computeTimestepData(self.obj)
+        return self.timestep_data
+
+    # out: optional float64 array (e.g. a row of a preallocated array) to write the current timestep data into.
+    # returns out, or a list of the values if out is not given.
+    def get_timestep_log(self, out=None):
+        if out is None:
+            return self.get_timestep_view().tolist()
+        lib.PeriodicExp4_writeTimestepData(self.obj, out)
+        return out
+
+class PeriodicExp4Batch(NativeLearner):
+    # Runs N PeriodicExp4 learners sharing the same partition functions, one native call per timestep.
+    # Device i behaves exactly like PeriodicExp4(T, K, functions, seed=seed, gamma=gamma, device=i).
+    # N: number of devices
+    # (other arguments are the same as PeriodicExp4)
+    def __init__(self, N, T, K, functions, seed=0, gamma=None):
+        check_partition_rows(functions, T)
+        self.N = N
+        self.T = T
+        self.F = len(functions)
+        self.K = K
+        self.t = 0
+        self.log = None
+        self.obj = None
+
+        self.label_counts = partition_label_counts(functions)
+        label_counts = (c_int*self.F)(*self.label_counts)
+        if gamma == None:
+            self.obj = lib.PeriodicExp4Batch_new(N,T,K,self.F,label_counts, seed)
+        elif gamma < 0:
+            raise Exception('gamma cannot be negative.')
+        else:
+            self.obj = lib.PeriodicExp4Batch_new_g(N,T,K,self.F,label_counts, seed, c_double(gamma))
+        self.set_partitions(functions)
+
+        self.labels = np.zeros(self.F, dtype=np.int32)
+        self.arms = np.zeros(N, dtype=np.int32)
+        self.timestep_data = np.zeros((N, self.F+2*K))
+
+    # Same as PeriodicExp4.close, for all devices.
+    def close(self):
+        if getattr(self, '_obj', None) is not None:
+            lib.PeriodicExp4Batch_delete(self._obj)
+            self._obj = None
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def set_partitions(self, functions, T=None):
+        if partition_label_counts(functions) != self.label_counts:
+            raise ValueError('the partitions have other label counts than the learners')
+        check_partition_rows(functions, self.T if T == None else T)
+        self.partitions = functions
+        self.functions, self.label_table = partition_sources(functions)
+        if self.label_table is not None:
+            lib.PeriodicExp4Batch_setLabelTable(self.obj, self.label_table.ctypes.data, self.label_table.itemsize, len(self.label_table))
+
+    # Same as PeriodicExp4.reset: device i is reset to PeriodicExp4(T, K, functions, seed, gamma, device=i).
+    def reset(self, T=None, functions=None, seed=0, gamma=None):
+        if gamma != None and gamma < 0:
+            raise Exception('gamma cannot be negative.')
+        if T == None: T = self.T
+        if functions != None: self.set_partitions(functions, T)
+        else: check_partition_rows(self.partitions, T)
+        self.T = T
+        lib.PeriodicExp4Batch_reset(self.obj, self.T, seed, c_double(-1 if gamma == None else gamma))
+        self.t = 0
+        self.log = None
+
+    # labels: current label of each partition. Taken from the label table or computed from the
+    #         partition functions if not given.
+    # returns a NumPy array of the arm chosen by each device. The array is reused on the next call.
+    def get_next_arms(self, labels=None):
+        if labels is None and self.label_table is not None:
+            if lib.PeriodicExp4Batch_getNextArmsAt(self.obj, self.t, self.arms) < 0:
+                raise_past_label_table(self.t, self.label_table)
+            return self.arms
+        if labels is None:
+            labels = self.labels
+            labels[:] = [f(self.t) for f in self.functions]
+        else:
+            labels = np.ascontiguousarray(labels, dtype=np.int32)
+        lib.PeriodicExp4Batch_getNextArms(self.obj, labels, self.arms)
+        return self.arms
+
+    # rewards: NumPy array of the reward of each device for its chosen arm.
+    def give_rewards(self, rewards, gamma=-1):
+        rewards = np.ascontiguousarray(rewards, dtype=np.float64)
+        lib.PeriodicExp4Batch_giveRewards(self.obj, rewards, c_double(gamma))
+        self.t += 1
+
+    # Same as PeriodicExp4.get_state, as an [N][state size] array. Row i is the state of device i, and can be
+    # restored into PeriodicExp4(..., device=i) and the other way round.
+    def get_state(self):
+        devices = [lib.PeriodicExp4Batch_getDevice(self.obj, d) for d in range(self.N)]
+        states = np.empty((self.N, lib.PeriodicExp4_getStateSize(devices[0])))
+        for device, state in zip(devices, states):
+            lib.PeriodicExp4_writeState(device, state)
+        return states
+
+    def set_state(self, states):
+        for d, state in enumerate(states):
+            self.t = read_state(lib.PeriodicExp4Batch_getDevice(self.obj, d), state, False)
+
+    def warm_start(self, states):
+        for d, state in enumerate(states):
+            read_state(lib.PeriodicExp4Batch_getDevice(self.obj, d), state, True)
+
+    # Same as PeriodicExp4.weight_bytes, for all devices.
+    def weight_bytes(self):
+        return sum(lib.PeriodicExp4_getWeightBytes(lib.PeriodicExp4Batch_getDevice(self.obj, d)) for d in range(self.N))
+
+    def get_log_headers(self):
+        return ['w_partitionF%d' % f for f in range(1,self.F+1)] +\
+               ['w_arm%d' % i for i in range(1,self.K+1)] +\
+               ['probability%d' % i for i in range(1,self.K+1)]
+
+    # Same as PeriodicExp4.enable_log, for all devices at once. The log is a [N][T/every][F+2K] array.
+    # paths: if given, a list of N paths. Each device then logs into its own memory-mapped .npy file
+    #        and self.log is the list of the N [T/every][F+2K] arrays.
+    def enable_log(self, every=1, path=None, paths=None, append=False):
+        rows = (self.T + every-1)//every
+        self.log_every = every
+        if paths != None:
+            self.log = [make_log_buffer(rows, self.F+2*self.K, devicePath, append=append) for devicePath in paths]
+            for d, deviceLog in enumerate(self.log):
+                lib.PeriodicExp4_setLog(lib.PeriodicExp4Batch_getDevice(self.obj, d), deviceLog.ctypes.data, rows, every)
+        else:
+            self.log = make_log_buffer(rows, self.F+2*self.K, path, self.N, append=append)
+            lib.PeriodicExp4Batch_setLog(self.obj, self.log.ctypes.data, rows, every)
+
+    def disable_log(self):
+        lib.PeriodicExp4Batch_setLog(self.obj, None, 0, 1)
+
+    def extract_log(self):
+        rows = (self.t + self.log_every-1)//self.log_every
+        if isinstance(self.log, list):
+            return [deviceLog[:rows] for deviceLog in self.log]
+        return self.log[:,:rows]
+
+    # out: optional [N][F+2K] float64 array to write the current timestep data of every device into.
+    # returns out, or an internal array that is overwritten by the next call if out is not given.
+    def get_timestep_logs(self, out=None):
+        if out is None:
+            out = self.timestep_data
+        lib.PeriodicExp4Batch_writeTimestepData(self.obj, out)
+        return out
+
+# Allocates a zeroed float64 log of the given shape, as a memory-mapped .npy file if path is given.
+# append: reuse the file at path if it holds a log of this shape, keeping its rows.
+def make_log_buffer(rows, cols, path=None, devices=None, append=False):
+    shape = (rows, cols) if devices == None else (devices, rows, cols)
+    if path != None:
+        if append and os.path.exists(path):
+            log = np.lib.format.open_memmap(path, mode='r+')
+            if log.shape == shape and log.dtype == np.float64: return log
+            del log
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=shape)
+    return np.zeros(shape)
+
+class LearnerPool(object):
+    # Keeps the native learners of finished runs, to reuse them in later runs of the same process. A learner of the
+    # same shape (number of devices, K and label counts) is reset instead of allocating a new one, so sweeps and
+    # benchmarks running many trials in one process keep a constant memory use.
+    #     with LearnerPool() as pool:
+    #         for seed in range(trials):
+    #             with pool.batch(N, T, K, partitions, seed=seed, gamma=0.3) as learners:
+    #                 ...
+    def __init__(self):
+        self.free = {} # (N or None, K, label counts): learners ready to be reset
+
+    # Same as PeriodicExp4(T, K, functions, seed, gamma, device), reusing a released learner if there is one.
+    def acquire(self, T, K, functions, seed=0, gamma=None, device=0):
+        learners = self.free.get((None, K, partition_label_counts(functions)))
+        if not learners:
+            return PeriodicExp4(T, K, functions, seed=seed, gamma=gamma, device=device)
+        learner = learners.pop()
+        learner.reset(T, functions, seed=seed, gamma=gamma, device=device)
+        return learner
+
+    # Same as PeriodicExp4Batch(N, T, K, functions, seed, gamma), reusing a released batch if there is one.
+    def acquire_batch(self, N, T, K, functions, seed=0, gamma=None):
+        learners = self.free.get((N, K, partition_label_counts(functions)))
+        if not learners:
+            return PeriodicExp4Batch(N, T, K, functions, seed=seed, gamma=gamma)
+        learner = learners.pop()
+        learner.reset(T, functions, seed=seed, gamma=gamma)
+        return learner
+
+    # Hands a learner of acquire or acquire_batch back to the pool; it must not be used afterwards.
+    def release(self, learner):
+        learner.disable_log()
+        learner.log = None
+        N = learner.N if isinstance(learner, PeriodicExp4Batch) else None
+        self.free.setdefault((N, learner.K, learner.label_counts), []).append(learner)
+
+    @contextmanager
+    def learner(self, *args, **kwargs):
+        learner = self.acquire(*args, **kwargs)
+        try:
+            yield learner
+        finally:
+            self.release(learner)
+
+    @contextmanager
+    def batch(self, *args, **kwargs):
+        learner = self.acquire_batch(*args, **kwargs)
+        try:
+            yield learner
+        finally:
+            self.release(learner)
+
+    # Frees the learners in the pool.
+    def close(self):
+        for learners in self.free.values():
+            for learner in learners:
+                learner.close()
+        self.free = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Label counts of a PartitionSpec, or of a tuple of (function, label_count) pairs.
+def partition_label_counts(functions):
+    if isinstance(functions, PartitionSpec):
+        return tuple(functions.label_counts)
+    labelCounts = tuple(f[1] for f in functions)
+    if any(count < 1 for count in labelCounts):
+        raise ValueError('every partition needs at least one label, got label counts %s' % (list(labelCounts),))
+    return labelCounts
+
+# Raises if functions is a PartitionSpec of fewer than T timesteps: the native code reads a row of its label table
+# at every timestep of the learner.
+def check_partition_rows(functions, T):
+    if isinstance(functions, PartitionSpec) and functions.T < T:
+        raise ValueError('the partitions cover %d timesteps, the learner needs %d' % (functions.T, T))
+
+def raise_past_label_table(t, labelTable):
+    raise IndexError('timestep %d is past the %d rows of the label table' % (t, len(labelTable)))
+
+# (None, label table) of a PartitionSpec, or (functions, None) of a tuple of (function, label_count) pairs.
+def partition_sources(functions):
+    if isinstance(functions, PartitionSpec):
+        return None, functions.materialize()
+    return tuple(f[0] for f in functions), None
+
+# Reads a state of PeriodicExp4.get_state into a native learner, and returns its timestep.
+def read_state(obj, state, weightsOnly):
+    timestep = lib.PeriodicExp4_readState(obj, np.ascontiguousarray(state, dtype=np.float64), int(weightsOnly))
+    if timestep < 0:
+        raise ValueError('the state is of a learner with other arms or partitions')
+    return timestep
 
 def generate_random_seed():
     import random
@@ -75,6 +501,7 @@ def make_partition_cycles(T, periods):
 
 
 def make_repeating_partition_cycles(T, repeats, periods):
+    # See PartitionSpec for the precomputed equivalent.
     def make_cycle_function(T,P):
         def f(t):
             i = (t*repeats)//T
@@ -86,6 +513,75 @@ def make_repeating_partition_cycles(T, repeats, periods):
     return tuple(make_cycle_function(T,i) for i in periods)
 
 
+class PartitionSpec(object):
+    # Declarative form of make_partition_cycles / make_repeating_partition_cycles.
+    # The labels of all partitions are materialized once into a [T][F] table, which is shared by
+    # every learner using this spec and read by the native code through a pointer.
+    # T: number of timesteps
+    # periods: number of labels in each partition, within one repeat
+    # repeats: number of times the partitions restart over T. repeats=1 gives make_partition_cycles.
+    def __init__(self, T, periods, repeats=1):
+        if any(period < 1 for period in periods):
+            raise ValueError('every partition needs at least one label, got periods %s' % (list(periods),))
+        self.T = T
+        self.periods = tuple(periods)
+        self.repeats = repeats
+        self.label_counts = self.periods
+        self.table = None
+
+    def __len__(self):
+        return len(self.periods)
+
+    def label_dtype(self):
+        return np.int16 if max(self.periods, default=0) <= np.iinfo(np.int16).max else np.int32
+
+    # Same labels as the functions of make_repeating_partition_cycles, for all t at once.
+    def compute_table(self):
+        return self.compute_labels(0, self.T)
+
+    # Rows start..stop-1 of the label table, without materializing the rest of it.
+    def compute_labels(self, start, stop):
+        T, repeats = self.T, self.repeats
+        t = np.arange(start, stop, dtype=np.int64)
+        i = (t*repeats)//T
+        repeatStart = (i*T + repeats-1)//repeats
+        length = ((i+1)*T + repeats-1)//repeats - repeatStart
+        periods = np.array(self.periods, dtype=np.int64)
+        table = ((t-repeatStart)[:,None]*periods[None,:])//length[:,None]
+        return table.astype(self.label_dtype())
+
+    # File name of the label table of this spec in cacheDir, for materialize(path).
+    # The periods are identified by a digest, since a configuration may have many of them.
+    def cache_name(self, cacheDir):
+        digest = hashlib.sha1(repr(self.periods).encode()).hexdigest()[:16]
+        return os.path.join(cacheDir, 'labels--T%d--rep%d--F%d--%s.npy' % (self.T, self.repeats, len(self.periods), digest))
+
+    # Returns the [T][F] label table, computing it on the first call.
+    # path: if given, the table is stored as a .npy file at path and memory-mapped read-only.
+    #       An existing file with the right shape and dtype is reused, so processes using the same file
+    #       share one copy of the table in the page cache.
+    def materialize(self, path=None):
+        if self.table is not None: return self.table
+        shape = (self.T, len(self.periods))
+        if path != None:
+            if os.path.exists(path):
+                table = np.load(path, mmap_mode='r')
+                if table.shape == shape and table.dtype == self.label_dtype():
+                    self.table = table
+                    return self.table
+            # written to a temporary file first, so that concurrent processes never map a partial table
+            directory = os.path.dirname(path)
+            if directory != '' and not os.path.exists(directory): os.makedirs(directory, exist_ok=True)
+            tempPath = '%s.%d.tmp' % (path, os.getpid())
+            with open(tempPath, 'wb') as f:
+                np.save(f, self.compute_table())
+            os.replace(tempPath, path)
+            self.table = np.load(path, mmap_mode='r')
+        else:
+            self.table = self.compute_table()
+        return self.table
+
+
 """
 ###  MAKING FUNCTIONS - END  ###
 """
@@ -110,7 +606,7 @@ def make_repeating_partition_cycles(T, repeats, periods):
 #
 def algo_partition_cycles(T, K, period_list, seed=None, gamma=None):
     if seed == None: seed = generate_random_seed()
-    functions = make_partition_cycles(T, period_list)
+    functions = PartitionSpec(T, period_list)
     return PeriodicExp4(T, K, functions, seed=seed, gamma=gamma)
 
 """
@@ -132,6 +628,9 @@ def test_algorithm():
     #alg = algo_partition_cycles(T, K, [3] + list(range(60,90)))
     alg = algo_partition_cycles(T, K, list(range(1,30)))
 
+    LOGGING = False
+    if LOGGING: alg.enable_log(every=10)
+
 
     total_reward = 0
     picked_arms = []
@@ -181,14 +680,11 @@ def test_algorithm():
     print('Reward: %g' % (total_reward/GOOD_REWARD))
 
 
-    LOGGING = False #Only turn this on if compiled with #define ENABLE_LOGGING
     if LOGGING:
         #print(''.join(str(i) for i in picked_arms))
-        cols, weightlog = alg.extract_log()
-        #logoutput = ' '.join(str(x) for x in weightlog)
-        weightlog = [int(math.log(x)) for x in weightlog]
-        lines = [weightlog[i*cols:(i+1)*cols] for i in range(0,T,10)]
-        logoutput = '\n'.join(' '.join('%3d'%x for x in line) for line in lines)
+        weightlog = alg.extract_log()
+        lines = weightlog.tolist()
+        logoutput = '\n'.join(' '.join('%8.3f'%x for x in line) for line in lines)
 
         f = open('weightlog.txt', 'w+')
         f.write(logoutput)
@@ -204,7 +700,239 @@ def test_algorithm():
         f.close()
 
 
+def test_batch_algorithm():
+    # The batched engine must pick exactly the same arms as separately created learners.
+    T = 2000
+    K = 5
+    N = 8
+    seed = 1234
+    functions = make_repeating_partition_cycles(T, 4, list(range(1,10)))
+
+    batch = PeriodicExp4Batch(N, T, K, functions, seed=seed, gamma=0.3)
+    singles = [PeriodicExp4(T, K, functions, seed=seed, gamma=0.3, device=i) for i in range(N)]
+
+    rewardTable = np.random.RandomState(seed).uniform(size=(T,K))
+    for t in range(T):
+        arms = batch.get_next_arms()
+        singleArms = [alg.get_next_arm() for alg in singles]
+        assert list(arms) == singleArms, 'mismatch at t=%d' % t
+        logs = batch.get_timestep_logs()
+        for d, alg in enumerate(singles):
+            assert (logs[d] == alg.get_timestep_view()).all(), 'log mismatch at t=%d' % t
+
+        rewards = rewardTable[t][arms]
+        batch.give_rewards(rewards, 0.3)
+        for alg, reward in zip(singles, rewards):
+            alg.give_reward(reward, 0.3)
+    print('Batch matches individual learners over %d steps.' % T)
+
+
+def test_state():
+    # A learner restored from a state must continue exactly as the original, in a batch or alone.
+    T = 600
+    K = 4
+    N = 3
+    functions = PartitionSpec(T, [1,2,5,7], repeats=3)
+    rewardTable = np.random.RandomState(5).uniform(size=(T,K))
+    def run(learner, start, stop):
+        arms = []
+        for t in range(start, stop):
+            arm = learner.get_next_arms()[1] if isinstance(learner, PeriodicExp4Batch) else learner.get_next_arm()
+            arms.append(int(arm))
+            if isinstance(learner, PeriodicExp4Batch):
+                learner.give_rewards(rewardTable[t][learner.arms], 0.3)
+            else:
+                learner.give_reward(rewardTable[t][arm], 0.3)
+        return arms
+
+    original = PeriodicExp4Batch(N, T, K, functions, seed=9, gamma=0.3)
+    firstHalf = run(original, 0, T//2)
+    states = original.get_state()
+    secondHalf = run(original, T//2, T)
+
+    single = PeriodicExp4(T, K, functions, seed=9, gamma=0.3, device=1)
+    single.set_state(states[1])
+    assert single.t == T//2
+    assert run(single, T//2, T) == secondHalf
+    assert (single.get_state() == original.get_state()[1]).all()
+
+    warm = PeriodicExp4(T, K, functions, seed=9, gamma=0.3, device=1)
+    warm.warm_start(states[1])
+    weights = slice(2*len(functions)+5+K, 2*len(functions)+5+K + sum(functions.periods)*K) # see PeriodicExp4::writeState
+    assert warm.t == 0 and (warm.get_state()[weights] == states[1][weights]).all()
+    print('Restored learners continue the original run.')
+
+
+def test_empty_partition():
+    # A partition without labels has no row of its own in the stacked weights, so it must be rejected.
+    for periods in ([0,2], [3,0], [-1]):
+        try:
+            PartitionSpec(100, periods)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('PartitionSpec accepted periods %s' % periods)
+    try:
+        PeriodicExp4(100, 3, ((lambda t: 0, 0), (lambda t: t%2, 2)))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('PeriodicExp4 accepted a partition function with no labels')
+    print('Partitions without labels are rejected.')
+
+
+def test_short_partitions():
+    # The native code reads row t of the label table at timestep t, so a table shorter than the run must be rejected,
+    # and a learner running past its table must raise instead of reading past it.
+    short = PartitionSpec(50, [2,3])
+    calls = [lambda: PeriodicExp4(100, 3, short),
+             lambda: PeriodicExp4Batch(4, 100, 3, short),
+             lambda: PeriodicExp4(50, 3, PartitionSpec(50, [2,3])).reset(T=100),
+             lambda: PeriodicExp4Batch(4, 50, 3, PartitionSpec(50, [2,3])).reset(T=100),
+             lambda: PeriodicExp4(100, 3, PartitionSpec(100, [2,3])).set_partitions(short),
+             lambda: PeriodicExp4Batch(4, 100, 3, PartitionSpec(100, [2,3])).reset(functions=short)]
+    for call in calls:
+        try:
+            call()
+        except ValueError:
+            continue
+        raise AssertionError('a label table of 50 rows was accepted for 100 timesteps')
+    for learner in (PeriodicExp4(50, 3, short), PeriodicExp4Batch(4, 50, 3, short)):
+        learner.t = 50
+        try:
+            learner.get_next_arm() if isinstance(learner, PeriodicExp4) else learner.get_next_arms()
+        except IndexError:
+            continue
+        raise AssertionError('a learner read past its label table')
+    print('Label tables shorter than the run are rejected.')
+
+
+def test_label_totals():
+    # The running per-partition totals of the max weights must stay at the sums of the per-label values over a
+    # full-length run (MODE_APPROXIMATE, the default build; other modes have another state layout).
+    T = 86400
+    K = 3
+    periods = list(range(1,51))
+    spec = PartitionSpec(T, periods, repeats=60)
+    learner = PeriodicExp4(T, K, spec, seed=7, gamma=0.3)
+    rewardTable = np.random.RandomState(7).uniform(size=(T,K))
+    for t in range(T):
+        arm = learner.get_next_arm()
+        learner.give_reward(rewardTable[t][arm], -1)
+    state = learner.get_state()
+    F, L = len(periods), sum(periods)
+    if len(state) != 2 + F + 3 + F + K + L*K + L + F:
+        print('Label totals not checked: the library is not built with MODE_APPROXIMATE.')
+        return
+    mw = state[-(L+F):-F]
+    mwTotal = state[-F:]
+    exact = np.add.reduceat(mw, np.cumsum([0] + periods[:-1]))
+    drift = np.abs(mwTotal - exact).max() / np.abs(exact).max()
+    assert drift < 1e-10, 'running label totals drifted by %g' % drift
+    print('Running label totals stay within %.1e of the exact sums after %d steps.' % (drift, T))
+
+
+def test_pool():
+    # A learner reused from the pool must behave exactly like a new one, and the pool must not grow with the trials.
+    T = 400
+    K = 3
+    N = 4
+    functions = PartitionSpec(T, [1,3,4], repeats=2)
+    rewardTable = np.random.RandomState(3).uniform(size=(T,K))
+    def run(batch):
+        arms = []
+        for t in range(T):
+            arms.append(batch.get_next_arms().copy())
+            batch.give_rewards(rewardTable[t][batch.arms])
+        return np.array(arms)
+
+    with PeriodicExp4Batch(N, T, K, functions, seed=11, gamma=0.3) as batch:
+        expected = run(batch)
+    with LearnerPool() as pool:
+        with pool.batch(N, T, K, functions, seed=5) as batch:
+            run(batch)
+            first = batch
+        for trial in range(50):
+            with pool.batch(N, T, K, functions, seed=11, gamma=0.3) as batch:
+                assert batch is first
+                assert (run(batch) == expected).all()
+        with pool.learner(T, K, functions, seed=11, gamma=0.3, device=2) as learner:
+            arms = []
+            for t in range(T):
+                arm = learner.get_next_arm()
+                arms.append(arm)
+                learner.give_reward(rewardTable[t][arm], -1)
+            assert arms == expected[:,2].tolist()
+        assert sum(len(learners) for learners in pool.free.values()) == 2
+    for closed in (first, learner):
+        try:
+            closed.get_state()
+        except ValueError:
+            continue
+        assert False, 'a closed learner must not be usable'
+    print('Pooled learners match new learners.')
+
+
+def test_philox():
+    # The native generator must give the Random123 known answers, and the same uniforms as sampling.philox_uniforms.
+    import sampling
+    assert sampling.philox4x32([0]*4, 0, 0) == [0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8]
+    assert sampling.philox4x32([0xffffffff]*4, 0xffffffff, 0xffffffff) == [0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd]
+    seed = 1234
+    slots = np.array([0, 1, 2, 1000, 2**32-1, 2**32, 2**40+7], dtype=np.uint64)
+    uniforms = sampling.philox_uniforms(seed, np.arange(3)[:,None], slots[None,:])
+    for device in range(3):
+        for i, slot in enumerate(slots.tolist()):
+            assert lib.Philox_uniform(seed, device, slot, 0) == uniforms[device,i], 'mismatch at device %d, slot %d' % (device, slot)
+    print('Native and NumPy Philox streams match.')
+
+
+def test_search_cdf():
+    # The native and NumPy samplers must pick the same arm for the same cumulative probabilities and uniform,
+    # also when the uniform is exactly on a boundary or an arm has zero probability (which must never be picked).
+    import sampling
+    rows = [[0.5, 0.0, 0.5], [0.0, 0.25, 0.25, 0.5], [0.25, 0.25, 0.0, 0.0, 0.5], [1.0, 0.0]] + \
+           [np.random.RandomState(k).uniform(size=k) * (np.arange(k) % 3 != 1) for k in (17, 40)]
+    for p in rows:
+        cumulative = np.cumsum(p)
+        values = np.concatenate([[0.0], cumulative[:-1], np.random.RandomState(len(p)).uniform(size=50)*cumulative[-1]])
+        values = values[values < cumulative[-1]]    # a uniform is below the total
+        numpyArms = np.minimum(sampling.search_cdf(np.tile(cumulative, (len(values),1)), values), len(p)-1)
+        for v, numpyArm in zip(values.tolist(), numpyArms.tolist()):
+            arm = lib.Sampling_searchCdf(cumulative, len(p), v)
+            assert arm == numpyArm, 'native arm %d, NumPy arm %d for %r at %r' % (arm, numpyArm, list(p), v)
+            assert p[arm] > 0, 'zero probability arm %d chosen for %r at %r' % (arm, list(p), v)
+    print('Native and NumPy samplers pick the same arms.')
+
+
+def benchmark_periods():
+    # Steps/sec of the native learner as the number of periods (and so the number of labels) grows.
+    # With the running label aggregates, the cost of a step should only grow with F*K.
+    # The labels come from the PartitionSpec table, as in a simulation, so the cost of label changes is included.
+    import time
+    T = 86400
+    K = 3
+    N = 20
+    steps = 2000
+    rewards = np.full(N, 0.5)
+    print('%8s %8s %12s' % ('periods', 'labels', 'steps/sec'))
+    for maxPeriod in [1, 10, 25, 50, 100, 200]:
+        periods = list(range(1,maxPeriod+1))
+        batch = PeriodicExp4Batch(N, T, K, PartitionSpec(T, periods, repeats=60), seed=0, gamma=0.3)
+
+        start = time.perf_counter()
+        for t in range(steps):
+            batch.get_next_arms()
+            batch.give_rewards(rewards)
+        elapsed = time.perf_counter() - start
+        print('%8d %8d %12.0f' % (maxPeriod, sum(periods), steps/elapsed))
+
+
 if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ['benchmark']:
+        benchmark_periods()
+        quit()
     test_algorithm()
 
     quit()
@@ -1,2 +1,2 @@
-g++ -std=c++11 -o3 -c -fPIC periodicexp4.cpp -o periodicexp4.o
+g++ -std=c++11 -O3 "$@" -c -fPIC periodicexp4.cpp -o periodicexp4.o
 g++ -shared -Wl,-soname,libperiodicexp4.so -o libperiodicexp4.so  periodicexp4.o
\ No newline at end of file
@@ -1,7 +1,7 @@
-//#define ENABLE_LOGGING
 //#define MODE_NORMALIZE
 #define MODE_APPROXIMATE
 #define MODE_STABLE
+//#define MODE_FLOAT_WEIGHTS // or sh compile.sh -DMODE_FLOAT_WEIGHTS
 
 
 #ifndef MODE_STABLE
@@ -21,39 +21,93 @@
 #include <iostream>
 #include <vector>
 #include <cmath>
-#include <random>
+#include <cstdint>
+#include <limits>
+#include <algorithm>
 const double MIN_DOUBLE = std::numeric_limits<double>::min();
 const double MAX_DOUBLE = std::numeric_limits<double>::max();
 
-class DataLog {
-public:
-    int cols;
-    int index;
-    std::vector<double> data;
-    DataLog(int cols): cols(cols), index(0) {}
-    void add(double v) { data.push_back(v); }
-    void reset() { index = 0; }
-    void clear() { data.clear(); reset(); }
-    double next() { return data[index++]; }
-};
+// The running per-partition totals (mwTotal, logSbTotal) are updated by differences, which accumulates rounding
+// error over a long run; they are recomputed from the per-label values every this many timesteps.
+const int LABEL_TOTALS_RESYNC = 1024;
+
+// Type of the per-expert state (w, mw, b, sb), which dominates the memory of a learner.
+// float halves it; the running totals, probabilities and rewards stay double.
+#ifdef MODE_FLOAT_WEIGHTS
+typedef float Weight;
+#else
+typedef double Weight;
+#endif
+
+// Philox4x32-10 counter-based generator (Salmon et al., "Parallel random numbers: as easy as 1, 2, 3").
+// The uniform of a device at a slot is a pure function of (seed, device, slot), so it can be computed on
+// its own, in any order and on any thread. sampling.philox_uniforms computes the same values in NumPy.
+const uint32_t PHILOX_M0 = 0xD2511F53;
+const uint32_t PHILOX_M1 = 0xCD9E8D57;
+const uint32_t PHILOX_W0 = 0x9E3779B9;
+const uint32_t PHILOX_W1 = 0xBB67AE85;
+
+void philox4x32(uint32_t ctr[4], uint32_t k0, uint32_t k1) {
+    for (int round=0; round<10; ++round) {
+        if (round > 0) {
+            k0 += PHILOX_W0;
+            k1 += PHILOX_W1;
+        }
+        const uint64_t p0 = (uint64_t)PHILOX_M0 * ctr[0];
+        const uint64_t p1 = (uint64_t)PHILOX_M1 * ctr[2];
+        const uint32_t c0 = (uint32_t)(p1 >> 32) ^ ctr[1] ^ k0;
+        const uint32_t c2 = (uint32_t)(p0 >> 32) ^ ctr[3] ^ k1;
+        ctr[0] = c0;
+        ctr[1] = (uint32_t)p1;
+        ctr[2] = c2;
+        ctr[3] = (uint32_t)p0;
+    }
+}
+
+// uniform in [0,1) with 53 random bits, keyed by (seed, device), counter (slot, draw)
+double philoxUniform(uint32_t seed, uint32_t device, uint64_t slot, uint32_t draw) {
+    uint32_t ctr[4] = {(uint32_t)slot, (uint32_t)(slot >> 32), draw, 0};
+    philox4x32(ctr, seed, device);
+    return ((ctr[0] >> 5) * 67108864.0 + (ctr[1] >> 6)) / 9007199254740992.0;
+}
+
+// index of the first cumulative probability greater than the uniform v, clipped to K-1. Same rule as
+// sampling.search_cdf: an arm of zero probability is never chosen, and a tie goes to the next arm.
+int searchCdf(const double* cumulative, size_t K, double v) {
+    const size_t arm = std::upper_bound(cumulative, cumulative + K, v) - cumulative;
+    return arm < K ? (int)arm : (int)K-1;
+}
 
 class PeriodicExp4 {
-public:
-    DataLog* dataLog;
 private:
     // Data
-    // INDEX: [f][label][arm]
-    std::vector<std::vector<std::vector<double> > > w; // weight
+    // The labels of all partitions are stacked into rows: row labelOffsets[f]+label is (partition f, label).
+    // Each per-expert array is one contiguous block, so the arms of a row are adjacent.
+    // INDEX: [f]
+    std::vector<size_t> labelOffsets;
+
+    // INDEX: [row*K + arm]
+    std::vector<Weight> w; // weight
 
 #ifdef MODE_APPROXIMATE
-    std::vector<std::vector<double> > mw; // max(w) over all arms    
+    // INDEX: [row]
+    std::vector<Weight> mw; // max(w) over all arms
+
+    // INDEX: [f]
+    std::vector<double> mwTotal; // sum(mw) over all labels
 #endif
 
 #ifdef MODE_NOT_APPROXIMATE
-    std::vector<std::vector<std::vector<double> > > b; // expweight
+    // INDEX: [row*K + arm]
+    std::vector<Weight> b; // expweight
 
-    // INDEX: [f][label]
-    std::vector<std::vector<double> > sb; // sum(b) over all arms
+    // INDEX: [row]
+    std::vector<Weight> sb; // sum(b) over all arms
+
+# ifdef MODE_STABLE
+    // INDEX: [f]
+    std::vector<double> logSbTotal; // sum(log(sb)) over all labels
+# endif
 
 # ifdef MODE_NOT_STABLE
     // INDEX: [f]
@@ -64,13 +118,30 @@ private:
     // INDEX: [K]
     std::vector<double> p;
 
+    // State of the current timestep: F partition weights, K arm weights, K probabilities.
+    std::vector<double> timestepData;
+
+    // Optional full-run log, INDEX: [row][F+2K]. Provided by the caller, not owned.
+    // The timestep data of every logEvery-th step is copied into it after the reward is given.
+    double* logBuffer;
+    int logRows;
+    int logEvery;
+
+    int timestep; // number of rewards given so far
+
     // Results
     int chosenArm;
     std::vector<int> currentLabels; // indexed by partition F
 
-    // Random
-    std::mt19937 gen;
-    std::uniform_real_distribution<double> dis;
+    // Optional precomputed label table, INDEX: [t][f]. Shared between learners, not owned.
+    const void* labelTable;
+    int labelTableBytes; // 2 for int16 entries, 4 for int32 entries
+    int labelTableRows;
+
+    // Random: the uniform of each timestep is philoxUniform(seed, device, timestep, 0)
+    uint32_t seed;
+    uint32_t device;
+    std::vector<double> cumulativeP; // INDEX: [arm], running sums of p for the arm search
 
     int T;
     int K;
@@ -82,11 +153,25 @@ private:
 
 
 private:
+    size_t row(size_t f, int label) const {
+        return labelOffsets[f] + label;
+    }
+
+    Weight* wRow(size_t f, int label) {
+        return &w[row(f, label)*K];
+    }
+
+#ifdef MODE_NOT_APPROXIMATE
+    Weight* bRow(size_t f, int label) {
+        return &b[row(f, label)*K];
+    }
+#endif
 
 #ifdef MODE_APPROXIMATE
-    const double computeLogSumExp(const std::vector<double>& values) {
+    template <typename T>
+    const double computeLogSumExp(const T* values, size_t n) {
         double max = 0;
-        for (size_t i=0; i<values.size(); ++i) {
+        for (size_t i=0; i<n; ++i) {
             if (values[i] > max) max = values[i];
         }
         return max;
@@ -95,29 +180,34 @@ private:
 
 #ifdef MODE_APPROXIMATE
     std::vector<double> temp_mwf;
-    std::vector<double> temp_mwf_i;
 
-    void computeWithNewLabels() {
+    // temp_mwf[f] = sum(mw) over all labels except the current one.
+    void computeOtherLabelWeights() {
         temp_mwf.resize(F);
-        temp_mwf_i.resize(F);
+        for (size_t f=0; f<F; ++f) {
+            temp_mwf[f] = mwTotal[f] - mw[row(f, currentLabels[f])];
+        }
+    }
 
+    // out[i] = max(0, max over f of w[f][currentLabels[f]][i] + temp_mwf[f]), one contiguous row per partition.
+    void computeArmWeights(double* out) {
+        for (size_t i=0; i<K; ++i) out[i] = 0;
         for (size_t f=0; f<F; ++f) {
-            double mwf = 0;
-            for (size_t l=0; l<nLabels[f]; ++l) {
-                if (l == currentLabels[f]) continue;
-                mwf += mw[f][l];
+            const Weight* weights = wRow(f, currentLabels[f]);
+            const double other = temp_mwf[f];
+            for (size_t i=0; i<K; ++i) {
+                out[i] = std::max(out[i], weights[i] + other);
             }
-            temp_mwf[f] = mwf;
         }
+    }
+
+    void computeWithNewLabels() {
+        computeOtherLabelWeights();
+        computeArmWeights(p.data());
 
         double smallestWeight = MAX_DOUBLE;
         for (size_t i=0; i<K; ++i) {
-            for (size_t f=0; f<F; ++f) {
-                temp_mwf_i[f] = w[f][currentLabels[f]][i] + temp_mwf[f];
-            }
-            double armWeight = computeLogSumExp(temp_mwf_i);
-            p[i] = armWeight;
-            if (armWeight < smallestWeight) smallestWeight = armWeight;
+            if (p[i] < smallestWeight) smallestWeight = p[i];
         }
         double totalR = 0;
         for (size_t i=0; i<K; ++i) {
@@ -133,30 +223,40 @@ private:
 #endif
 
 #ifdef MODE_STABLE
-    std::vector<float> temp_bff;
+    std::vector<double> temp_bff;
 
-    void computeWithNewLabels() {
+    // temp_bff[f] = product of sb over all labels except the current one, divided by the largest such product.
+    // The products themselves overflow, so they stay in log space until then; p is normalized anyway.
+    void computeOtherLabelWeights() {
         temp_bff.resize(F);
+        double maxLog = -std::numeric_limits<double>::infinity();
+        for (size_t f=0; f<F; ++f) {
+            temp_bff[f] = logSbTotal[f] - std::log(sb[row(f, currentLabels[f])]);
+            maxLog = std::max(maxLog, temp_bff[f]);
+        }
+        for (size_t f=0; f<F; ++f) {
+            temp_bff[f] = std::exp(temp_bff[f] - maxLog);
+        }
+    }
 
+    void computeWithNewLabels() {
+        computeOtherLabelWeights();
         for (size_t f=0; f<F; ++f) {
-            double bff = 1;
-            for (size_t l=0; l<nLabels[f]; ++l) {
-                if (l == currentLabels[f]) continue;
-                bff *= sb[f][l];
-            }
-            temp_bff[f] = std::max(MIN_DOUBLE, bff);
+            temp_bff[f] = std::max(MIN_DOUBLE, temp_bff[f]);
         }
 
+        for (size_t i=0; i<K; ++i) p[i] = 0;
+        for (size_t f=0; f<F; ++f) {
+            const Weight* expWeights = bRow(f, currentLabels[f]);
+            const double other = temp_bff[f];
+            for (size_t i=0; i<K; ++i) {
+                p[i] += expWeights[i] * other;
+            }
+        }
         double totalR = 0;
         for (size_t i=0; i<K; ++i) {
-            double sum = 0;
-            for (size_t f=0; f<F; ++f) {
-                sum += b[f][currentLabels[f]][i] * temp_bff[f];
-            }
-            sum = std::max(MIN_DOUBLE, sum);
-
-            p[i] = sum;
-            totalR += sum;
+            p[i] = std::max(MIN_DOUBLE, p[i]);
+            totalR += p[i];
         }
 
         for (size_t i=0; i<K; ++i) {
@@ -167,16 +267,17 @@ private:
 
 #ifdef MODE_NOT_STABLE
     void computeWithNewLabels() {
+        for (size_t i=0; i<K; ++i) p[i] = 0;
+        for (size_t f=0; f<F; ++f) {
+            const Weight* expWeights = bRow(f, currentLabels[f]);
+            const double other = bf[f] / sb[row(f, currentLabels[f])];
+            for (size_t i=0; i<K; ++i) {
+                p[i] += expWeights[i] * other;
+            }
+        }
         double totalR = 0;
-
         for (size_t i=0; i<K; ++i) {
-            double sum = 0;
-            for (size_t f=0; f<F; ++f) {
-                sum += b[f][currentLabels[f]][i] * bf[f] / sb[f][currentLabels[f]];
-            }
-
-            p[i] = sum;
-            totalR += sum;
+            totalR += p[i];
         }
 
         for (size_t i=0; i<K; ++i) {
@@ -202,12 +303,11 @@ private:
 
         for (size_t f=0; f<F; ++f) {
             const int labelCount = nLabels[f];
-            for (size_t l=0; l<labelCount; ++l) {
-                for (size_t i=0; i<K; ++i) {
-                    double requiredSubtraction = labelCount*(w[f][l][i] - MAX_W);
-                    if (requiredSubtraction > adjustment) {
-                        adjustment = requiredSubtraction;
-                    }
+            const Weight* weights = wRow(f, 0);
+            for (size_t j=0; j<labelCount*K; ++j) {
+                double requiredSubtraction = labelCount*(weights[j] - MAX_W);
+                if (requiredSubtraction > adjustment) {
+                    adjustment = requiredSubtraction;
                 }
             }
         }
@@ -215,31 +315,51 @@ private:
             for (size_t f=0; f<F; ++f) {
                 const int labelCount = nLabels[f];
                 for (size_t l=0; l<labelCount; ++l) {
+                    Weight* weights = wRow(f, l);
                     for (size_t i=0; i<K; ++i) {
-                        w[f][l][i] -= adjustment/labelCount;
+                        weights[i] -= adjustment/labelCount;
 #ifdef MODE_NOT_APPROXIMATE
-                        b[f][l][i] = std::exp(w[f][l][i]);
+                        bRow(f, l)[i] = std::exp(weights[i]);
 #endif
                     }
 
 #ifdef MODE_APPROXIMATE
                     // update relevant mw
-                    mw[f][l] = computeMaxw(f, l);
+                    mw[row(f, l)] = computeMaxw(f, l);
 #endif
 #ifdef MODE_NOT_APPROXIMATE
                     // update relevant sb
-                    sb[f][l] = std::max(MIN_DOUBLE, computeSumb(f, l));
+                    sb[row(f, l)] = std::max(MIN_DOUBLE, computeSumb(f, l));
 #endif
                 }
             }
+            recomputeLabelTotals();
+        }
+    }
+
+    // Recomputes the running per-partition totals from scratch.
+    void recomputeLabelTotals() {
+        for (size_t f=0; f<F; ++f) {
+#ifdef MODE_APPROXIMATE
+            mwTotal[f] = 0;
+            for (size_t l=0; l<nLabels[f]; ++l) {
+                mwTotal[f] += mw[row(f, l)];
+            }
+#endif
+#ifdef MODE_STABLE
+            logSbTotal[f] = 0;
+            for (size_t l=0; l<nLabels[f]; ++l) {
+                logSbTotal[f] += std::log(sb[row(f, l)]);
+            }
+#endif
         }
     }
 
     void computeWithPreviousLabels(double reward) {
 
+        const double update = reward * gamma / K / p[chosenArm];
         for (size_t f=0; f<F; ++f) {
-            const int label = currentLabels[f];
-            w[f][label][chosenArm] += reward * gamma / K / p[chosenArm];
+            wRow(f, currentLabels[f])[chosenArm] += update;
         }
 
 #ifdef MODE_NORMALIZE
@@ -248,41 +368,51 @@ private:
 
         for (size_t f=0; f<F; ++f) {
             const int label = currentLabels[f];
+            const size_t r = row(f, label);
 
 #ifdef MODE_NOT_APPROXIMATE
-            b[f][label][chosenArm] = std::exp(w[f][label][chosenArm]);
+            bRow(f, label)[chosenArm] = std::exp(wRow(f, label)[chosenArm]);
 #endif
 
 #ifdef MODE_APPROXIMATE
-            mw[f][label] = computeMaxw(f, label);
+            // update relevant mw and mwTotal. Non-negative rewards only increase the
+            // chosen arm's weight, so the max can be updated without a rescan.
+            const double oldMw = mw[r];
+            if (reward >= 0) {
+                mw[r] = std::max(mw[r], wRow(f, label)[chosenArm]);
+            } else {
+                mw[r] = computeMaxw(f, label);
+            }
+            mwTotal[f] += mw[r] - oldMw;
 #endif
 
 #ifdef MODE_NOT_STABLE
             // update relevant bf - Part 1
-            bf[f] /= sb[f][label];
+            bf[f] /= sb[r];
             // update relevant sb
-            sb[f][label] = computeSumb(f, label);
+            sb[r] = computeSumb(f, label);
             // update relevant bf - Part 2
-            bf[f] *= sb[f][label];
+            bf[f] *= sb[r];
 #endif
 
 #ifdef MODE_STABLE
-            // update relevant sb
-            sb[f][label] = std::max(MIN_DOUBLE, computeSumb(f, label));
+            // update relevant sb and logSbTotal
+            const double oldSb = sb[r];
+            sb[r] = std::max(MIN_DOUBLE, computeSumb(f, label));
+            logSbTotal[f] += std::log(sb[r]) - std::log(oldSb);
 #endif
         }
     }
 
 #ifdef MODE_APPROXIMATE
     const double computeMaxw(size_t f, int label) {
-        const std::vector<double>& vec = w[f][label];
-        return computeLogSumExp(vec);
+        return computeLogSumExp(wRow(f, label), K);
     }
 #endif
 
 #ifdef MODE_NOT_APPROXIMATE
     const double computeSumb(size_t f, int label) {
-        const std::vector<double>& vec = b[f][label];
+        const Weight* vec = bRow(f, label);
         double sum = 0;
         for (size_t i=0; i<K; ++i) {
             sum += vec[i];
@@ -291,88 +421,102 @@ private:
     }
 #endif
 
-    // computes nextArm based on the existing probabilities
+    // computes nextArm based on the existing probabilities: the first arm whose cumulative probability exceeds
+    // the uniform, by binary search.
     void decideNextArm() {
-        double v = dis(gen);
-        chosenArm = 0;
-        while (v > p[chosenArm]) {
-            v -= p[chosenArm];
-            ++chosenArm;
+        const double v = philoxUniform(seed, device, timestep, 0);
+        double total = 0;
+        for (size_t i=0; i<K; ++i) {
+            total += p[i];
+            cumulativeP[i] = total;
         }
-        if (chosenArm >= K) chosenArm = K-1;
+        chosenArm = searchCdf(cumulativeP.data(), K, v);
     }
 
 public:
     // To use a default value of gamma, set gamma to -1.
-    PeriodicExp4(int _T, int _K, int _F, int* labelCounts, int seed, double _gamma): T(_T), K(_K), F(_F), dis(0.0, 1.0), gen(seed), gamma(_gamma) {
-        dataLog = new DataLog(1);
-        normalizeCooldown = 0;
-
-        // Set gamma if not yet set.
-        if (gamma < 0) {
-            double N = 0;
-            for (size_t i=0; i<F; ++i) {
-                N += pow(K,labelCounts[i]);
-            }
-            gamma = sqrt(K * std::log(N) / T);
-        }
+    PeriodicExp4(int _T, int _K, int _F, int* labelCounts, int _seed, int _device, double _gamma): K(_K), F(_F) {
+        labelTable = NULL;
+        labelTableBytes = 0;
+        labelTableRows = 0;
 
         currentLabels.resize(F);
 
         nLabels.resize(F);
-        w.resize(F);
-#ifdef MODE_APPROXIMATE        
-        mw.resize(F);
+        labelOffsets.resize(F);
+        size_t totalLabels = 0;
+        for (size_t f=0; f<F; ++f) {
+            nLabels[f] = labelCounts[f];
+            labelOffsets[f] = totalLabels;
+            totalLabels += labelCounts[f];
+        }
+
+        w.resize(totalLabels*K);
+#ifdef MODE_APPROXIMATE
+        mw.resize(totalLabels);
+        mwTotal.resize(F);
 #endif
 #ifdef MODE_NOT_APPROXIMATE
-        b.resize(F);
-        sb.resize(F);
+        b.resize(totalLabels*K);
+        sb.resize(totalLabels);
 #endif
-#ifdef MODE_NOT_STABLE        
+#ifdef MODE_STABLE
+        logSbTotal.resize(F);
+#endif
+#ifdef MODE_NOT_STABLE
         bf.resize(F);
-#endif        
-        for (size_t f=0; f<F; ++f) {
-            const int labelCount = labelCounts[f];
-            nLabels[f] = labelCount;
+#endif
+        p.resize(K);
+        cumulativeP.resize(K);
+        timestepData.resize(F+2*K);
 
-#ifdef MODE_APPROXIMATE     
-            w[f].resize(labelCount);
-            mw[f].resize(labelCount);
-            for (size_t l=0; l<nLabels[f]; ++l) {
-                w[f][l].resize(K);
-                for (size_t i=0; i<K; ++i) {
-                    w[f][l][i] = 0;
-                }
-                mw[f][l] = 0;
+        reset(_T, _seed, _device, _gamma);
+
+        // IDEA:::: REPEAT MANy OF THE FUNCTIONS FOR WEIGHTING??
+    }
+
+    // Puts the learner back in the state of a new learner with these arguments, without reallocating.
+    // The arms and partitions stay; the label table too. The log is detached.
+    void reset(int _T, int _seed, int _device, double _gamma) {
+        T = _T;
+        seed = _seed;
+        device = _device;
+        gamma = _gamma;
+        normalizeCooldown = 0;
+        timestep = 0;
+        chosenArm = 0;
+        logBuffer = NULL;
+        logRows = 0;
+        logEvery = 1;
+
+        // Set gamma if not yet set.
+        if (gamma < 0) {
+            double N = 0;
+            for (size_t i=0; i<F; ++i) {
+                N += pow(K,nLabels[i]);
             }
-#endif
+            gamma = sqrt(K * std::log(N) / T);
+        }
 
+        std::fill(currentLabels.begin(), currentLabels.end(), 0);
+        std::fill(w.begin(), w.end(), 0);
+#ifdef MODE_APPROXIMATE
+        std::fill(mw.begin(), mw.end(), 0);
+#endif
 #ifdef MODE_NOT_APPROXIMATE
-            w[f].resize(labelCount);
-            b[f].resize(labelCount);
-            sb[f].resize(labelCount);
-            for (size_t l=0; l<nLabels[f]; ++l) {
-                w[f][l].resize(K);
-                b[f][l].resize(K);
-                for (size_t i=0; i<K; ++i) {
-                    w[f][l][i] = 0;
-                    b[f][l][i] = 1;
-                }
-                sb[f][l] = K;
-            }
+        std::fill(b.begin(), b.end(), 1);
+        std::fill(sb.begin(), sb.end(), K);
 #endif
 #ifdef MODE_NOT_STABLE
-            //bf[f] = pow(K,labelCount);
-            bf[f] = 1;
+        //bf[f] = pow(K,labelCount);
+        std::fill(bf.begin(), bf.end(), 1);
 #endif
-        }
 
-        p.resize(K);
+        recomputeLabelTotals();
+
         for (size_t i=0; i<K; ++i) {
             p[i] = 1.0f/K;
         }
-
-        // IDEA:::: REPEAT MANy OF THE FUNCTIONS FOR WEIGHTING??
     }
 
     int getNextArm(int* labels) {
@@ -384,102 +528,339 @@ public:
         return chosenArm;
     }
 
+    // table: [rows][F] array of labels with entries of labelBytes bytes (2 or 4).
+    void setLabelTable(const void* table, int labelBytes, int rows) {
+        labelTable = table;
+        labelTableBytes = labelBytes;
+        labelTableRows = rows;
+    }
+
+    // same as getNextArm, with the labels read from row t of the label table. -1 if there is no row t.
+    int getNextArmAt(int t) {
+        if (t < 0 || t >= labelTableRows) return -1;
+        if (labelTableBytes == 2) {
+            const int16_t* row = (const int16_t*)labelTable + (size_t)t*F;
+            for (size_t f=0; f<F; ++f) currentLabels[f] = row[f];
+        } else {
+            const int32_t* row = (const int32_t*)labelTable + (size_t)t*F;
+            for (size_t f=0; f<F; ++f) currentLabels[f] = row[f];
+        }
+        computeWithNewLabels();
+        decideNextArm();
+        return chosenArm;
+    }
+
     // inputs the reward for arm nextArm on the current timestep t.
     void giveReward(double reward, double _gamma) {
         if (_gamma > 0) this->gamma = _gamma;
         computeWithPreviousLabels(reward);
+        if (logBuffer != NULL && timestep % logEvery == 0 && timestep/logEvery < logRows) {
+            const int cols = timestepData.size();
+            computeTimestepData();
+            std::copy(timestepData.begin(), timestepData.end(), logBuffer + (size_t)(timestep/logEvery)*cols);
+        }
+        ++timestep;
+        if (timestep % LABEL_TOTALS_RESYNC == 0) recomputeLabelTotals();
     }
 
-    DataLog* getCurrentTimestepData() {
-        dataLog->clear();
+    // buffer: [rows][F+2K] array that receives the timestep data of every every-th step.
+    // Pass NULL to stop logging.
+    void setLog(double* buffer, int rows, int every) {
+        logBuffer = buffer;
+        logRows = rows;
+        logEvery = std::max(1, every);
+    }
 
+    int getTimestepDataSize() {
+        return timestepData.size();
+    }
+
+    // Bytes allocated for the per-expert state (w, and mw or b and sb), which grows with the number of labels.
+    size_t getWeightBytes() {
+        size_t bytes = w.capacity()*sizeof(Weight);
 #ifdef MODE_APPROXIMATE
-        temp_mwf.resize(F);
+        bytes += mw.capacity()*sizeof(Weight);
+#endif
+#ifdef MODE_NOT_APPROXIMATE
+        bytes += (b.capacity() + sb.capacity())*sizeof(Weight);
+#endif
+        return bytes;
+    }
+
+    // Flat state of the learner, for checkpoints. Layout:
+    // [F, K, nLabels (F), timestep, gamma, chosenArm, currentLabels (F), p (K), w ([f][label][arm]), running aggregates of the mode]
+    int getStateSize() {
+        size_t totalLabels = 0;
+        for (size_t f=0; f<F; ++f) totalLabels += nLabels[f];
+        size_t size = 2 + F + 3 + F + K + totalLabels*K;
+#ifdef MODE_APPROXIMATE
+        size += totalLabels + F;         // mw, mwTotal
+#endif
+#ifdef MODE_NOT_APPROXIMATE
+        size += totalLabels*K + totalLabels; // b, sb
+#endif
+#ifdef MODE_STABLE
+        size += F;                       // logSbTotal
+#endif
+#ifdef MODE_NOT_STABLE
+        size += F;                       // bf
+#endif
+        return size;
+    }
 
+    void writeState(double* out) {
+        size_t index = 0;
+        out[index++] = F;
+        out[index++] = K;
+        for (size_t f=0; f<F; ++f) out[index++] = nLabels[f];
+        out[index++] = timestep;
+        out[index++] = gamma;
+        out[index++] = chosenArm;
+        for (size_t f=0; f<F; ++f) out[index++] = currentLabels[f];
+        for (size_t i=0; i<K; ++i) out[index++] = p[i];
+        index = std::copy(w.begin(), w.end(), out + index) - out;
+#ifdef MODE_APPROXIMATE
+        index = std::copy(mw.begin(), mw.end(), out + index) - out;
+        for (size_t f=0; f<F; ++f) out[index++] = mwTotal[f];
+#endif
+#ifdef MODE_NOT_APPROXIMATE
+        index = std::copy(b.begin(), b.end(), out + index) - out;
+        index = std::copy(sb.begin(), sb.end(), out + index) - out;
+#endif
+#ifdef MODE_STABLE
+        for (size_t f=0; f<F; ++f) out[index++] = logSbTotal[f];
+#endif
+#ifdef MODE_NOT_STABLE
+        for (size_t f=0; f<F; ++f) out[index++] = bf[f];
+#endif
+    }
+
+    // Restores a state written by writeState. With weightsOnly (a warm start), only the weights w are taken,
+    // the aggregates are recomputed from them, and the learner keeps its timestep, gamma and uniform p.
+    // returns the timestep of the learner, or -1 if the state is of a learner with other arms or partitions.
+    int readState(const double* in, int weightsOnly) {
+        size_t index = 0;
+        if ((int)in[index++] != F || (int)in[index++] != K) return -1;
         for (size_t f=0; f<F; ++f) {
-            double mwf = 0;
-            for (size_t l=0; l<nLabels[f]; ++l) {
-                if (l == currentLabels[f]) continue;
-                mwf += mw[f][l];
+            if ((int)in[index++] != nLabels[f]) return -1;
+        }
+        if (weightsOnly) {
+            index += 3 + F + K;
+        } else {
+            timestep = (int)in[index++];
+            gamma = in[index++];
+            chosenArm = (int)in[index++];
+            for (size_t f=0; f<F; ++f) currentLabels[f] = (int)in[index++];
+            for (size_t i=0; i<K; ++i) p[i] = in[index++];
+        }
+        std::copy(in + index, in + index + w.size(), w.begin());
+        index += w.size();
+        if (weightsOnly) {
+            for (size_t f=0; f<F; ++f) {
+                for (size_t l=0; l<nLabels[f]; ++l) {
+#ifdef MODE_APPROXIMATE
+                    mw[row(f, l)] = computeMaxw(f, l);
+#endif
+#ifdef MODE_NOT_APPROXIMATE
+                    for (size_t i=0; i<K; ++i) bRow(f, l)[i] = std::exp(wRow(f, l)[i]);
+                    sb[row(f, l)] = std::max(MIN_DOUBLE, computeSumb(f, l));
+#endif
+                }
+#ifdef MODE_NOT_STABLE
+                bf[f] = 1;
+                for (size_t l=0; l<nLabels[f]; ++l) bf[f] *= sb[row(f, l)];
+#endif
             }
-            temp_mwf[f] = mwf;
+            recomputeLabelTotals();
+            return timestep;
         }
+#ifdef MODE_APPROXIMATE
+        std::copy(in + index, in + index + mw.size(), mw.begin());
+        index += mw.size();
+        for (size_t f=0; f<F; ++f) mwTotal[f] = in[index++];
+#endif
+#ifdef MODE_NOT_APPROXIMATE
+        std::copy(in + index, in + index + b.size(), b.begin());
+        index += b.size();
+        std::copy(in + index, in + index + sb.size(), sb.begin());
+        index += sb.size();
+#endif
+#ifdef MODE_STABLE
+        for (size_t f=0; f<F; ++f) logSbTotal[f] = in[index++];
+#endif
+#ifdef MODE_NOT_STABLE
+        for (size_t f=0; f<F; ++f) bf[f] = in[index++];
+#endif
+        return timestep;
+    }
+
+    // Fills timestepData with the state of the current timestep and returns it.
+    // The buffer is allocated once, so the pointer stays valid for the lifetime of the object.
+    double* computeTimestepData() {
+        double* out = timestepData.data();
+        size_t index = 0;
+
+#ifdef MODE_APPROXIMATE
+        computeOtherLabelWeights();
 
         // 1. weight of each partition function
         for (size_t f=0; f<F; ++f) {
-            dataLog->add(temp_mwf[f]+mw[f][currentLabels[f]]);
+            out[index++] = mwTotal[f];
         }
 
         // 2. weight of each arm
-        for (size_t i=0; i<K; ++i) {
-            double largest = 0;
-            for (size_t f=0; f<F; ++f) {
-                double functionWeight = w[f][currentLabels[f]][i] + temp_mwf[f];
-                if (functionWeight > largest) largest = functionWeight;
-            }
-            dataLog->add(largest);
-        }
+        computeArmWeights(out + index);
+        index += K;
 #endif
 
 #ifdef MODE_NOT_STABLE
         // 1. weight of each partition function
         for (size_t f=0; f<F; ++f) {
-            dataLog->add(bf[f]);
+            out[index++] = bf[f];
         }
 
         // 2. weight of each arm
-        for (size_t i=0; i<K; ++i) {
-            double weight = 0;
-            for (size_t f=0; f<F; ++f) {
-                weight += b[f][currentLabels[f]][i] * bf[f] / sb[f][currentLabels[f]];
-            }
-            dataLog->add(weight);
+        for (size_t i=0; i<K; ++i) out[index+i] = 0;
+        for (size_t f=0; f<F; ++f) {
+            const Weight* expWeights = bRow(f, currentLabels[f]);
+            const double other = bf[f] / sb[row(f, currentLabels[f])];
+            for (size_t i=0; i<K; ++i) out[index+i] += expWeights[i] * other;
         }
+        index += K;
 #endif
 
 #ifdef MODE_STABLE
-        temp_bff.resize(F);
-        for (size_t f=0; f<F; ++f) {
-            double bff = 1;
-            for (size_t l=0; l<nLabels[f]; ++l) {
-                if (l == currentLabels[f]) continue;
-                bff *= sb[f][l];
-            }
-            temp_bff[f] = bff;
-        }
+        computeOtherLabelWeights();
 
         // 1. weight of each partition function
         for (size_t f=0; f<F; ++f) {
-            dataLog->add(temp_bff[f]*sb[f][currentLabels[f]]);
+            out[index++] = std::exp(logSbTotal[f]);
         }
 
         // 2. weight of each arm
-        for (size_t i=0; i<K; ++i) {
-            double weight = 0;
-            for (size_t f=0; f<F; ++f) {
-                weight += b[f][currentLabels[f]][i] * temp_bff[f];
-            }
-            dataLog->add(weight);
+        for (size_t i=0; i<K; ++i) out[index+i] = 0;
+        for (size_t f=0; f<F; ++f) {
+            const Weight* expWeights = bRow(f, currentLabels[f]);
+            for (size_t i=0; i<K; ++i) out[index+i] += expWeights[i] * temp_bff[f];
         }
+        index += K;
 #endif
 
         // 3. probability of each arm
         for (size_t i=0; i<K; ++i) {
-            dataLog->add(p[i]);
+            out[index++] = p[i];
+        }
+        return out;
+    }
+};
+
+// Holds the learners of N devices that share the same partitions, so that a
+// simulation can step every device with a single call per timestep.
+// Device i is learner (seed, device i), the same as creating the learners one by one.
+class PeriodicExp4Batch {
+public:
+    std::vector<PeriodicExp4*> devices;
+
+    PeriodicExp4Batch(int N, int T, int K, int F, int* labelCounts, int seed, double gamma) {
+        devices.resize(N);
+        for (size_t d=0; d<N; ++d) {
+            devices[d] = new PeriodicExp4(T,K,F,labelCounts,seed,d,gamma);
+        }
+    }
+
+    // device d is reset to learner (seed, device d)
+    void reset(int T, int seed, double gamma) {
+        for (size_t d=0; d<devices.size(); ++d) {
+            devices[d]->reset(T,seed,d,gamma);
+        }
+    }
+
+    ~PeriodicExp4Batch() {
+        for (size_t d=0; d<devices.size(); ++d) {
+            delete devices[d];
+        }
+    }
+
+    // labels: the current label of each partition, shared by all devices.
+    // arms: output, the arm chosen by each device.
+    void getNextArms(int* labels, int* arms) {
+        for (size_t d=0; d<devices.size(); ++d) {
+            arms[d] = devices[d]->getNextArm(labels);
+        }
+    }
+
+    void setLabelTable(const void* table, int labelBytes, int rows) {
+        for (size_t d=0; d<devices.size(); ++d) {
+            devices[d]->setLabelTable(table, labelBytes, rows);
+        }
+    }
+
+    // same as getNextArms, with the labels read from row t of the label table. -1 if there is no row t.
+    int getNextArmsAt(int t, int* arms) {
+        for (size_t d=0; d<devices.size(); ++d) {
+            arms[d] = devices[d]->getNextArmAt(t);
+            if (arms[d] < 0) return -1;
+        }
+        return 0;
+    }
+
+    // out: [N][F+2K] array, filled with the current timestep data of each device.
+    void writeTimestepData(double* out) {
+        for (size_t d=0; d<devices.size(); ++d) {
+            const double* data = devices[d]->computeTimestepData();
+            const int size = devices[d]->getTimestepDataSize();
+            std::copy(data, data+size, out + d*size);
+        }
+    }
+
+    // buffer: [N][rows][F+2K] array, split into one log per device.
+    void setLog(double* buffer, int rows, int every) {
+        for (size_t d=0; d<devices.size(); ++d) {
+            double* deviceBuffer = NULL;
+            if (buffer != NULL) deviceBuffer = buffer + d*(size_t)rows*devices[d]->getTimestepDataSize();
+            devices[d]->setLog(deviceBuffer, rows, every);
+        }
+    }
+
+    // rewards: the reward of each device for the arm it chose this timestep.
+    void giveRewards(double* rewards, double _gamma) {
+        for (size_t d=0; d<devices.size(); ++d) {
+            devices[d]->giveReward(rewards[d], _gamma);
         }
-        return dataLog;
     }
 };
 
 extern "C" {
-    PeriodicExp4* PeriodicExp4_new(int T, int K, int F, int* labelCounts, int seed){ return new PeriodicExp4(T,K,F,labelCounts,seed,-1); }
-    PeriodicExp4* PeriodicExp4_new_g(int T, int K, int F, int* labelCounts, int seed, double gamma){ return new PeriodicExp4(T,K,F,labelCounts,seed,gamma); }
+    PeriodicExp4* PeriodicExp4_new(int T, int K, int F, int* labelCounts, int seed, int device){ return new PeriodicExp4(T,K,F,labelCounts,seed,device,-1); }
+    PeriodicExp4* PeriodicExp4_new_g(int T, int K, int F, int* labelCounts, int seed, int device, double gamma){ return new PeriodicExp4(T,K,F,labelCounts,seed,device,gamma); }
+    void PeriodicExp4_delete(PeriodicExp4* obj) { delete obj; }
+    void PeriodicExp4_reset(PeriodicExp4* obj, int T, int seed, int device, double gamma) { obj->reset(T,seed,device,gamma); }
     int PeriodicExp4_getNextArm(PeriodicExp4* obj, int* labels) { return obj->getNextArm(labels); }
     void PeriodicExp4_giveReward(PeriodicExp4* obj, double reward, double _gamma) { obj->giveReward(reward, _gamma); }
-    DataLog* PeriodicExp4_getLog(PeriodicExp4* obj){ return obj->dataLog; }
-    DataLog* PeriodicExp4_getCurrentTimestepData(PeriodicExp4* obj){ return obj->getCurrentTimestepData(); }
-    void DataLog_reset(DataLog* obj) { obj->reset(); }
-    int DataLog_size(DataLog* obj) { return obj->data.size(); }
-    int DataLog_cols(DataLog* obj) { return obj->cols; }
-    double DataLog_next(DataLog* obj) { return obj->next(); }
+    void PeriodicExp4_setLabelTable(PeriodicExp4* obj, const void* table, int labelBytes, int rows) { obj->setLabelTable(table, labelBytes, rows); }
+    int PeriodicExp4_getNextArmAt(PeriodicExp4* obj, int t) { return obj->getNextArmAt(t); }
+    void PeriodicExp4_setLog(PeriodicExp4* obj, double* buffer, int rows, int every){ obj->setLog(buffer, rows, every); }
+    int PeriodicExp4_getTimestepDataSize(PeriodicExp4* obj){ return obj->getTimestepDataSize(); }
+    double* PeriodicExp4_computeTimestepData(PeriodicExp4* obj){ return obj->computeTimestepData(); }
+    void PeriodicExp4_writeTimestepData(PeriodicExp4* obj, double* out){ const double* data = obj->computeTimestepData(); std::copy(data, data+obj->getTimestepDataSize(), out); }
+    int PeriodicExp4_getStateSize(PeriodicExp4* obj){ return obj->getStateSize(); }
+    long long PeriodicExp4_getWeightBytes(PeriodicExp4* obj){ return obj->getWeightBytes(); }
+    int PeriodicExp4_weightSize(){ return sizeof(Weight); }
+    void PeriodicExp4_writeState(PeriodicExp4* obj, double* out){ obj->writeState(out); }
+    int PeriodicExp4_readState(PeriodicExp4* obj, const double* in, int weightsOnly){ return obj->readState(in, weightsOnly); }
+
+    PeriodicExp4Batch* PeriodicExp4Batch_new(int N, int T, int K, int F, int* labelCounts, int seed){ return new PeriodicExp4Batch(N,T,K,F,labelCounts,seed,-1); }
+    PeriodicExp4Batch* PeriodicExp4Batch_new_g(int N, int T, int K, int F, int* labelCounts, int seed, double gamma){ return new PeriodicExp4Batch(N,T,K,F,labelCounts,seed,gamma); }
+    void PeriodicExp4Batch_delete(PeriodicExp4Batch* obj) { delete obj; }
+    void PeriodicExp4Batch_reset(PeriodicExp4Batch* obj, int T, int seed, double gamma) { obj->reset(T,seed,gamma); }
+    void PeriodicExp4Batch_getNextArms(PeriodicExp4Batch* obj, int* labels, int* arms) { obj->getNextArms(labels, arms); }
+    void PeriodicExp4Batch_setLabelTable(PeriodicExp4Batch* obj, const void* table, int labelBytes, int rows) { obj->setLabelTable(table, labelBytes, rows); }
+    int PeriodicExp4Batch_getNextArmsAt(PeriodicExp4Batch* obj, int t, int* arms) { return obj->getNextArmsAt(t, arms); }
+    void PeriodicExp4Batch_writeTimestepData(PeriodicExp4Batch* obj, double* out) { obj->writeTimestepData(out); }
+    void PeriodicExp4Batch_setLog(PeriodicExp4Batch* obj, double* buffer, int rows, int every) { obj->setLog(buffer, rows, every); }
+    void PeriodicExp4Batch_giveRewards(PeriodicExp4Batch* obj, double* rewards, double _gamma) { obj->giveRewards(rewards, _gamma); }
+    PeriodicExp4* PeriodicExp4Batch_getDevice(PeriodicExp4Batch* obj, int d) { return obj->devices[d]; }
+
+    double Philox_uniform(unsigned int seed, unsigned int device, unsigned long long slot, unsigned int draw) { return philoxUniform(seed, device, slot, draw); }
+    int Sampling_searchCdf(const double* cumulative, int K, double v) { return searchCdf(cumulative, K, v); }
 }
\ No newline at end of file
@@ -0,0 +1,143 @@
+'''
+@description:   Checkpoints of a running simulation (wns.py -checkpoint k), written to checkpoint.npz in the output
+                directory every k time slots. A checkpoint holds everything the rest of the run depends on: the state
+                of every learner, the network of every device (and so the occupancy of the networks), the cumulative
+                gains of the devices, the cumulative gains of the experts (HindsightGains) and the position of the
+                device and network logs. The columns of the logs read by data_analyzer are not saved: a resumed run
+                reads them back from the logs, so a checkpoint does not grow with the time slot. The trace and the
+                partition labels are indexed by the time slot, so the slot is all that is needed of them. A run started
+                again in the same directory with the same arguments continues from the checkpoint, and gives the same
+                results as a run that was not interrupted.
+                The learner states of a checkpoint can also be the starting weights of a new run (wns.py -warmstart).
+'''
+import os
+import json
+import numpy as np
+
+CHECKPOINT_FILE = 'checkpoint.npz'
+
+def learner_states(algorithm):
+    ''' [device][state size] states of a batch learner, or of a list with one learner per device '''
+    if isinstance(algorithm, list):
+        return np.stack([alg.get_state() for alg in algorithm])
+    return algorithm.get_state()
+
+def restore_learners(algorithm, states, warmStart=False):
+    ''' restores learner_states into a batch learner or a list of learners; only the weights if warmStart '''
+    if isinstance(algorithm, list):
+        for alg, state in zip(algorithm, states):
+            if warmStart: alg.warm_start(state)
+            else: alg.set_state(state)
+    elif warmStart: algorithm.warm_start(states)
+    else: algorithm.set_state(states)
+
+def load_learner_states(path):
+    ''' learner states of the checkpoint at path, or of the checkpoint in the directory at path '''
+    if os.path.isdir(path): path = os.path.join(path, CHECKPOINT_FILE)
+    with np.load(path) as checkpoint:
+        return checkpoint['learners']
+
+class Checkpoint(object):
+    '''
+    A checkpoint read back from a file. slot is the last time slot it covers, config the arguments of the run that
+    wrote it and seed its random seed.
+    '''
+    def __init__(self, path):
+        with np.load(path) as checkpoint:
+            self.arrays = {name: checkpoint[name] for name in checkpoint.files}
+        meta = json.loads(str(self.arrays.pop('meta')))
+        self.slot = meta['slot']
+        self.config = meta['config']
+        self.seed = meta['seed']
+        self.logs = meta['logs']
+
+    def restoreDevices(self, mobileDeviceList, networkList):
+        ''' sets the network, occupancy and cumulative gain of every device and network '''
+        for mobileDevice, network, cumulativeGain in zip(mobileDeviceList, self.arrays['networks'].tolist(), self.arrays['cumulativeGains'].tolist()):
+            mobileDevice.currentNetwork = network
+            mobileDevice.cumulativeGain = cumulativeGain
+        for network in networkList:
+            network.numDevice = sum(1 for mobileDevice in mobileDeviceList if mobileDevice.currentNetwork == network.networkID)
+
+    def restoreHindsightGains(self, hindsightGains):
+        hindsightGains.joinGains[:] = self.arrays['joinGains']
+        hindsightGains.stayCorrections = self.arrays['stayCorrections'].copy()
+        hindsightGains.lastSlot = self.slot
+
+    def restoreLogs(self, mobileDeviceList):
+        ''' makes the devices continue their logs from the rows of the checkpoint, when they next create them '''
+        for mobileDevice in mobileDeviceList:
+            mobileDevice.logResume = self.logResume('device%d' % mobileDevice.deviceID)
+        mobileDeviceList[0].networkLogResume = self.logResume('network')
+
+    def logResume(self, name):
+        if name not in self.logs: return None
+        rows, position, columns = self.logs[name]
+        resume = {'rows': rows, 'position': position}
+        if columns != None: # a log without a file, see TableWriter.checkpoint
+            resume['columns'] = {column: self.arrays['log %s %s' % (name, column)] for column in columns}
+        return resume
+
+    def restoreLearners(self, algorithm):
+        restore_learners(algorithm, self.arrays['learners'])
+# end Checkpoint class
+
+class Checkpointer(object):
+    def __init__(self, outputDir, numTimeSlots, every, config, seed):
+        '''
+        args: output directory, number of time slots of the run, time slots between checkpoints (0 = only the final one),
+              arguments of the run that must match to resume from a checkpoint, random seed of the run
+        '''
+        self.path = os.path.join(outputDir, CHECKPOINT_FILE)
+        self.numTimeSlots = numTimeSlots
+        self.every = every
+        self.config = config
+        self.seed = seed
+
+    def due(self, t):
+        return self.every > 0 and t % self.every == 0 and t < self.numTimeSlots
+
+    def load(self):
+        ''' returns: the Checkpoint in the output directory, or None if there is none of a run with the same config '''
+        if not os.path.exists(self.path): return None
+        checkpoint = Checkpoint(self.path)
+        if checkpoint.config != self.config: return None
+        return checkpoint
+
+    def save(self, t, algorithm, mobileDeviceList, hindsightGains):
+        '''
+        description: writes the checkpoint of the end of time slot t, replacing the previous one only once it is complete
+        args:        self, time slot, batch learner or list of learners, devices (with their network and cumulative gain
+                     of slot t), their shared HindsightGains
+        '''
+        arrays = {
+            'learners': learner_states(algorithm),
+            'networks': np.array([mobileDevice.currentNetwork for mobileDevice in mobileDeviceList]),
+            'cumulativeGains': np.array([mobileDevice.cumulativeGain for mobileDevice in mobileDeviceList], dtype=np.float64),
+            'joinGains': hindsightGains.joinGains,
+            'stayCorrections': hindsightGains.stayCorrections,
+        }
+        logs = {}
+        writers = [('device%d' % m.deviceID, m.csvData) for m in mobileDeviceList] + [('network', mobileDeviceList[0].networkCsvData)]
+        for name, writer in writers:
+            if writer == None: continue
+            state = writer.checkpoint()
+            logs[name] = (state['rows'], state['position'], list(state['columns']) if 'columns' in state else None)
+            for column, values in state.get('columns', {}).items():
+                arrays['log %s %s' % (name, column)] = values
+        arrays['meta'] = np.array(json.dumps({'slot': t, 'config': self.config, 'seed': self.seed, 'logs': logs}))
+
+        temporaryPath = self.path + '.tmp.npz'
+        np.savez(temporaryPath, **arrays)
+        os.replace(temporaryPath, self.path)
+
+    def run(self, env, startSlot, algorithms, mobileDeviceList, hindsightGains):
+        '''
+        description: simpy process writing a checkpoint after every k-th time slot, once all devices have observed their gains
+        args:        self, simpy environment, time slot the run starts after, learner of every device, devices, their shared HindsightGains
+        '''
+        for t in range((startSlot//self.every + 1)*self.every, self.numTimeSlots, self.every):
+            yield env.timeout(3*(t - startSlot) + 0.5 - env.now)  # time slot t ends at 3(t - startSlot) in a resumed run
+            self.save(t, algorithms, mobileDeviceList, hindsightGains)
+# end Checkpointer class
+''' _____________________________________________________________________________ end of file _____________________________________________________________________________ '''
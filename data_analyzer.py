@@ -1,12 +1,17 @@
+import global_setting
+SHOW_PLOTS = global_setting.constants['show_plots']
+import matplotlib
+if not SHOW_PLOTS: matplotlib.use('Agg')     # figures are only saved, don't open windows
 import matplotlib.pyplot as plt
 from mpl_toolkits import mplot3d
 import numpy as np
 import statistics
-import global_setting
 from logging_configure import logger
 import random
+import os
+from concurrent.futures import ThreadPoolExecutor
+import plot_rendering
 
-SHOW_PLOTS = global_setting.constants['show_plots']
 SAVE_LOG_DETAILS = global_setting.constants['save_log_details']
 NUM_MOBILE_DEVICE = global_setting.constants['num_mobile_device']
 NUM_TIME_SLOT = global_setting.constants['num_time_slot']
@@ -16,6 +21,10 @@ ALGORITHM = global_setting.constants['algorithm_name']
 OUTPUT_DIR = global_setting.constants['output_dir']
 networkList = global_setting.constants['network_list']
 NUM_NETWORK = len(networkList)
+BASELINE_SAMPLES = global_setting.constants.get('baseline_samples', 0)
+MC_CHUNK_CELLS = 1 << 22    # samples*slots*networks drawn at a time by monte_carlo_min_bandwidths
+PLOT_POINTS = 2000          # time slots are averaged into at most this many buckets before plotting
+PLOT_WORKERS = 1            # worker processes rendering the figures: 1 renders in this process, None = one per core
 
 def weighted_choice(seq, weights):
     w = np.asarray(weights)
@@ -29,135 +38,171 @@ def get_subdivisions():
         start, end = T*i//R, T*(i+1)//R
         yield start, end
 
+# csvData: CsvData, a TableWriter, or an NpyTable of a saved run (see utility_method.loadNpyRun)
 def get_data(name, csvData):
-    for index, header in enumerate(csvData.headers):
-        if header == name:
-            return [row[index] for row in csvData.rows]
-
-def plot_3d(x,y,zs_labels,skip_step=1, color=None):
-    ax = plt.axes(projection='3d')
-
-    x_filtered = x[::skip_step]
-    X, Y = np.meshgrid(x_filtered, y)
-
-    for z, label in zs_labels:
-        z_filtered = z[::skip_step]
-        Z = np.array(z_filtered)
-        if color != None:
-            ax.plot_surface(X, Y, Z.T, label=label, color=color)
-        else:
-            ax.plot_surface(X, Y, Z.T, label=label)
-
-    #ax.set_xlabel('X Label')
-    #ax.set_ylabel('Y Label')
-    #ax.set_zlabel('Z Label')
+    return csvData.getColumn(name)
 
 def plot_graphs(results, deviceCsvDatas, networkCsvData):
-    def save_fig():
-        if not SAVE_LOG_DETAILS: return
-        figure_name = plt.gcf().get_label().replace(' ', '_')
-        plt.savefig('%s\\%s.png' % (OUTPUT_DIR, figure_name))
+    if not SAVE_LOG_DETAILS and not SHOW_PLOTS: return
 
-    armChoices = []
-    for deviceID, csvData in deviceCsvDatas:
-        armChoices.append((deviceID, get_data('Current network', csvData)))
-
-    totalProbs = [[0]*NUM_NETWORK for i in range(NUM_TIME_SLOT)]
     probs = []
     highestProbs = []
+    totalProbs = np.zeros((NUM_TIME_SLOT, NUM_NETWORK))
     for deviceID, csvData in deviceCsvDatas:
-        probList = [get_data('probability%d'%i, csvData) for i in range(1,NUM_NETWORK+1)]
-        largests = [max(enumerate(probs), key=lambda tup:tup[1])[0]+1 for probs in zip(*probList)]
-        highestProbs.append((deviceID, largests))
-
-        probs.append((deviceID, [list(i) for i in zip(*probList)]))
+        deviceProbs = np.stack([np.asarray(get_data('probability%d'%i, csvData), dtype=np.float64) for i in range(1,NUM_NETWORK+1)], axis=1)
+        probs.append((deviceID, deviceProbs))
+        highestProbs.append((deviceID, np.argmax(deviceProbs, axis=1)+1))
+        totalProbs += deviceProbs
 
-        for t in range(NUM_TIME_SLOT):
-            for i in range(NUM_NETWORK):
-                totalProbs[t][i] += probList[i][t]
-
-    dataRateList = [get_data('dataRate%d'%i, networkCsvData) for i in range(1,NUM_NETWORK+1)]
-    dataRateList = [list(i) for i in zip(*dataRateList)]
-    
-    SKIP_STEP = 1
+    dataRates = np.stack([np.asarray(get_data('dataRate%d'%i, networkCsvData), dtype=np.float64) for i in range(1,NUM_NETWORK+1)], axis=1)
 
+    figures = []
     # plot bandwidth graph
-    if True:
-        x = list(range(1,NUM_TIME_SLOT+1))
-        y = list(range(1,NUM_NETWORK+1))
-        plt.figure('Network Bandwidths')
-        plot_3d(x,y,[(dataRateList,'bandwidth')],skip_step=SKIP_STEP)
-        save_fig()
+    figures.append(plot_rendering.surface_figure('Network Bandwidths', dataRates, PLOT_POINTS))
 
     # plot highest probability arm of each device
-    if True:
-        plt.figure('Highest Probability Arms')
-        x = range(1,NUM_TIME_SLOT+1)
-        for deviceID, arms in highestProbs:
-            y = [v+deviceID/NUM_MOBILE_DEVICE/4 for v in arms]
-            plt.plot(x, y, label='%d'%deviceID)
-        save_fig()
+    figures.append(plot_rendering.band_figure('Highest Probability Arms',
+        [('%d'%deviceID, arms+deviceID/NUM_MOBILE_DEVICE/4) for deviceID, arms in highestProbs], PLOT_POINTS))
 
     # plot probability distribution over time (3D) for each device, and total probability distribution
-    if True:
-        x = list(range(1,NUM_TIME_SLOT+1))
-        y = list(range(1,NUM_NETWORK+1))
-        for deviceID, deviceProbs in probs:
-            plt.figure('Device %d Probability' % deviceID)
-            plot_3d(x,y,[(deviceProbs,'%d'%deviceID)],skip_step=SKIP_STEP)
-            save_fig()
-
-        plt.figure('Total Probability')
-        plot_3d(x,y,[(totalProbs,'total')], skip_step=SKIP_STEP, color='#ff8020')
-        #plot_3d(x,y,[(deviceProbs,'%d'%deviceID) for deviceID, deviceProbs in probs], skip_step=500)
-        save_fig()
+    for deviceID, deviceProbs in probs:
+        figures.append(plot_rendering.surface_figure('Device %d Probability' % deviceID, deviceProbs, PLOT_POINTS))
+    figures.append(plot_rendering.surface_figure('Total Probability', totalProbs, PLOT_POINTS, color='#ff8020'))
 
     # plot probability distribution at final timestep (2D)
-    if True:
-        plt.figure('Final Timestep Probabilities')
-        x = range(1,NUM_NETWORK+1)
-        for deviceID, deviceProbs in probs:
-            finalProbs = deviceProbs[-1]
-            plt.plot(x,finalProbs, label='%d'%deviceID)
-        save_fig()
+    figures.append(plot_rendering.line_figure('Final Timestep Probabilities', range(1,NUM_NETWORK+1),
+        [('%d'%deviceID, deviceProbs[-1]) for deviceID, deviceProbs in probs]))
+
+    if SAVE_LOG_DETAILS:
+        plot_rendering.render_all_to_files(figures, OUTPUT_DIR, numWorkers=PLOT_WORKERS)
 
     if SHOW_PLOTS:
+        for figure in figures: plot_rendering.render(figure)
         plt.show()
 
+# exact max-min allocation of nUsers to the networks, for each row of dataRates (T x numNetworks).
+# The best lowest per-user bandwidth b is the largest value with sum_k floor(rate_k/b) >= nUsers, i.e. the nUsers-th
+# largest of all rate_k/c. It is bracketed for all rows at once by bisection between total/(nUsers+K) and
+# total/nUsers, and the few rate_k/c left in the bracket are ranked exactly. Ties go to the lower network index.
+# returns: T array of the lowest per-user bandwidth, T x numNetworks array of the number of users in each network
+def opt_max_min_allocation(nUsers, dataRates, iterations=24):
+    dataRates = np.asarray(dataRates, dtype=np.float64)
+    T, K = dataRates.shape
+    total = dataRates.sum(axis=1)
+    positive = total > 0
+    total = np.where(positive, total, 1.0)[:,None]
+    users_at = lambda b: np.floor(dataRates/b).astype(np.int64)
+
+    lo = total/(nUsers+K)*(1-1e-9)     # at least nUsers users fit
+    hi = total/nUsers*(1+1e-9)         # fewer than nUsers users fit
+    for i in range(iterations):
+        mid = (lo+hi)/2
+        enough = users_at(mid).sum(axis=1, keepdims=True) >= nUsers
+        lo = np.where(enough, mid, lo)
+        hi = np.where(enough, hi, mid)
+
+    # the remaining users go to the best candidates rate_k/c with users_at(hi)_k < c <= users_at(lo)_k
+    occupancy = users_at(hi)
+    numCandidates = (users_at(lo) - occupancy).ravel()
+    remaining = nUsers - occupancy.sum(axis=1)
+    cells = np.repeat(np.arange(T*K), numCandidates)
+    within = np.arange(len(cells)) - (np.cumsum(numCandidates) - numCandidates)[cells]
+    rows, networks = cells // K, cells % K
+    values = dataRates[rows, networks] / (occupancy.ravel()[cells] + within + 1)
+    order = np.lexsort((networks, -values, rows))
+    rows, networks = rows[order], networks[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    selected = rank < remaining[rows]
+    np.add.at(occupancy, (rows[selected], networks[selected]), 1)
+
+    # no bandwidth anywhere: everyone ends up in the first network, with 0
+    occupancy[~positive] = 0
+    occupancy[~positive, 0] = nUsers
+    return min_bandwidths_of_counts(dataRates, occupancy), occupancy
+
+# min bandwidth over the occupied networks, for each row of dataRates and of the per-network user counts
+def min_bandwidths_of_counts(dataRates, counts):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, dataRates/counts, np.inf).min(axis=-1)
+
+# Monte Carlo estimate of the expected min bandwidth when in every slot each of the nUsers users joins network k
+# independently with probability probabilities[t][k] (T x numNetworks, or one row for all slots).
+# The occupancy vectors of numSamples runs are drawn with Generator.multinomial, a chunk of slots at a time.
+# Every chunk has its own generator spawned from seed, so the result does not depend on numWorkers; the chunks
+# run on numWorkers threads, as numpy draws them without holding the GIL.
+# returns: numSamples array with the mean over all slots of the min bandwidth of each sample run
+def monte_carlo_min_bandwidths(nUsers, dataRates, probabilities, numSamples, seed, numWorkers=None):
+    T, numNetworks = dataRates.shape
+    probabilities = np.broadcast_to(probabilities, dataRates.shape)
+    chunkSize = max(1, MC_CHUNK_CELLS // (numSamples*numNetworks))
+    starts = range(0, T, chunkSize)
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+
+    def sample_chunk(i):
+        generator = np.random.default_rng(seeds[i])
+        rates = dataRates[starts[i]:starts[i]+chunkSize]
+        counts = generator.multinomial(nUsers, probabilities[starts[i]:starts[i]+chunkSize], size=(numSamples, len(rates)))
+        return min_bandwidths_of_counts(rates, counts).sum(axis=1)
+
+    numWorkers = numWorkers if numWorkers != None else os.cpu_count()
+    with ThreadPoolExecutor(max_workers=min(numWorkers, len(starts))) as executor:
+        return sum(executor.map(sample_chunk, range(len(starts)))) / T
+
+# mean of samples with the half-width of its normal confidence interval (z=1.96 for 95%)
+def mean_confidence_interval(samples, z=1.96):
+    mean = samples.mean()
+    return mean, z*samples.std(ddof=1)/np.sqrt(len(samples)) if len(samples) > 1 else np.nan
+
+# counts[t][k] = number of users choosing network k in row t of choices (T x nUsers)
+def choice_counts(choices, numNetworks):
+    offsets = np.arange(len(choices))[:,None]*numNetworks
+    return np.bincount((choices + offsets).ravel(), minlength=len(choices)*numNetworks).reshape(len(choices), numNetworks)
+
+# [random.randrange(n) for i in range(size)], with the 32-bit words of the generator drawn in bulk.
+# randrange(n) takes the top n.bit_length() bits of one word and retries while they are >= n. The words are
+# drawn from a saved state, and the state is then moved past exactly the words that the loop would have used.
+def uniform_randranges(n, size):
+    if size == 0: return np.zeros(0, dtype=np.int64)
+    shift = np.uint32(32 - n.bit_length())
+    state = random.getstate()
+    words = []
+    numAccepted = 0
+    while numAccepted < size:
+        m = 2*(size - numAccepted)
+        words.append(np.frombuffer(random.getrandbits(32*m).to_bytes(4*m, 'little'), dtype='<u4'))
+        numAccepted += int(((words[-1] >> shift) < n).sum())
+    values = (np.concatenate(words) >> shift).astype(np.int64)
+    accepted = np.flatnonzero(values < n)[:size]
+    random.setstate(state)
+    random.getrandbits(32*(accepted[-1]+1))
+    return values[accepted]
+
+# estimated expected min bandwidth from a uniform distribution allocation, for each row of dataRates
+def uniform_min_bandwidths(nUsers, dataRates):
+    T, numNetworks = dataRates.shape
+    choices = uniform_randranges(numNetworks, T*nUsers).reshape(T, nUsers)
+    return min_bandwidths_of_counts(dataRates, choice_counts(choices, numNetworks))
+
+# estimated expected min bandwidth from an allocation weighted by the data rates, for each row of dataRates.
+# Same draws as calling np.random.choice(range(numNetworks), p=rates/sum(rates)) for each user in each row.
+def weighted_min_bandwidths(nUsers, dataRates):
+    T, numNetworks = dataRates.shape
+    p = dataRates / dataRates.sum(axis=1, keepdims=True)
+    cdf = np.cumsum(p, axis=1)
+    cdf /= cdf[:,-1:]
+    uniformSamples = np.random.random_sample((T, nUsers))
+    choices = (uniformSamples[:,:,None] >= cdf[:,None,:]).sum(axis=2)
+    return min_bandwidths_of_counts(dataRates, choice_counts(choices, numNetworks))
+
+# mean of values over [start, end) for each (start, end) of subdivisions, from one prefix sum
+def subdivision_means(values, subdivisions):
+    prefixSums = np.concatenate(([0.0], np.cumsum(values)))
+    return [(prefixSums[end] - prefixSums[start])/(end - start) for start, end in subdivisions]
+
 def print_results(results, deviceCsvDatas, networkCsvData):
     deviceCsvDatas = deviceCsvDatas[:]
     deviceCsvDatas.sort(key=lambda pair:pair[0]) # sort by device ID
 
-    # exact min bandwidth from best possible allocation
-    def computeOptMinBandwidth(nUsers, dataRates):
-        nextBandwidths = np.array(dataRates, dtype='f')
-        originalRates = np.array(dataRates)
-        nextCounts = np.array([1]*len(dataRates))
-        for i in range(nUsers):
-            index = np.argmax(nextBandwidths)
-            lowestBandwidth = nextBandwidths[index]
-            nextCounts[index] += 1
-            nextBandwidths[index] = originalRates[index]/nextCounts[index]
-        return lowestBandwidth.item()
-
-    # estimated expected min bandwidth from a uniform distribution allocation
-    def estimateUniformMinBandwidth(nUsers, dataRates):
-        numNetworks = len(dataRates)
-        counts = [0]*numNetworks
-        for i in range(nUsers): counts[random.randrange(numNetworks)] += 1
-        return min(dataRate/count for dataRate,count in zip(dataRates,counts) if count>0)
-
-    # estimated expected min bandwidth from a uniform distribution allocation
-    def estimateWeightedMinBandwidth(nUsers, dataRates):
-        numNetworks = len(dataRates)
-        seq = list(range(numNetworks))
-        w = np.asarray(dataRates)
-        p = w / w.sum()
-        counts = [0]*numNetworks
-        for i in range(nUsers): counts[np.random.choice(seq, p=p)] += 1
-        return min(dataRate/count for dataRate,count in zip(dataRates,counts) if count>0)
-
-
     for deviceID, cumulativeGain, maxCumulativeGain in results:
         logger.info("Device %d - Score: %.2f, Max: %.2f, Regret: %.2f" % 
             (deviceID, cumulativeGain, maxCumulativeGain, maxCumulativeGain-cumulativeGain))
@@ -165,35 +210,39 @@ def print_results(results, deviceCsvDatas, networkCsvData):
     cumulativeGains = [x[1] for x in results]
     cumulativeGains = [x/NUM_TIME_SLOT*NUM_MOBILE_DEVICE for x in cumulativeGains] # normalize
 
-    dataRateList = [get_data('dataRate%d'%i, networkCsvData) for i in range(1,NUM_NETWORK+1)]
-    dataRateList = [list(i) for i in zip(*dataRateList)] #transpose
+    # T x numNetworks
+    dataRates = np.stack([np.asarray(get_data('dataRate%d'%i, networkCsvData), dtype=np.float64) for i in range(1,NUM_NETWORK+1)], axis=1)
     
     # timestep-wise min (we use this because we can make total min higher by rotating devices)
-    allGains = [get_data('gain', csvData) for deviceID,csvData in deviceCsvDatas]
-    allGains = [list(i) for i in zip(*allGains)] #transpose
-    minGains = [min(gains) for gains in allGains]
-    stepwiseMin = statistics.mean(minGains)*NUM_MOBILE_DEVICE
+    allGains = np.stack([np.asarray(get_data('gain', csvData), dtype=np.float64) for deviceID,csvData in deviceCsvDatas])
+    minGains = allGains.min(axis=0)
+    stepwiseMin = minGains.mean()*NUM_MOBILE_DEVICE
 
     # opt min (per step)
-    optMinBandwidths = [computeOptMinBandwidth(NUM_MOBILE_DEVICE, dataRates) for dataRates in dataRateList]
-    optMinBandwidth = statistics.mean(optMinBandwidths)*NUM_MOBILE_DEVICE
+    optMinBandwidths, optOccupancy = opt_max_min_allocation(NUM_MOBILE_DEVICE, dataRates)
+    optMinBandwidths = optMinBandwidths.astype('f').astype(np.float64) # in float32, like the greedy baseline was
+    optMinBandwidth = optMinBandwidths.mean()*NUM_MOBILE_DEVICE
+
+    # users per step that would have to switch networks to reach the optimal occupancy
+    occupancy = np.stack([np.asarray(get_data('#users%d'%i, networkCsvData)) for i in range(1,NUM_NETWORK+1)], axis=1)
+    occupancyDistance = np.abs(occupancy - optOccupancy).sum(axis=1).mean()/2
 
     # uniform min (per step)
-    uniformMinBandwidths = [estimateUniformMinBandwidth(NUM_MOBILE_DEVICE, dataRates) for dataRates in dataRateList]
-    uniformMinBandwidth = statistics.mean(uniformMinBandwidths)*NUM_MOBILE_DEVICE
+    uniformMinBandwidths = uniform_min_bandwidths(NUM_MOBILE_DEVICE, dataRates)
+    uniformMinBandwidth = uniformMinBandwidths.mean()*NUM_MOBILE_DEVICE
 
     # optimally weighted min (per step)
-    weightedMinBandwidths = [estimateWeightedMinBandwidth(NUM_MOBILE_DEVICE, dataRates) for dataRates in dataRateList]
-    weightedMinBandwidth = statistics.mean(weightedMinBandwidths)*NUM_MOBILE_DEVICE
-
-    for index, startEnd in enumerate(get_subdivisions()):
-        start, end = startEnd
-        averageStepwiseMin = statistics.mean(minGains[start:end])*NUM_MOBILE_DEVICE
-        averageOptMin = statistics.mean(optMinBandwidths[start:end])*NUM_MOBILE_DEVICE
-        averageWMin = statistics.mean(weightedMinBandwidths[start:end])*NUM_MOBILE_DEVICE
-        logger.info('Div%dStepMin: %.2f' % (index, averageStepwiseMin))
-        logger.info('Div%dOptMin: %.2f' % (index, averageOptMin))
-        logger.info('Div%dWMin: %.2f' % (index, averageWMin))
+    weightedMinBandwidths = weighted_min_bandwidths(NUM_MOBILE_DEVICE, dataRates)
+    weightedMinBandwidth = weightedMinBandwidths.mean()*NUM_MOBILE_DEVICE
+
+    subdivisions = list(get_subdivisions())
+    divisionStepwiseMins = subdivision_means(minGains, subdivisions)
+    divisionOptMins = subdivision_means(optMinBandwidths, subdivisions)
+    divisionWMins = subdivision_means(weightedMinBandwidths, subdivisions)
+    for index in range(len(subdivisions)):
+        logger.info('Div%dStepMin: %.2f' % (index, divisionStepwiseMins[index]*NUM_MOBILE_DEVICE))
+        logger.info('Div%dOptMin: %.2f' % (index, divisionOptMins[index]*NUM_MOBILE_DEVICE))
+        logger.info('Div%dWMin: %.2f' % (index, divisionWMins[index]*NUM_MOBILE_DEVICE))
 
     logger.info(", ".join((
         "MeanTotal: %.2f" % statistics.mean(cumulativeGains),
@@ -213,6 +262,20 @@ def print_results(results, deviceCsvDatas, networkCsvData):
         "uniformMinBandwidth: %.2f" % uniformMinBandwidth,
         "weightedMinBandwidth: %.2f" % weightedMinBandwidth,
     )))
+    logger.info(", ".join((
+        "optOccupancyDistance: %.2f" % occupancyDistance,
+    )))
+
+    # uniform and optimally weighted min, averaged over BASELINE_SAMPLES allocations per step
+    if BASELINE_SAMPLES > 0:
+        seed = global_setting.constants.get('seed', 0)
+        totals = dataRates.sum(axis=1, keepdims=True)
+        uniform = np.full(NUM_NETWORK, 1/NUM_NETWORK)
+        weighted = np.where(totals > 0, dataRates/np.where(totals > 0, totals, 1), uniform)
+        for name, probabilities, seedOffset in (("uniform", uniform, 1), ("weighted", weighted, 2)):
+            samples = monte_carlo_min_bandwidths(NUM_MOBILE_DEVICE, dataRates, probabilities, BASELINE_SAMPLES, [seed, seedOffset])
+            mean, halfWidth = mean_confidence_interval(samples*NUM_MOBILE_DEVICE)
+            logger.info("%sMinBandwidthMC: %.2f +- %.2f (95%% CI, %d samples)" % (name, mean, halfWidth, BASELINE_SAMPLES))
 
 def analyze(results, deviceCsvDatas, networkCsvData):
     print_results(results, deviceCsvDatas, networkCsvData)
@@ -0,0 +1,102 @@
+'''
+@description:   Synchronous, slot-stepped alternative to the simpy process model in wns.py.
+                All devices choose a network in one step, occupancy is computed with np.bincount and
+                the gains of all devices are computed together. Produces the same results and csvs as
+                the simpy path for the same seeds.
+'''
+
+''' ______________________________________________________________________ import external libraries ______________________________________________________________________ '''
+import numpy as np
+import global_setting
+from mobile_device import MobileDevice, HindsightGains
+
+''' ______________________________________________________________________________ constants ______________________________________________________________________________ '''
+NUM_TIME_SLOT = global_setting.constants['num_time_slot']
+networkList = global_setting.constants['network_list']
+
+def choose_arms(algorithm):
+    if isinstance(algorithm, list): # one algorithm per device, stepped in device order
+        return np.array([alg.get_next_arm() for alg in algorithm])
+    return algorithm.get_next_arms()
+
+def give_rewards(algorithm, rewards, gamma):
+    if isinstance(algorithm, list):
+        for alg, reward in zip(algorithm, rewards.tolist()):
+            alg.give_reward(reward, gamma)
+    else:
+        algorithm.give_rewards(rewards, gamma)
+
+def get_timestep_logs(algorithm):
+    if isinstance(algorithm, list):
+        return [alg.get_timestep_log() for alg in algorithm]
+    return algorithm.get_timestep_logs().tolist()
+
+def get_log_headers(algorithm):
+    if isinstance(algorithm, list):
+        return algorithm[0].get_log_headers()
+    return algorithm.get_log_headers()
+
+''' ################################################################################################################################################################### '''
+def run(mobileDeviceList, algorithm, trace, hindsightGains, results, gamma_function, telemetry=None, checkpointer=None, startSlot=0):
+    '''
+    description: runs the whole simulation, one time slot per iteration
+    args:        devices, a PeriodicExp4Batch or a list with one algorithm per device, T x numNetwork array of observed data rates
+                 (problem_instance.load_trace), HindsightGains of the devices, results list to fill, gamma function,
+                 optional Telemetry to take the snapshots of every k-th time slot, optional Checkpointer to save the checkpoints of
+                 every k-th time slot, time slot to start after when resuming from a checkpoint (the devices then hold its state)
+    returns:     None
+    '''
+    numNetwork = trace.shape[1]
+    maxGain = mobileDeviceList[0].maxGain
+    networkIDs = np.array([network.networkID for network in networkList])
+    trackDetailedStats = any(m.trackDetailedStats for m in mobileDeviceList)
+
+    if trackDetailedStats:
+        MobileDevice.makeNetworkCsv(mobileDeviceList[0])
+        for mobileDevice in mobileDeviceList:
+            MobileDevice.makeDeviceCsv(mobileDevice, get_log_headers(algorithm))
+
+    cumulativeGains = np.array([m.cumulativeGain for m in mobileDeviceList], dtype=np.float64)
+
+    for t in range(startSlot+1,NUM_TIME_SLOT+1):
+        arms = choose_arms(algorithm)
+        counts = np.bincount(arms, minlength=numNetwork)
+        dataRates = trace[t-1]
+
+        gains = dataRates[arms]/counts[arms]
+        scaledGains = np.minimum(gains/maxGain, 1)
+        give_rewards(algorithm, scaledGains, gamma_function(t,NUM_TIME_SLOT))
+
+        # Score computation for result logging: the gain of each device on every network, given the others stay
+        cumulativeGains += gains
+        hindsightGains.giveGains(t, dataRates, counts, arms)
+        if telemetry != None and telemetry.due(t):
+            telemetry.snapshot(t, cumulativeGains, hindsightGains.maxCumulativeGains())
+
+        if trackDetailedStats:
+            algoDatas = get_timestep_logs(algorithm)
+            potentialGains = HindsightGains.potentialGains(dataRates, counts, arms)
+            for network, dataRate, count in zip(networkList, dataRates.tolist(), counts.tolist()):
+                network.dataRate = dataRate
+                network.numDevice = count
+            for mobileDevice, network, gain, algoData, deviceGains in zip(mobileDeviceList,
+                    networkIDs[arms].tolist(), gains.tolist(), algoDatas, potentialGains.tolist()):
+                mobileDevice.currentNetwork = network
+                mobileDevice.gain = gain
+                MobileDevice.saveDeviceDetail(mobileDevice, t, deviceGains, algoData)
+            MobileDevice.saveNetworkDetail(mobileDeviceList[0], t)
+
+        if checkpointer != None and checkpointer.due(t):
+            for mobileDevice, network, cumulativeGain in zip(mobileDeviceList, networkIDs[arms].tolist(), cumulativeGains.tolist()):
+                mobileDevice.currentNetwork = network
+                mobileDevice.cumulativeGain = cumulativeGain
+            checkpointer.save(t, algorithm, mobileDeviceList, hindsightGains)
+
+    maxCumulativeGains = hindsightGains.maxCumulativeGains()
+    if startSlot < NUM_TIME_SLOT:
+        for mobileDevice, network in zip(mobileDeviceList, networkIDs[arms].tolist()):
+            mobileDevice.currentNetwork = network
+    for mobileDevice, cumulativeGain, maxCumulativeGain in zip(mobileDeviceList, cumulativeGains.tolist(), maxCumulativeGains):
+        mobileDevice.cumulativeGain = cumulativeGain
+        results.append((mobileDevice.deviceID, cumulativeGain, maxCumulativeGain))
+''' _____________________________________________________________________________ end of file _____________________________________________________________________________ '''
@@ -1,4 +1,5 @@
 import logging
+import os
 from colorlog import ColoredFormatter   # install using sudo pip3 install colorlog
 
 logger = logging.getLogger('pythonConfig')
@@ -6,7 +7,7 @@ logger = logging.getLogger('pythonConfig')
 def initialize(loggingRootDir=None):
     LOG_LEVEL = logging.INFO
     if loggingRootDir != None:
-        logfile = '%s\\log.txt' % loggingRootDir
+        logfile = os.path.join(loggingRootDir, 'log.txt')
         with open(logfile, 'w'): pass # clear logfile
         logging.basicConfig(filename=logfile, level=logging.INFO)
     logging.root.setLevel(LOG_LEVEL)
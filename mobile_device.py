@@ -4,11 +4,13 @@
 
 ''' ______________________________________________________________________ import external libraries ______________________________________________________________________ '''
 import simpy
+import numpy as np
 from network import Network
-from utility_method import getListIndex, CsvData, deviceCsvName, networkCsvName
+from utility_method import getListIndex, CsvWriter, NpyWriter, deviceCsvName, networkCsvName, deviceNpyName, networkNpyName
 import global_setting
 from termcolor import colored
 from logging_configure import logger
+from algo_periodicexp4.algo_periodicexp4 import PartitionSpec
 
 ''' ______________________________________________________________________________ constants ______________________________________________________________________________ '''
 NUM_MOBILE_DEVICE = global_setting.constants['num_mobile_device']
@@ -16,30 +18,82 @@ NUM_TIME_SLOT = global_setting.constants['num_time_slot']
 RUN_NUM = global_setting.constants['run_num']
 ALGORITHM = global_setting.constants['algorithm_name']
 OUTPUT_DIR = global_setting.constants['output_dir']
+SAVE_LOG_DETAILS = global_setting.constants['save_log_details']
+OUTPUT_FORMAT = global_setting.constants.get('output_format', 'csv')
 networkList = global_setting.constants['network_list']
 
-class PartitionCumulativeGains(object):
-    def __init__(self, partitionTuples, numNetworks):
-        self.cumulativeGain = []
-        for function, nLabels in partitionTuples:
-            self.cumulativeGain.append([[0]*numNetworks for i in range(nLabels)])
-        self.functions = tuple(tup[0] for tup in partitionTuples)
-
-    def giveGain(self, t, potentialGains):
-        for f, function in enumerate(self.functions):
-            l = function(t-1)
-            for i, value in enumerate(potentialGains):
-                self.cumulativeGain[f][l][i] += value
-
-    def maxCumulativeGain(self):
-        return max(sum(max(gains) for gains in cumulativeLabelGains)
-            for cumulativeLabelGains in self.cumulativeGain)
+class HindsightGains(object):
+    ''' Cumulative gains of the experts of a PartitionSpec (partition f, label, network) for all the devices of a simulation.
+        The labels of all partitions are stacked, so an expert is [labelOffsets[f]+label][network].
+        A device that is not on a network would get dataRate/(count+1) by joining it, the same for every such device, so
+        these gains are accumulated once per slot in joinGains. A device on a network gets dataRate/count instead;
+        the difference is accumulated per device, on the network it was on only, in stayCorrections[device]. '''
+    def __init__(self, partitionSpec, numNetworks, numDevices=0):
+        self.labelOffsets = np.concatenate(([0], np.cumsum(partitionSpec.label_counts)))
+        self.labelTable = partitionSpec.materialize()
+        self.numNetworks = numNetworks
+        self.numDevices = numDevices
+        self.joinGains = np.zeros((self.labelOffsets[-1], numNetworks))
+        self.stayCorrections = None                             # [device][row][network], allocated once all devices are added
+        self.devices = []                                       # MobileDevices whose networks are read by observeSlot
+        self.lastSlot = 0
+        self.slotState = None                                   # (dataRates, counts, arms) of the last observed slot
+        self.slotPotentialGains = None                          # potentialGains of that slot, once a device asks for them
+
+    def addDevice(self, mobileDevice):
+        self.devices.append(mobileDevice)
+        self.numDevices = max(self.numDevices, len(self.devices))
+        return len(self.devices) - 1
+
+    # dataRates, counts: [network] arrays of the slot; arms: [device] array of the network index of every device
+    def giveGains(self, t, dataRates, counts, arms):
+        if self.stayCorrections is None:
+            self.stayCorrections = np.zeros((self.numDevices, self.labelOffsets[-1], self.numNetworks))
+        rows = self.labelOffsets[:-1] + self.labelTable[t-1]
+        joinGains = dataRates/(counts+1)
+        stayGains = dataRates/np.maximum(counts,1)
+        self.joinGains[rows] += joinGains
+        # one entry per (device, row), so the fancy-indexed add has no repeated indices
+        self.stayCorrections[np.arange(len(arms))[:,None], rows, np.asarray(arms)[:,None]] += (stayGains-joinGains)[arms][:,None]
+        self.lastSlot = t
+
+    # accumulates slot t from the state of the networks and of the added devices, once for all devices of the slot
+    def observeSlot(self, t):
+        if t == self.lastSlot: return
+        networkIndex = {network.networkID: i for i, network in enumerate(networkList)}
+        dataRates = np.array([network.dataRate for network in networkList], dtype=np.float64)
+        counts = np.array([network.numDevice for network in networkList])
+        arms = np.array([networkIndex[mobileDevice.currentNetwork] for mobileDevice in self.devices])
+        self.giveGains(t, dataRates, counts, arms)
+        self.slotState = (dataRates, counts, arms)
+        self.slotPotentialGains = None
+
+    def devicePotentialGains(self, deviceIndex):
+        ''' potentialGains of the last observed slot for one device; computed once per slot for all devices '''
+        if self.slotPotentialGains is None:
+            self.slotPotentialGains = self.potentialGains(*self.slotState).tolist()
+        return self.slotPotentialGains[deviceIndex]
+
+    @staticmethod
+    def potentialGains(dataRates, counts, arms):
+        ''' [device][network] gain of every device on every network, given the others stay; for the detailed logs '''
+        gains = np.tile(dataRates/(counts+1), (len(arms),1))
+        gains[np.arange(len(arms)),arms] = dataRates[arms]/counts[arms]
+        return gains
+
+    def maxCumulativeGain(self, deviceIndex):
+        labelMaxes = (self.joinGains + self.stayCorrections[deviceIndex]).max(axis=1)
+        return np.maximum.reduce(np.add.reduceat(labelMaxes, self.labelOffsets[:-1])).item()
+
+    def maxCumulativeGains(self):
+        labelMaxes = (self.joinGains[None] + self.stayCorrections).max(axis=2)
+        return np.add.reduceat(labelMaxes, self.labelOffsets[:-1], axis=1).max(axis=1).tolist()
 
 ''' ____________________________________________________________________ MobileDevice class definition ____________________________________________________________________ '''
 class MobileDevice(object):
     numMobileDevice = 0                                         # keeps track of number of mobile devices to automatically assign an ID to device upon creation
 
-    def __init__(self, networks, maxGain, trackDetailedStats=False, partitions=None):
+    def __init__(self, networks, maxGain, trackDetailedStats=False, partitions=None, hindsightGains=None):
         MobileDevice.numMobileDevice = MobileDevice.numMobileDevice + 1
         self.deviceID = MobileDevice.numMobileDevice            # ID of device
         self.availableNetwork = [networkList[i].networkID for i in range(len(networkList))]  # networkIDs of set of available networks
@@ -49,20 +103,26 @@ class MobileDevice(object):
         self.cumulativeGain = 0                                 # keeps track of the cumulative gain observed (unscaled)
         self.trackDetailedStats = trackDetailedStats
 
-        if partitions == None: partitions = [(lambda t : 0, 1)] # constant function
-        self.partitionCumulativeGains = PartitionCumulativeGains(partitions, len(networkList))
+        if hindsightGains == None: # not shared with the other devices of the simulation
+            if partitions == None: partitions = PartitionSpec(NUM_TIME_SLOT, [1]) # constant function
+            hindsightGains = HindsightGains(partitions, len(networkList))
+        self.hindsightGains = hindsightGains
+        self.hindsightGainsIndex = hindsightGains.addDevice(self)
 
         self.csvData = None
         self.networkCsvData = None
+        self.logResume = None                                   # TableWriter states to continue the logs from, when resuming a run
+        self.networkLogResume = None
         # end __init__
 
 
-    def runAlgorithm(self, env, algorithm, results, gamma_function):
+    # startSlot: number of time slots already simulated, when resuming a run from a checkpoint
+    def runAlgorithm(self, env, algorithm, results, gamma_function, startSlot=0):
         if self.trackDetailedStats:
             if self.deviceID == 1: MobileDevice.makeNetworkCsv(self)
             MobileDevice.makeDeviceCsv(self, algorithm.get_log_headers())
 
-        for t in range(1,NUM_TIME_SLOT+1):
+        for t in range(startSlot+1,NUM_TIME_SLOT+1):
             yield env.timeout(2)
 
             prevNetworkSelected = self.currentNetwork
@@ -87,23 +147,17 @@ class MobileDevice(object):
 
             # Score computation for result logging: (compute potential gain of all possible choices)
             self.cumulativeGain += self.gain
-            potentialGains = [0]*len(networkList)
-            for netIndex, network in enumerate(networkList): # append achievable download if connected to each of the other networks; each expert's gain
-                if (network.networkID == self.currentNetwork):
-                    possibleDownload = network.dataRate/network.numDevice
-                else:
-                    possibleDownload = network.dataRate/(network.numDevice + 1)
-                potentialGains[netIndex] = possibleDownload
-            self.partitionCumulativeGains.giveGain(t, potentialGains)
+            self.hindsightGains.observeSlot(t)
 
             # logging details of current time step to user, network and rateOfConvergence files
             if self.trackDetailedStats:
+                potentialGains = self.hindsightGains.devicePotentialGains(self.hindsightGainsIndex) # achievable download on each network; each expert's gain
                 algoData = algorithm.get_timestep_log()
                 MobileDevice.saveDeviceDetail(self, t, potentialGains, algoData)  # save device details to csv file
                 #MobileDevice.saveDeviceDetail(self, t, potentialGains, None)  # save device details to csv file
                 if self.deviceID == 1: MobileDevice.saveNetworkDetail(self, t)  # save network details to csv file
 
-        maxCumulativeGain = self.partitionCumulativeGains.maxCumulativeGain()
+        maxCumulativeGain = self.hindsightGains.maxCumulativeGain(self.hindsightGainsIndex)
         results.append((self.deviceID, self.cumulativeGain, maxCumulativeGain))
 
     ''' ################################################################################################################################################################### '''
@@ -151,7 +205,13 @@ class MobileDevice(object):
 
         #headers = ["gain"]
 
-        self.csvData = CsvData(deviceCsvName(OUTPUT_DIR, self.deviceID), headers)
+        keepColumns = [h for h in headers if h in ("Current network", "gain") or h.startswith("probability")] # read by data_analyzer
+        if OUTPUT_FORMAT == 'npy':
+            self.csvData = NpyWriter(deviceNpyName(OUTPUT_DIR, self.deviceID) if SAVE_LOG_DETAILS else None, headers,
+                                     NUM_TIME_SLOT, keepColumns=keepColumns, resume=self.logResume)
+        else:
+            self.csvData = CsvWriter(deviceCsvName(OUTPUT_DIR, self.deviceID) if SAVE_LOG_DETAILS else None, headers,
+                                     keepColumns=keepColumns, resume=self.logResume)
         #createBlankCsv(deviceCsvName(OUTPUT_DIR, self.deviceID), headers)
 
     ''' ################################################################################################################################################################### '''
@@ -163,7 +223,13 @@ class MobileDevice(object):
         #headers = ['#users%d' % i for i in range(1,len(self.availableNetwork)+1)] +\
         #          ['dataRate%d' % i for i in range(1,len(self.availableNetwork)+1)]
 
-        self.networkCsvData = CsvData(networkCsvName(OUTPUT_DIR), headers)
+        keepColumns = [h for h in headers if h.startswith("dataRate") or h.startswith("#users")] # read by data_analyzer
+        if OUTPUT_FORMAT == 'npy':
+            self.networkCsvData = NpyWriter(networkNpyName(OUTPUT_DIR) if SAVE_LOG_DETAILS else None, headers,
+                                            NUM_TIME_SLOT, keepColumns=keepColumns, resume=self.networkLogResume)
+        else:
+            self.networkCsvData = CsvWriter(networkCsvName(OUTPUT_DIR) if SAVE_LOG_DETAILS else None, headers,
+                                            keepColumns=keepColumns, resume=self.networkLogResume)
         #createBlankCsv(networkCsvName(OUTPUT_DIR), headers)
 
     ''' ################################################################################################################################################################### '''
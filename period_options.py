@@ -0,0 +1,113 @@
+'''
+@description:   Defines the period configurations selected with wns.py -per, as partitions of the time slots
+'''
+import argparse
+from algo_periodicexp4.algo_periodicexp4 import PartitionSpec, PeriodicExp4, WEIGHT_SIZE
+
+PERIOD_OPTIONS = [0,1,2,3] + list(range(5,21)) # option 4 is disabled
+
+def make_partitions(periodOption, T, numRepeats):
+    '''
+    description: returns the PartitionSpec of a period configuration
+    args:        period option, number of time slots, number of repeats of the problem instance
+    returns:     PartitionSpec
+    '''
+    if periodOption == 0: # EXP3
+        periods = [1]
+        partitions = PartitionSpec(T, periods)
+    elif periodOption == 1: # EXP3, but reset every day
+        periods = [numRepeats]
+        partitions = PartitionSpec(T, periods)
+    elif periodOption == 2: # unused
+        periods = list(range(1,15))
+        partitions = PartitionSpec(T, periods)
+    elif periodOption == 3: # unused
+        periods = list(range(1,15))
+        periods = [i*numRepeats for i in periods]
+        partitions = PartitionSpec(T, periods)
+    elif periodOption == 4:
+        pass #DISABLED
+    elif periodOption == 5:
+        periods = list(range(1,15))
+        partitions = PartitionSpec(T, periods, repeats=numRepeats)
+    elif periodOption == 6:
+        periods = list(range(1,40))
+        partitions = PartitionSpec(T, periods, repeats=numRepeats)
+    elif periodOption == 7: #primes below 15
+        periods = [1,2,3,5,7,11,13]
+        partitions = PartitionSpec(T, periods, repeats=numRepeats)
+    elif periodOption == 8: #primes below 40
+        periods = [1,2,3,5,7,11,13,17,19,23,29,31,37]
+        partitions = PartitionSpec(T, periods, repeats=numRepeats)
+    elif periodOption == 9: #powers of 2 up to 16
+        periods = [1,2,4,8,16]
+        partitions = PartitionSpec(T, periods, repeats=numRepeats)
+    elif periodOption == 10: #powers of 2 up to 1024
+        periods = [1,2,4,8,16,32,64,128,256,512,1024]
+        partitions = PartitionSpec(T, periods, repeats=numRepeats)
+    elif periodOption == 11: # all numbers up to 100
+        periods = list(range(1,100+1))
+        partitions = PartitionSpec(T, periods, repeats=numRepeats)
+    elif periodOption == 12: # primes below 100
+        periods = [2,3,5,7,11,13,17,19,23,29,31,37,41,43,47,53,59,61,67,71,73,79,83,89,97]
+        partitions = PartitionSpec(T, periods, repeats=numRepeats)
+    elif periodOption == 13: # large primes only
+        periods = [53,59,61,67,71,73,79,83,89,97]
+        partitions = PartitionSpec(T, periods, repeats=numRepeats)
+
+
+    #elif periodOption >= 14: # temp, delete
+    #    # 14 --> 1
+    #    periods = [periodOption-13]
+    #    partitions = algo_periodicexp4.make_repeating_partition_cycles(T, numRepeats, periods)
+
+    elif periodOption == 14:
+        periods = [4]
+        partitions = PartitionSpec(T, periods, repeats=numRepeats)
+    elif periodOption == 15:
+        periods = list(range(1,15+1)) # 15 periods
+        partitions = PartitionSpec(T, periods, repeats=numRepeats)
+    elif periodOption == 16:
+        periods = list(range(1,23+1)) # 23 periods
+        partitions = PartitionSpec(T, periods, repeats=numRepeats)
+    elif periodOption == 17:
+        periods = list(range(1,45+1)) # 45 periods
+        partitions = PartitionSpec(T, periods, repeats=numRepeats)
+    elif periodOption == 18:
+        periods = list(range(23,45+1)) # 23 periods
+        partitions = PartitionSpec(T, periods, repeats=numRepeats)
+    elif periodOption == 19:
+        periods = [1,2,3,5,7,11,13,17,19,23,29,31,37,41,43] # 15 periods
+        partitions = PartitionSpec(T, periods, repeats=numRepeats)
+    elif periodOption == 20:
+        periods = list(range(1,24+1)) # 24 periods
+        partitions = PartitionSpec(T, periods, repeats=numRepeats)
+
+    return partitions
+
+def memory_report(K, numDevices, T, numRepeats, periodOptions=PERIOD_OPTIONS):
+    '''
+    description: prints the native memory of the learners of each period configuration, measured on one learner,
+                 with the weights as built (WEIGHT_SIZE bytes) and as double and float32
+    args:        number of networks, number of devices, number of time slots, number of repeats of problem instance,
+                 period options to report
+    '''
+    print('weights of %d bytes, %d devices, K = %d' % (WEIGHT_SIZE, numDevices, K))
+    print('%6s %9s %9s %14s %14s %15s %14s' % ('option', 'periods', 'labels', 'KB per device', 'MB all devices',
+                                               'MB as float32', 'MB label table'))
+    for periodOption in periodOptions:
+        partitions = make_partitions(periodOption, T, numRepeats)
+        deviceBytes = PeriodicExp4(T, K, partitions, gamma=0.3).weight_bytes()
+        totalBytes = deviceBytes*numDevices
+        print('%6d %9d %9d %14.1f %14.1f %15.1f %14.1f' % (periodOption, len(partitions), sum(partitions.label_counts),
+              deviceBytes/2**10, totalBytes/2**20, totalBytes*4/WEIGHT_SIZE/2**20, partitions.materialize().nbytes/2**20))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reports the memory of the learners of each period configuration.')
+    parser.add_argument('-k', dest="num_network", default=3, type=int, help='number of networks')
+    parser.add_argument('-n', dest="num_device", default=20, type=int, help='number of devices')
+    parser.add_argument('-t', dest="num_time_slot", default=86400, type=int, help='number of time slots')
+    parser.add_argument('-rep', dest="num_repeats", default=60, type=int, help='number of repeats of problem instance')
+    parser.add_argument('-per', dest="period_options", default=[], type=int, action='append', help='period configuration to report (repeatable, default: all)')
+    args = parser.parse_args()
+    memory_report(args.num_network, args.num_device, args.num_time_slot, args.num_repeats, args.period_options or PERIOD_OPTIONS)
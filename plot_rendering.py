@@ -0,0 +1,95 @@
+'''
+@description:   Renders the figures of data_analyzer.plot_graphs. Each figure is described by a plain dict of
+                (downsampled) numpy arrays, so that it can be rendered in a worker process.
+'''
+import os
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+''' ____________________________________________________________________________ downsampling ____________________________________________________________________________ '''
+def downsample(values, targetPoints):
+    '''
+    description: splits the rows (time slots) of values into at most targetPoints buckets of consecutive rows
+    args:        T or T x K array, maximum number of buckets
+    returns:     1-based slot at the centre of each bucket, and the min, mean and max of the rows in each bucket
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    T = len(values)
+    numBuckets = max(1, min(T, targetPoints))
+    starts = (np.arange(numBuckets)*T)//numBuckets
+    sizes = np.diff(np.append(starts, T)).reshape((-1,) + (1,)*(values.ndim-1))
+    centres = starts + (sizes.ravel()+1)/2
+    mins = np.minimum.reduceat(values, starts, axis=0)
+    means = np.add.reduceat(values, starts, axis=0)/sizes
+    maxs = np.maximum.reduceat(values, starts, axis=0)
+    return centres, mins, means, maxs
+
+def surface_figure(name, values, targetPoints, color=None):
+    ''' figure of a T x K array as a surface over time slot and network, with the bucket means '''
+    x, mins, means, maxs = downsample(values, targetPoints)
+    return {'name': name, 'kind': 'surface', 'x': x, 'y': np.arange(1, means.shape[1]+1), 'z': means, 'color': color}
+
+def band_figure(name, labelledSeries, targetPoints):
+    ''' figure of T arrays as lines of the bucket means, shaded between the bucket min and max '''
+    series = []
+    for label, values in labelledSeries:
+        x, mins, means, maxs = downsample(values, targetPoints)
+        series.append((label, x, mins, means, maxs))
+    return {'name': name, 'kind': 'band', 'series': series}
+
+def line_figure(name, x, labelledSeries):
+    ''' figure of short arrays plotted as they are '''
+    return {'name': name, 'kind': 'line', 'x': x, 'series': labelledSeries}
+
+''' _____________________________________________________________________________ rendering _____________________________________________________________________________ '''
+def figure_file_name(outputDir, figure):
+    return os.path.join(outputDir, '%s.png' % figure['name'].replace(' ', '_'))
+
+def render(figure):
+    ''' draws the figure into a new pyplot figure with the figure's name, and returns the pyplot figure '''
+    import matplotlib.pyplot as plt
+    fig = plt.figure(figure['name'])
+    if figure['kind'] == 'surface':
+        ax = fig.add_subplot(projection='3d')
+        X, Y = np.meshgrid(figure['x'], figure['y'])
+        if figure['color'] != None:
+            ax.plot_surface(X, Y, figure['z'].T, color=figure['color'])
+        else:
+            ax.plot_surface(X, Y, figure['z'].T)
+    elif figure['kind'] == 'band':
+        ax = fig.add_subplot()
+        for label, x, mins, means, maxs in figure['series']:
+            line, = ax.plot(x, means, label=label)
+            ax.fill_between(x, mins, maxs, color=line.get_color(), alpha=0.2, linewidth=0)
+    elif figure['kind'] == 'line':
+        ax = fig.add_subplot()
+        for label, y in figure['series']:
+            ax.plot(figure['x'], y, label=label)
+    return fig
+
+def render_to_file(figure, path):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig = render(figure)
+    fig.savefig(path)
+    plt.close(fig)
+    return path
+
+def render_all_to_files(figures, outputDir, numWorkers=1):
+    '''
+    description: renders every figure to <outputDir>/<name>.png with the non-interactive Agg backend,
+                 in this process, or on numWorkers worker processes (None = all cores). The workers are started by a
+                 forkserver, so they do not inherit the threads of the caller; they import the caller's main module
+                 again, which must therefore guard its work with if __name__ == '__main__'.
+    returns:     paths of the written files
+    '''
+    paths = [figure_file_name(outputDir, figure) for figure in figures]
+    numWorkers = min(numWorkers if numWorkers != None else os.cpu_count(), len(figures))
+    if numWorkers <= 1:
+        return [render_to_file(figure, path) for figure, path in zip(figures, paths)]
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+    with ProcessPoolExecutor(max_workers=numWorkers, mp_context=context) as executor:
+        return list(executor.map(render_to_file, figures, paths))
+''' _____________________________________________________________________________ end of file _____________________________________________________________________________ '''
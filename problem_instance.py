@@ -1,13 +1,37 @@
 """
 Manages the variation of network bitrates and other network properties over time.
 A problem instance maker should return (run, maxGain, numNetworks)
+A trace maker should return (trace, maxGain, numNetworks), where trace is a T x numNetworks array whose
+row t-1 holds the data rates of time slot t.
 """
-import math, random
+import math, random, os
+import numpy as np
 
 def run_instance(env, networkList, instance):
     for timeoutDuration in instance(networkList):
         yield env.timeout(timeoutDuration)
 
+class NetworkStub(object):
+    def __init__(self):
+        self.dataRate = 0
+
+def materialize_instance(T, instance, numNetworks):
+    '''
+    Returns a T x numNetworks array of the data rates observed by the devices in each time slot.
+    Replays the instance with the timing of run_instance under simpy: a device observes slot t at
+    time 3t, after any instance event at the same time (those are always scheduled earlier).
+    '''
+    networkList = [NetworkStub() for i in range(numNetworks)]
+    trace = []
+    events = instance(networkList)
+    nextTime = next(events, None)
+    for t in range(1,T+1):
+        while nextTime != None and nextTime <= 3*t:
+            timeout = next(events, None)
+            nextTime = None if timeout == None else nextTime + timeout
+        trace.append([network.dataRate for network in networkList])
+    return np.array(trace) # integer dtype if the instance only uses integer rates, as the csvs do
+
 def make_datarate_instance(events):
     seq = sorted(events.items(), key=lambda x:x[0])
     assert seq[0][0] == 0, 'first event must start from 0'
@@ -26,6 +50,14 @@ def make_datarate_instance(events):
     return run, maxGain, numNetworks
 
 EPSILON=0.0000001
+
+# The gaussian noise of a trace is drawn in blocks of NOISE_BLOCK_SIZE rows. Block b of a run with seed s
+# comes from its own generator, seeded with (s, b), so the noise of any row only depends on the seed and the
+# row index, whichever way the trace is chunked.
+NOISE_BLOCK_SIZE = 4096
+DEFAULT_NOISE = (0.1, 15) # (percentageNoise, seed) used by wns.py
+TRACE_CHUNK_SIZE = 65536
+
 def make_fractional_datarate_instance(T, events):
     return make_datarate_instance({int(T*p+EPSILON):v for p,v in events.items()})
 
@@ -37,21 +69,36 @@ def sine(T, relativePeriod, phaseShift, amplitude):
     shift = phaseShift*2*math.pi
     return lambda t: math.sin(t*freq-shift)*amplitude
 
-def make_random_continous_function(T, seed, scale, meanAmplitude):
+# returns a list of (relativePeriod, phaseShift, amplitude) of the sines of a random continuous function
+def random_sine_parameters(seed, scale, meanAmplitude):
     localRandom = random.Random(seed)
 
     numberOfFunctions = 20
-    functions = []
+    parameters = []
     amp = meanAmplitude/numberOfFunctions
     for i in range(numberOfFunctions):
         amplitude = localRandom.uniform(amp/3, amp*5/3)
         shift = localRandom.uniform(0,1)
         #relativePeriod = 2**localRandom.uniform(-3,2)
         relativePeriod = (2**localRandom.uniform(-3,2))*scale
-        functions.append(sine(T, relativePeriod, shift, amplitude))
+        parameters.append((relativePeriod, shift, amplitude))
+    return parameters
 
+def make_random_continous_function(T, seed, scale, meanAmplitude):
+    functions = [sine(T, relativePeriod, shift, amplitude)
+        for relativePeriod, shift, amplitude in random_sine_parameters(seed, scale, meanAmplitude)]
     return lambda t: sum(f(t) for f in functions)
 
+# make_random_continous_function evaluated at all of ts at once. The sines are added in the same order,
+# so the values are identical.
+def random_continuous_function_values(T, seed, scale, meanAmplitude, ts):
+    values = np.zeros(len(ts))
+    for relativePeriod, phaseShift, amplitude in random_sine_parameters(seed, scale, meanAmplitude):
+        freq = 2*math.pi / T / relativePeriod
+        shift = phaseShift*2*math.pi
+        values += np.sin(ts*freq-shift)*amplitude
+    return values
+
 
 def make_continuous_datarate_instance(T, numNetworks, seed, totalBandwidth, scale, offsetPercent):
     localRandom = random.Random(seed)
@@ -68,6 +115,160 @@ def make_continuous_datarate_instance(T, numNetworks, seed, totalBandwidth, scal
             yield (3)
     return run, totalBandwidth, numNetworks
 
+def make_continuous_datarate_trace(T, numNetworks, seed, totalBandwidth, scale, offsetPercent):
+    localRandom = random.Random(seed)
+    seeds = [localRandom.randrange(2147483647) for i in range(numNetworks)]
+    ts = np.arange(1,T+1, dtype=np.float64)
+
+    dataRates = [random_continuous_function_values(T, s, scale, 10, ts) for s in seeds]
+    dataRates = [x*x+(offsetPercent*100) for x in dataRates] # square everything
+    totalRate = np.zeros(T)
+    for x in dataRates: totalRate += x
+    trace = np.stack([x*totalBandwidth/totalRate for x in dataRates], axis=1)
+    return trace, totalBandwidth, numNetworks
+
+def make_fractional_datarate_trace(T, events):
+    events = {int(T*p+EPSILON):v for p,v in events.items()}
+    seq = sorted(events.items(), key=lambda x:x[0])
+    assert seq[0][0] == 0, 'first event must start from 0'
+    maxGain = max(max(pair[1]) for pair in seq)
+    times = np.array([t for t, dataRates in seq])
+    rates = np.array([dataRates for t, dataRates in seq]) # stays integer for integer rates, as the csvs print them
+
+    # the rates of an event at time e apply from time slot e+1 onwards
+    index = np.searchsorted(times, np.arange(T), side='right') - 1
+    return rates[index], maxGain, rates.shape[1]
+
+def repeat_trace(T, repeats, problemInstance):
+    maxGain = 0
+    traces = []
+    for i in range(repeats):
+        dT = T*(i+1)//repeats - T*i//repeats
+        trace, localMaxGain, numNetworks = problemInstance.trace(dT)
+        traces.append(trace)
+        maxGain = max(maxGain, localMaxGain)
+    return np.concatenate(traces), maxGain, numNetworks
+
+def trace_instance(trace, chunkSize=TRACE_CHUNK_SIZE):
+    ''' problem instance that plays back a trace, one row per time slot '''
+    def run(networkList):
+        yield (1)
+        for start in range(0, len(trace), chunkSize):
+            for dataRates in np.asarray(trace[start:start+chunkSize]).tolist():
+                for dataRate, network in zip(dataRates, networkList):
+                    network.dataRate = dataRate
+                yield (3)
+    return run
+
+''' __________ noise __________ '''
+def standard_noise(seed, start, stop, numNetworks):
+    ''' standard normal noise of rows [start, stop) of a trace, shape (stop-start) x numNetworks '''
+    noise = np.empty((stop-start, numNetworks))
+    for block in range(start//NOISE_BLOCK_SIZE, (stop-1)//NOISE_BLOCK_SIZE + 1 if stop > start else 0):
+        blockStart = block*NOISE_BLOCK_SIZE
+        generator = np.random.default_rng([seed, block])
+        blockNoise = generator.standard_normal((NOISE_BLOCK_SIZE, numNetworks))
+        lo, hi = max(start, blockStart), min(stop, blockStart+NOISE_BLOCK_SIZE)
+        noise[lo-start:hi-start] = blockNoise[lo-blockStart:hi-blockStart]
+    return noise
+
+def add_noise_to_trace(trace, percentageNoise, seed, start=0, out=None):
+    '''
+    Adds gaussian noise with a standard deviation of percentageNoise*dataRate to each data rate, clipped at 0.
+    trace holds rows [start, start+len(trace)) of the full trace, so chunks can be noised independently.
+    '''
+    trace = np.asarray(trace, dtype=np.float64)
+    noise = standard_noise(seed, start, start+len(trace), trace.shape[1])
+    noise *= percentageNoise
+    noise += 1
+    noise *= trace
+    return np.maximum(noise, 0, out=out)
+
+def iter_noisy_trace(trace, percentageNoise, seed, chunkSize=TRACE_CHUNK_SIZE):
+    ''' yields (start, noisy rows from start) in chunks of chunkSize rows, without holding the full noisy trace '''
+    for start in range(0, len(trace), chunkSize):
+        yield start, add_noise_to_trace(trace[start:start+chunkSize], percentageNoise, seed, start=start)
+
+def trace_cache_name(cacheDir, name, T, repeats, noise=None):
+    fileName = '%s--T%d--rep%d' % (name, T, repeats)
+    if noise != None: fileName += '--noise%g--seed%d' % noise
+    return os.path.join(cacheDir, fileName + '.npy')
+
+def load_trace(name, T, repeats, cacheDir=None, noise=None):
+    '''
+    Returns (trace, maxGain, numNetworks) of PROBLEM_INSTANCES[name] repeated over T time slots.
+    noise: optional (percentageNoise, seed) to apply add_noise_to_trace with.
+    If cacheDir is given, the trace is stored there as .npy and memory mapped from it on later calls.
+    '''
+    problemInstance = PROBLEM_INSTANCES[name]
+    maxGain, numNetworks = problemInstance.max_gain(), problemInstance.num_networks()
+    if cacheDir == None:
+        trace, maxGain, numNetworks = repeat_trace(T, repeats, problemInstance)
+        if noise != None: trace = add_noise_to_trace(trace, *noise)
+        return trace, maxGain, numNetworks
+
+    path = trace_cache_name(cacheDir, name, T, repeats, noise)
+    if not os.path.exists(path):
+        if noise == None:
+            trace, maxGain, numNetworks = repeat_trace(T, repeats, problemInstance)
+            save_trace(path, trace)
+        else:
+            clean, maxGain, numNetworks = load_trace(name, T, repeats, cacheDir)
+            save_trace(path, iter_noisy_trace(clean, *noise), shape=clean.shape)
+    return np.load(path, mmap_mode='r'), maxGain, numNetworks
+
+def save_trace(path, trace, shape=None):
+    '''
+    Saves a trace as .npy. trace is either an array, or an iterable of (start, rows) chunks of a trace of the given shape.
+    '''
+    # write to a temporary file first, so that concurrent runs never load a partial trace
+    if not os.path.exists(os.path.dirname(path)): os.makedirs(os.path.dirname(path), exist_ok=True)
+    tempPath = '%s.%d.tmp' % (path, os.getpid())
+    if shape == None:
+        with open(tempPath, 'wb') as f:
+            np.save(f, trace)
+    else:
+        out = np.lib.format.open_memmap(tempPath, mode='w+', dtype=np.float64, shape=shape)
+        for start, rows in trace:
+            out[start:start+len(rows)] = rows
+        out.flush()
+        del out
+    os.replace(tempPath, path)
+
+class FractionalInstance(object):
+    ''' piecewise-constant data rates. events: {fraction of T: data rates from that point on} '''
+    def __init__(self, events):
+        self.events = events
+
+    def __call__(self, T):
+        return make_fractional_datarate_instance(T, self.events)
+
+    def trace(self, T):
+        return make_fractional_datarate_trace(T, self.events)
+
+    def max_gain(self):
+        return max(max(v) for v in self.events.values())
+
+    def num_networks(self):
+        return len(self.events[0])
+
+class ContinuousInstance(object):
+    ''' smoothly varying data rates, see make_continuous_datarate_instance for the arguments '''
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def __call__(self, T):
+        return make_continuous_datarate_instance(T, **self.kwargs)
+
+    def trace(self, T):
+        return make_continuous_datarate_trace(T, **self.kwargs)
+
+    def max_gain(self):
+        return self.kwargs['totalBandwidth']
+
+    def num_networks(self):
+        return self.kwargs['numNetworks']
+
 def repeat_instance(T, repeats, instanceFun):
     maxGain = 0
     instances = []
@@ -91,32 +292,21 @@ def repeat_instance(T, repeats, instanceFun):
     return run, maxGain, numNetworks
 
 def add_noise_to_instance(T, percentageNoise, seed, instanceFun):
-    localRandom = random.Random(seed)
     instance, maxGain, numNetworks = instanceFun(T)
-
-    def run(networkList):
-        runInstance = instance(networkList)
-        for timeout in runInstance:
-            dataRates = [network.dataRate for network in networkList]
-            steps = timeout//3
-            for t in range(steps):
-                for dataRate, network in zip(dataRates, networkList):
-                    network.dataRate = max(0, dataRate + localRandom.gauss(0, percentageNoise*dataRate))
-                yield 3
-
-    return run, maxGain, numNetworks
+    trace = add_noise_to_trace(materialize_instance(T, instance, numNetworks), percentageNoise, seed)
+    return trace_instance(trace), maxGain, numNetworks
 
 ''' __________ problem instance definitions __________ '''
 '''       the keys are the problem instance names      '''
 
 PROBLEM_INSTANCES = {
     'instance_1': 
-    lambda T: make_fractional_datarate_instance(T, {
+    FractionalInstance({
         0: (4,7,22),
     }),
 
     'instance_2': 
-    lambda T: make_fractional_datarate_instance(T, {
+    FractionalInstance({
         0:   (20,5,15,140,20),
         1/5: (10,5,15,10,160),
         2/5: (75,15,20,77,13),
@@ -125,7 +315,7 @@ PROBLEM_INSTANCES = {
     }),
 
     'instance_2b': 
-    lambda T: make_fractional_datarate_instance(T, {
+    FractionalInstance({
         0:     (20,5,15,140,20),
         1/15:  (10,5,15,10,160),
         2/15:  (75,15,20,77,13),
@@ -144,7 +334,7 @@ PROBLEM_INSTANCES = {
     }),
 
     'instance_3': 
-    lambda T: make_fractional_datarate_instance(T, {
+    FractionalInstance({
         0:   (0,0,0,200,0),
         1/5: (0,0,200,0,0),
         2/5: (0,0,0,0,200),
@@ -153,7 +343,7 @@ PROBLEM_INSTANCES = {
     }),
 
     'instance_4': 
-    lambda T: make_fractional_datarate_instance(T, {
+    FractionalInstance({
         0:   (13,2,60,19,6),
         1/7: (72,14,4,5,5),
         2/7: (5,1,36,46,12),
@@ -164,7 +354,7 @@ PROBLEM_INSTANCES = {
     }),
 
     'instance_testing': 
-    lambda T: make_fractional_datarate_instance(T, {
+    FractionalInstance({
         0:   (0,0,100,100,0),
         1/5: (50,50,0,50,50),
         2/5: (0,0,0,0,200),
@@ -173,42 +363,42 @@ PROBLEM_INSTANCES = {
     }),
 
     'instance_testing2': 
-    lambda T: make_fractional_datarate_instance(T, {
+    FractionalInstance({
         0: (40,20,10,160,20),
     }),
 
     'instance_cont1': 
-    lambda T: make_continuous_datarate_instance(T,
+    ContinuousInstance(
         numNetworks=5, seed=3, scale=1, totalBandwidth=100,
         offsetPercent=0),
 
     'instance_cont2': 
-    lambda T: make_continuous_datarate_instance(T,
+    ContinuousInstance(
         numNetworks=5, seed=531, scale=3, totalBandwidth=100,
         offsetPercent=0),
 
     'instance_cont3': 
-    lambda T: make_continuous_datarate_instance(T,
+    ContinuousInstance(
         numNetworks=5, seed=15, scale=4, totalBandwidth=100,
         offsetPercent=0),
 
     'instance_cont4': 
-    lambda T: make_continuous_datarate_instance(T,
+    ContinuousInstance(
         numNetworks=5, seed=389, scale=2, totalBandwidth=100,
         offsetPercent=0.3),
 
     'instance_cont5': 
-    lambda T: make_continuous_datarate_instance(T,
+    ContinuousInstance(
         numNetworks=5, seed=821, scale=3, totalBandwidth=100,
         offsetPercent=0.6),
 
     'instance_cont6': 
-    lambda T: make_continuous_datarate_instance(T,
+    ContinuousInstance(
         numNetworks=5, seed=411, scale=2.5, totalBandwidth=100,
         offsetPercent=0.03),
 
     'instance_f1': 
-    lambda T: make_fractional_datarate_instance(T, {
+    FractionalInstance({
         0:   (7,14,44),
         1/4: (36,7,22),
         2/4: (9,16,40),
@@ -216,12 +406,12 @@ PROBLEM_INSTANCES = {
     }),
 
     'instance_cont_f1': 
-    lambda T: make_continuous_datarate_instance(T,
+    ContinuousInstance(
         numNetworks=3, seed=10, scale=3, totalBandwidth=65,
         offsetPercent=0),
 
     'instance_cont_f2': 
-    lambda T: make_continuous_datarate_instance(T,
+    ContinuousInstance(
         numNetworks=3, seed=11, scale=1, totalBandwidth=65,
         offsetPercent=0),
 
@@ -236,10 +426,6 @@ def test_continuous_datarate_instance():
 
     T = 1440
     import matplotlib.pyplot as plt
-    class NetworkStub(object):
-        def __init__(self):
-            self.dataRate = 0
-
     numNetworks = 5
     #instance, _1, numNetworks = make_continuous_datarate_instance(T, numNetworks, seed, 1, 100)
     #instance, _1, numNetworks = add_noise_to_instance(T, 0.1, 15, lambda T : repeat_instance(T, 1, PROBLEM_INSTANCES['instance_f1']))
@@ -0,0 +1,194 @@
+'''
+@description:   Computes the regret of the devices of a finished run against the best expert of any candidate period
+                configuration, from the device and network logs the run saved (wns.py -log true, csv or npy format),
+                without running the simulation again. The logs are read in chunks of time slots, and all candidate
+                configurations are evaluated together in one pass over each chunk, so the memory use does not grow
+                with the length of the run.
+                usage: python regret_analyzer.py -dir <output directory of the run> -rep <repeats of the run> -per 5 -per 12 -periods 1,2,4,8
+'''
+import os
+import re
+import csv
+import argparse
+from itertools import islice
+import numpy as np
+import period_options
+from algo_periodicexp4.algo_periodicexp4 import PartitionSpec
+from utility_method import saveToCsv, loadNpyRun, networkCsvName, networkNpyName, deviceCsvName
+
+CHUNK_SLOTS = 16384         # time slots read and accumulated at a time, and spacing of the points of the regret curves
+CURVES_FILE = 'regret_curves.csv'
+
+''' ______________________________________________________________________ reading the saved logs ______________________________________________________________________ '''
+def csv_chunks(path, names, chunkSlots):
+    ''' yields {name: float array} of the given columns of the csv at path, chunkSlots rows at a time '''
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        headers = next(reader)
+        indices = [headers.index(name) for name in names]
+        while True:
+            rows = list(islice(reader, chunkSlots))
+            if len(rows) == 0: return
+            yield {name: np.array([float(row[index]) for row in rows]) for name, index in zip(names, indices)}
+
+def npy_chunks(table, names, chunkSlots):
+    ''' yields {name: float array} of the given columns of an NpyTable, chunkSlots rows at a time '''
+    for start in range(0, len(table), chunkSlots):
+        yield {name: np.asarray(table.getColumn(name)[start:start+chunkSlots], dtype=np.float64) for name in names}
+
+def count_csv_rows(path):
+    with open(path, newline='') as f:
+        return sum(1 for row in csv.reader(f)) - 1
+
+class SavedRun(object):
+    '''
+    The logs of a finished run in a directory, in either output format.
+    Network IDs are 1..numNetworks, as created by wns.py, so the network index of a device is its "Current network" - 1.
+    '''
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(networkNpyName(path)):
+            self.deviceTables, self.networkTable = loadNpyRun(path)
+            self.deviceIDs = [deviceID for deviceID, table in self.deviceTables]
+            self.headers = self.networkTable.headers
+            self.numTimeSlots = len(self.networkTable)
+        else:
+            self.deviceTables, self.networkTable = None, None
+            self.deviceIDs = sorted(int(m.group(1)) for m in (re.match(r'device(\d+)\.csv$', name) for name in os.listdir(path)) if m)
+            with open(networkCsvName(path), newline='') as f:
+                self.headers = next(csv.reader(f))
+            self.numTimeSlots = count_csv_rows(networkCsvName(path))
+        self.numNetworks = sum(1 for header in self.headers if re.match(r'dataRate\d+$', header))
+
+    def chunks(self, chunkSlots):
+        '''
+        description: reads the logs chunkSlots time slots at a time
+        returns:     generator of (C x numNetworks data rates, C x numNetworks occupancy, numDevices x C network indices,
+                     numDevices x C gains) for consecutive chunks of C time slots
+        '''
+        networkNames = ['dataRate%d'%i for i in range(1,self.numNetworks+1)] + ['#users%d'%i for i in range(1,self.numNetworks+1)]
+        deviceNames = ['Current network', 'gain']
+        if self.networkTable != None:
+            networkChunks = npy_chunks(self.networkTable, networkNames, chunkSlots)
+            deviceChunks = [npy_chunks(table, deviceNames, chunkSlots) for deviceID, table in self.deviceTables]
+        else:
+            networkChunks = csv_chunks(networkCsvName(self.path), networkNames, chunkSlots)
+            deviceChunks = [csv_chunks(deviceCsvName(self.path, deviceID), deviceNames, chunkSlots) for deviceID in self.deviceIDs]
+        for networkChunk, *deviceChunk in zip(networkChunks, *deviceChunks):
+            dataRates = np.stack([networkChunk['dataRate%d'%i] for i in range(1,self.numNetworks+1)], axis=1)
+            counts = np.stack([networkChunk['#users%d'%i] for i in range(1,self.numNetworks+1)], axis=1)
+            arms = np.stack([chunk['Current network'] for chunk in deviceChunk]).astype(np.int64) - 1
+            gains = np.stack([chunk['gain'] for chunk in deviceChunk])
+            yield dataRates, counts, arms, gains
+# end SavedRun class
+
+''' __________________________________________________________________________ regret analysis __________________________________________________________________________ '''
+class StreamingRegret(object):
+    '''
+    Cumulative gains of every expert (partition f, label, network) of several PartitionSpecs for every device, fed one
+    chunk of time slots at a time. The partitions of all specs are stacked, so an expert is
+    [labelOffsets[f]+label][device][network]. Within a chunk, the gains are summed over the runs of consecutive slots
+    with the same label of a partition, as differences of prefix sums over the chunk.
+    '''
+    def __init__(self, partitionSpecs, numDevices, numNetworks):
+        self.partitionSpecs = partitionSpecs
+        self.numDevices = numDevices
+        self.numNetworks = numNetworks
+        self.specOffsets = np.concatenate(([0], np.cumsum([len(spec) for spec in partitionSpecs])))
+        labelCounts = [count for spec in partitionSpecs for count in spec.label_counts]
+        self.labelOffsets = np.concatenate(([0], np.cumsum(labelCounts)))
+        self.cumulativeGains = np.zeros((self.labelOffsets[-1], numDevices*numNetworks))
+        self.deviceGains = np.zeros(numDevices)
+        self.numSlots = 0
+
+    def giveChunk(self, dataRates, counts, arms, gains):
+        '''
+        description: accumulates the next C time slots
+        args:        self, C x numNetworks data rates, C x numNetworks occupancy, numDevices x C network index of every device,
+                     numDevices x C gain of every device
+        '''
+        C = len(dataRates)
+        start, stop = self.numSlots, self.numSlots + C
+        # gain of every device on every network, given the others stay: C x numDevices x numNetworks
+        potentialGains = np.repeat((dataRates/(counts+1))[:,None,:], self.numDevices, axis=1)
+        slots = np.arange(C)
+        for device in range(self.numDevices):
+            potentialGains[slots,device,arms[device]] = dataRates[slots,arms[device]]/counts[slots,arms[device]]
+        prefixSums = np.zeros((C+1, self.numDevices*self.numNetworks))
+        np.cumsum(potentialGains.reshape(C,-1), axis=0, out=prefixSums[1:])
+
+        # runs of equal labels of each partition: (partition, first slot) sorted by partition, then slot
+        labels = np.concatenate([spec.compute_labels(start, stop) for spec in self.partitionSpecs], axis=1)
+        numPartitions = labels.shape[1]
+        changedPartitions, changedSlots = np.nonzero((labels[1:] != labels[:-1]).T)
+        runPartitions = np.concatenate((np.arange(numPartitions), changedPartitions))
+        runStarts = np.concatenate((np.zeros(numPartitions, dtype=np.int64), changedSlots+1))
+        order = np.lexsort((runStarts, runPartitions))
+        runPartitions, runStarts = runPartitions[order], runStarts[order]
+        runEnds = np.append(runStarts[1:], C)
+        runEnds[np.append(runPartitions[1:] != runPartitions[:-1], True)] = C
+
+        rows = self.labelOffsets[runPartitions] + labels[runStarts, runPartitions]
+        np.add.at(self.cumulativeGains, rows, prefixSums[runEnds] - prefixSums[runStarts])
+        self.deviceGains += gains.sum(axis=1)
+        self.numSlots = stop
+
+    def maxCumulativeGains(self):
+        ''' returns: len(partitionSpecs) x numDevices cumulative gain of the best expert of each spec, for every device '''
+        labelMaxes = self.cumulativeGains.reshape(len(self.cumulativeGains), self.numDevices, self.numNetworks).max(axis=2)
+        partitionGains = np.add.reduceat(labelMaxes, self.labelOffsets[:-1], axis=0)
+        return np.maximum.reduceat(partitionGains, self.specOffsets[:-1], axis=0)
+
+    def regrets(self):
+        ''' returns: len(partitionSpecs) x numDevices regret against the best expert of each spec, for every device '''
+        return self.maxCumulativeGains() - self.deviceGains[None,:]
+# end StreamingRegret class
+
+def regret_curves(savedRun, partitionSpecs, chunkSlots=CHUNK_SLOTS):
+    '''
+    description: streams the logs of a run once, and evaluates the regret of every device against every spec at the end of each chunk
+    args:        SavedRun, list of PartitionSpec over the time slots of the run, time slots per chunk
+    returns:     list of the time slots at the ends of the chunks, array of the regrets [chunk][spec][device]
+    '''
+    regret = StreamingRegret(partitionSpecs, len(savedRun.deviceIDs), savedRun.numNetworks)
+    slots, curves = [], []
+    for dataRates, counts, arms, gains in savedRun.chunks(chunkSlots):
+        regret.giveChunk(dataRates, counts, arms, gains)
+        slots.append(regret.numSlots)
+        curves.append(regret.regrets())
+    return slots, np.array(curves)
+
+''' _______________________________________________________________________________ main _______________________________________________________________________________ '''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Computes the regret of a finished run against the best expert of candidate period configurations.')
+    parser.add_argument('-dir', dest="directory", required=True, type=str, help='output directory of the run (saved with -log true)')
+    parser.add_argument('-rep', dest="num_repeats", required=True, type=int, help='number of repeats of problem instance of the run')
+    parser.add_argument('-per', dest="period_options", default=[], type=int, action='append', help='period configuration of wns.py -per to evaluate (repeatable)')
+    parser.add_argument('-periods', dest="period_lists", default=[], type=str, action='append', help='comma separated periods to evaluate, repeating with -rep (repeatable)')
+    parser.add_argument('-chunk', dest="chunk_slots", default=CHUNK_SLOTS, type=int, help='time slots per chunk, and between the points of the regret curves')
+    parser.add_argument('-out', dest="output", default=None, type=str, help='csv to write the regret curves to (default: %s in the run directory)' % CURVES_FILE)
+    args = parser.parse_args()
+    if len(args.period_options) + len(args.period_lists) == 0: parser.error('give at least one -per or -periods')
+
+    savedRun = SavedRun(args.directory)
+    T = savedRun.numTimeSlots
+    names, partitionSpecs = [], []
+    for periodOption in args.period_options:
+        names.append('per%d' % periodOption)
+        partitionSpecs.append(period_options.make_partitions(periodOption, T, args.num_repeats))
+    for periodList in args.period_lists:
+        names.append(periodList)
+        partitionSpecs.append(PartitionSpec(T, [int(period) for period in periodList.split(',')], repeats=args.num_repeats))
+
+    slots, curves = regret_curves(savedRun, partitionSpecs, args.chunk_slots)
+
+    headers = ['Time slot', 'Periods', 'Mean regret'] + ['Regret device%d' % deviceID for deviceID in savedRun.deviceIDs]
+    rows = [[slot, name, regrets.mean()] + regrets.tolist()
+            for slot, specRegrets in zip(slots, curves) for name, regrets in zip(names, specRegrets)]
+    output = args.output if args.output != None else os.path.join(args.directory, CURVES_FILE)
+    saveToCsv(output, headers, rows)
+
+    for name, regrets in zip(names, curves[-1]):
+        print('%s - Mean regret: %.2f, Lowest: %.2f, Highest: %.2f' % (name, regrets.mean(), regrets.min(), regrets.max()))
+    print('regret curves saved to %s' % output)
+''' _____________________________________________________________________________ end of file _____________________________________________________________________________ '''
@@ -1,10 +1,17 @@
 import os
 import sys
+from sweep_runner import Job, SweepRunner
 
 SAVE_LOG_DETAILS = True
 SHOW_PLOTS = False
-ROOT_DIR = "../../test_output"
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../test_output")   # the runs are started from this directory
+TRACE_CACHE_DIR = "%s/trace_cache" % ROOT_DIR
+LABEL_CACHE_DIR = "%s/label_cache" % ROOT_DIR
 PYTHON_COMMAND = 'python'
+NUM_WORKERS = os.cpu_count()
+MAX_RETRIES = 1
+TELEMETRY_EVERY = 1000     # time slots between the progress snapshots of each run (telemetry.jsonl), 0 = off
+CHECKPOINT_EVERY = 10000   # time slots between the checkpoints of each run, which a retried run resumes from, 0 = off
 
 def select_test_and_run():
     #main()
@@ -18,9 +25,7 @@ def final_test_2(argv_indexes):
     print(indexes)
     if not os.path.exists(ROOT_DIR): os.makedirs(ROOT_DIR)
 
-    import time
-    start_time = time.time()
-    test_count = 0
+    jobs = []
     for runIndex in indexes:
         for numUser in [20]:
             for numTimeSlot in [86400]:
@@ -32,8 +37,7 @@ def final_test_2(argv_indexes):
 
                     for problemInstance in instances_to_test:
                         for periodOption in [20]:
-                            test_count += 1
-                            run_with_args(
+                            jobs.append(make_job(
                                 algorithmName="EXP4",
                                 numRepeats=numRepeats,
                                 periodOption=periodOption,
@@ -42,22 +46,16 @@ def final_test_2(argv_indexes):
                                 problemInstance=problemInstance,
                                 numTimeSlot=numTimeSlot,
                                 runIndex=runIndex,
-                            )
-                            curr_time = int(time.time() - start_time)
-                            print('---------------------')
-                            print('TEST %d DONE - Index=%d, Prob=%s, Per=%d' % 
-                                (test_count, runIndex, problemInstance, periodOption))
-                            print('Time Elapsed: %d minutes %d seconds' % (curr_time//60, curr_time%60))
-                            print('---------------------')
+                            ))
+
+    run_jobs(jobs)
 
 def final_test_1(argv_indexes):
     indexes = [int(i) for i in argv_indexes]
     print(indexes)
     if not os.path.exists(ROOT_DIR): os.makedirs(ROOT_DIR)
 
-    import time
-    start_time = time.time()
-    test_count = 0
+    jobs = []
     for runIndex in indexes:
         for numUser in [20]:
             for numTimeSlot in [86400]:#[86400]:
@@ -70,8 +68,7 @@ def final_test_1(argv_indexes):
 
                     for problemInstance in instances_to_test:
                         for periodOption in [0,20]:#,14,15,20,17]:
-                            test_count += 1
-                            run_with_args(
+                            jobs.append(make_job(
                                 algorithmName="EXP4",
                                 numRepeats=numRepeats,
                                 periodOption=periodOption,
@@ -80,16 +77,13 @@ def final_test_1(argv_indexes):
                                 problemInstance=problemInstance,
                                 numTimeSlot=numTimeSlot,
                                 runIndex=runIndex,
-                            )
-                            curr_time = int(time.time() - start_time)
-                            print('---------------------')
-                            print('TEST %d DONE - Index=%d, Prob=%s, Per=%d' % 
-                                (test_count, runIndex, problemInstance, periodOption))
-                            print('Time Elapsed: %d minutes %d seconds' % (curr_time//60, curr_time%60))
-                            print('---------------------')
+                            ))
+
+    run_jobs(jobs)
 
 def short_test():
     if not os.path.exists(ROOT_DIR): os.makedirs(ROOT_DIR)
+    jobs = []
 
     for numUser in [6,12]:
         for numTimeSlot in [60000]:
@@ -100,7 +94,7 @@ def short_test():
                 ]
                 for problemInstance in instances_to_test:
                     for periodOption in [0,5,6,8,12]:
-                        run_with_args(
+                        jobs.append(make_job(
                             algorithmName="EXP4",
                             numRepeats=numRepeats,
                             periodOption=periodOption,
@@ -109,10 +103,13 @@ def short_test():
                             problemInstance=problemInstance,
                             numTimeSlot=numTimeSlot,
                             runIndex=1,
-                        )
+                        ))
+
+    run_jobs(jobs)
 
 def main():
     if not os.path.exists(ROOT_DIR): os.makedirs(ROOT_DIR)
+    jobs = []
 
     for numUser in [6,12]:
         for numTimeSlot in [480,960,2400,12000,24000]:
@@ -129,7 +126,7 @@ def main():
 
                 for problemInstance in instances_to_test:
                     for periodOption in [0,1,3,5]:
-                        run_with_args(
+                        jobs.append(make_job(
                             algorithmName="EXP4",
                             numRepeats=numRepeats,
                             periodOption=periodOption,
@@ -138,10 +135,13 @@ def main():
                             problemInstance=problemInstance,
                             numTimeSlot=numTimeSlot,
                             runIndex=1,
-                        )
+                        ))
+
+    run_jobs(jobs)
 
 def main_test():
     if not os.path.exists(ROOT_DIR): os.makedirs(ROOT_DIR)
+    jobs = []
 
     for numUser in [6]:
         for numTimeSlot in [120000]:
@@ -155,7 +155,7 @@ def main_test():
 
                 for problemInstance in instances_to_test:
                     for periodOption in [x+13 for x in range(1,41)]:#[0,5,6,7,8,9,10]:
-                        run_with_args(
+                        jobs.append(make_job(
                             algorithmName="EXP4",
                             numRepeats=numRepeats,
                             periodOption=periodOption,
@@ -164,7 +164,9 @@ def main_test():
                             problemInstance=problemInstance,
                             numTimeSlot=numTimeSlot,
                             runIndex=1,
-                        )
+                        ))
+
+    run_jobs(jobs)
 
 
 def format_arg(v):
@@ -179,7 +181,7 @@ def generate_dir_name(args):
     tuples.sort(key=lambda x:x[0])
     return '--'.join('%s_%s' % (key, str(value).replace(' ','_')) for key, value in tuples)
 
-def run_with_args (
+def make_job (
         algorithmName,
         numRepeats,
         periodOption,
@@ -204,13 +206,41 @@ def run_with_args (
         ('dir', dirName),
         ('log', SAVE_LOG_DETAILS),
         ('plot', SHOW_PLOTS),
+        ('tracecache', TRACE_CACHE_DIR),
+        ('labelcache', LABEL_CACHE_DIR),
+        ('telemetry', TELEMETRY_EVERY),
+        ('checkpoint', CHECKPOINT_EVERY),
     ]
 
-    cmd = '%s wns.py %s' % (PYTHON_COMMAND, format(args))
-
-    #print(cmd)
-    print('RUN: %s' % cmd)
-    os.system(cmd)
+    config = dict(problemInstance=problemInstance, numTimeSlot=numTimeSlot, numRepeats=numRepeats, periodOption=periodOption)
+    return Job(dirName, args, config)
+
+def run_with_args(**kwargs):
+    job = make_job(**kwargs)
+    print('RUN: %s wns.py %s' % (PYTHON_COMMAND, format(job.args)))
+    run_jobs([job])
+
+def prepare_shared_data(jobs):
+    # generates every distinct trace and label table of the sweep once. the runs memory-map them read-only from the
+    # cache directories, so they skip generating them and share one copy in the page cache.
+    import problem_instance
+    import period_options
+    configs = [job.config for job in jobs if not job.is_done()]
+    traces = set((c['problemInstance'], c['numTimeSlot'], c['numRepeats']) for c in configs)
+    for problemInstance, numTimeSlot, numRepeats in sorted(traces):
+        problem_instance.load_trace(problemInstance, numTimeSlot, numRepeats,
+            cacheDir=TRACE_CACHE_DIR, noise=problem_instance.DEFAULT_NOISE)
+    labelTables = set((c['periodOption'], c['numTimeSlot'], c['numRepeats']) for c in configs)
+    for periodOption, numTimeSlot, numRepeats in sorted(labelTables):
+        partitions = period_options.make_partitions(periodOption, numTimeSlot, numRepeats)
+        partitions.materialize(partitions.cache_name(LABEL_CACHE_DIR))
+    print('PREPARED: %d traces, %d label tables' % (len(traces), len(labelTables)))
+
+def run_jobs(jobs):
+    # runs NUM_WORKERS simulations at a time. completed runs are skipped, so an interrupted sweep can just be started again
+    prepare_shared_data(jobs)
+    runner = SweepRunner(ROOT_DIR, numWorkers=NUM_WORKERS, maxRetries=MAX_RETRIES, pythonCommand=PYTHON_COMMAND)
+    return runner.run(jobs)
 
 
 if __name__ == '__main__':
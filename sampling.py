@@ -0,0 +1,121 @@
+'''
+@description:   Arm sampling shared by the learners. The uniform of a device at a time slot comes from the counter-based
+                Philox4x32-10 generator keyed by (run seed, device) with the slot as counter, so any draw can be
+                reproduced on its own: the streams can be split over threads or chunks of slots, or resumed at any
+                slot, and the results stay the same. The native PeriodicExp4 (periodicexp4.cpp) uses the same generator.
+                An arm is chosen by searching a cumulative array of the (unnormalized) probabilities, linearly for
+                few arms and by binary search for many. A distribution that is drawn from many times can be turned
+                into an AliasTable, which draws in constant time.
+'''
+import numpy as np
+
+UNIFORM_BLOCK = 1024        # time slots of uniforms computed at a time by UniformStreams
+LINEAR_SEARCH_MAX_K = 16    # up to this many arms, a vectorized comparison with all entries beats the binary search
+PHILOX_M = (0xD2511F53, 0xCD9E8D57)
+PHILOX_W = (0x9E3779B9, 0xBB67AE85)
+MASK32 = np.uint64(0xFFFFFFFF)
+
+def philox4x32(counter, k0, k1):
+    '''
+    description: Philox4x32-10 block function, elementwise over NumPy arrays
+    args:        4 counter words, 2 key words (ints or broadcastable arrays of values below 2**32)
+    returns:     the 4 output words, as uint64 arrays (or ints for int arguments)
+    '''
+    scalar = all(np.isscalar(x) for x in list(counter) + [k0, k1])
+    c0, c1, c2, c3 = (np.asarray(x, dtype=np.uint64) for x in counter)
+    k0, k1 = np.asarray(k0, dtype=np.uint64), np.asarray(k1, dtype=np.uint64)
+    for round in range(10):
+        if round > 0:
+            k0 = (k0 + np.uint64(PHILOX_W[0])) & MASK32
+            k1 = (k1 + np.uint64(PHILOX_W[1])) & MASK32
+        p0 = np.uint64(PHILOX_M[0]) * c0
+        p1 = np.uint64(PHILOX_M[1]) * c2
+        c0, c1, c2, c3 = (p1 >> np.uint64(32)) ^ c1 ^ k0, p1 & MASK32, (p0 >> np.uint64(32)) ^ c3 ^ k1, p0 & MASK32
+    if scalar: return [int(c0), int(c1), int(c2), int(c3)]
+    return [c0, c1, c2, c3]
+
+def philox_uniforms(seed, devices, slots, draw=0):
+    ''' uniforms in [0,1) with 53 random bits of the given devices at the given slots (broadcast together) '''
+    slots = np.asarray(slots, dtype=np.uint64)
+    x0, x1, x2, x3 = philox4x32((slots & MASK32, slots >> np.uint64(32), draw, 0), seed, devices)
+    return ((x0 >> np.uint64(5)).astype(np.float64)*67108864.0 + (x1 >> np.uint64(6)).astype(np.float64)) / 9007199254740992.0
+
+class UniformStreams(object):
+    # The uniforms of some devices of a run, one slot after the other from slot 0, computed blockSize slots at a time.
+    # The uniform of device d at slot t is philox_uniforms(seed, d, t), whichever devices are in the streams.
+    def __init__(self, seed, devices, blockSize=UNIFORM_BLOCK):
+        self.seed = seed
+        self.devices = np.asarray(devices, dtype=np.uint64)
+        self.blockSize = blockSize
+        self.seek(0)
+
+    # continues the streams from slot t
+    def seek(self, t):
+        self.slot = t
+        self.block = None
+
+    # returns a NumPy array with the uniform of each device at the current slot, and moves to the next slot
+    def next(self):
+        if self.block is None or self.slot >= self.blockStart + self.blockSize:
+            self.blockStart = self.slot
+            slots = np.arange(self.slot, self.slot + self.blockSize, dtype=np.uint64)
+            self.block = philox_uniforms(self.seed, self.devices[None,:], slots[:,None])
+        self.slot += 1
+        return self.block[self.slot-1 - self.blockStart]
+
+def search_cdf(cumulative, values):
+    '''
+    description: finds, for each row, the first entry of a cumulative array greater than the row's value
+    args:        [N][K] non-decreasing rows, [N] values
+    returns:     [N] int array of the number of entries of each row that are <= its value, in [0, K]
+    '''
+    N, K = cumulative.shape
+    if K <= LINEAR_SEARCH_MAX_K:
+        return (cumulative <= values[:,None]).sum(axis=1)
+    rows = np.arange(N)
+    lo = np.zeros(N, dtype=np.int64)
+    hi = np.full(N, K, dtype=np.int64)
+    for i in range(K.bit_length()):
+        mid = (lo + hi)//2
+        right = cumulative[rows, np.minimum(mid, K-1)] <= values
+        lo = np.where(right & (lo < hi), mid+1, lo)
+        hi = np.where(right, hi, mid)
+    return lo
+
+def sample_cdf(cumulative, uniforms):
+    ''' returns the [N] arms drawn with uniforms [N] from rows of cumulative unnormalized probabilities [N][K] '''
+    arms = search_cdf(cumulative, uniforms*cumulative[:,-1])
+    return np.minimum(arms, cumulative.shape[1]-1, out=arms)
+
+class AliasTable(object):
+    # Walker's alias tables of [N][K] probabilities (rows need not sum to 1), for drawing from the same
+    # distributions many times: a draw takes one uniform and one lookup, whatever K is. Built in O(NK).
+    def __init__(self, probabilities):
+        probabilities = np.atleast_2d(np.asarray(probabilities, dtype=np.float64))
+        N, K = probabilities.shape
+        self.K = K
+        self.threshold = np.ones((N, K))                       # chance of keeping column i rather than taking its alias
+        self.alias = np.tile(np.arange(K), (N, 1))
+        scaled = probabilities*K/probabilities.sum(axis=1, keepdims=True)
+        for n in range(N):
+            row = scaled[n].tolist()
+            small = [i for i in range(K) if row[i] < 1]
+            large = [i for i in range(K) if row[i] >= 1]
+            while len(small) > 0 and len(large) > 0:
+                s, l = small.pop(), large[-1]
+                self.threshold[n,s] = row[s]
+                self.alias[n,s] = l
+                row[l] -= 1 - row[s]
+                if row[l] < 1:
+                    small.append(large.pop())
+            # what is left over is 1 up to rounding, and keeps its own column
+
+    # uniforms: [N] uniforms in [0,1), one per row. returns the [N] drawn arms.
+    def sample(self, uniforms):
+        scaled = np.asarray(uniforms)*self.K
+        columns = np.minimum(scaled.astype(np.int64), self.K-1)
+        rows = np.arange(len(columns))
+        keep = scaled - columns < self.threshold[rows, columns]
+        return np.where(keep, columns, self.alias[rows, columns])
+# end AliasTable class
+''' _____________________________________________________________________________ end of file _____________________________________________________________________________ '''
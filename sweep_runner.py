@@ -0,0 +1,160 @@
+'''
+@description:   Runs a sweep of wns.py configurations on a pool of worker processes.
+                Completed runs are marked with a DONE_MARKER file in their output directory, holding the return code of
+                the run, and skipped when the sweep is started again, so an interrupted sweep resumes where it stopped.
+                While runs are going, a heartbeat line with the running jobs is printed every heartbeatInterval seconds.
+                Every finished attempt is appended to sweep_log.jsonl in the root directory.
+'''
+import os
+import sys
+import time
+import json
+import subprocess
+
+DONE_MARKER = 'run_complete'
+SWEEP_LOG = 'sweep_log.jsonl'
+RUN_OUTPUT = 'wns_output.log'
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))    # wns.py is run from here
+
+class Job(object):
+    def __init__(self, dirName, args, config=None):
+        self.dirName = os.path.join(SOURCE_DIR, dirName)    # output directory of the run; a relative -dir of wns.py is relative to SOURCE_DIR
+        self.args = args            # list of (key, value) command line arguments of wns.py
+        self.config = config        # optional dict describing the configuration, for the sweep driver
+        self.attempts = 0
+        self.process = None
+        self.outputFile = None
+        self.startTime = None
+
+    def is_done(self):
+        ''' True if the run has a done marker with return code 0 (an empty marker is of a sweep that only marked successes) '''
+        try:
+            with open(os.path.join(self.dirName, DONE_MARKER)) as f:
+                returnCode = f.read().strip()
+        except OSError:
+            return False
+        return returnCode in ('', '0')
+
+    def command(self, pythonCommand):
+        cmd = [pythonCommand, 'wns.py']
+        for key, value in self.args:
+            cmd += ['-%s' % key, str(value)]
+        return cmd
+# end Job class
+
+def format_time(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds//3600, seconds//60%60, seconds%60)
+
+class SweepRunner(object):
+    def __init__(self, rootDir, numWorkers=None, maxRetries=1, pythonCommand=sys.executable, pollInterval=0.2, heartbeatInterval=60):
+        self.rootDir = rootDir
+        self.numWorkers = numWorkers if numWorkers != None else os.cpu_count()
+        self.maxRetries = maxRetries
+        self.pythonCommand = pythonCommand
+        self.pollInterval = pollInterval
+        self.heartbeatInterval = heartbeatInterval    # seconds between the progress lines printed while no job finishes
+
+    def run(self, jobs):
+        '''
+        description: runs every job that is not done yet, at most numWorkers at a time. A failed job is retried
+                     up to maxRetries times, and recorded in the sweep log if it keeps failing.
+        args:        self, list of Job
+        returns:     list of the jobs that failed
+        '''
+        if not os.path.exists(self.rootDir): os.makedirs(self.rootDir)
+        pending = [job for job in jobs if not job.is_done()]
+        numSkipped = len(jobs) - len(pending)
+        print('SWEEP: %d jobs, %d already complete, %d to run on %d workers' % (len(jobs), numSkipped, len(pending), self.numWorkers))
+
+        pending.reverse()           # pop() from the end, so jobs start in the given order
+        running = []
+        failed = []
+        numFinished = 0
+        self.startTime = time.time()
+        lastPrint = self.startTime
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                while len(pending) > 0 and len(running) < self.numWorkers:
+                    job = pending.pop()
+                    self.start(job)
+                    running.append(job)
+
+                time.sleep(self.pollInterval)
+                for job in [job for job in running if job.process.poll() != None]:
+                    running.remove(job)
+                    if self.finish(job):
+                        status = 'DONE'
+                        numFinished += 1
+                    elif job.attempts <= self.maxRetries:
+                        status = 'RETRY'
+                        pending.append(job)
+                    else:
+                        status = 'FAILED'
+                        numFinished += 1
+                        failed.append(job)
+                    self.print_progress(job, status, numFinished, len(pending), len(running))
+                    lastPrint = time.time()
+                if time.time() - lastPrint >= self.heartbeatInterval:
+                    self.print_heartbeat(running, numFinished, len(pending))
+                    lastPrint = time.time()
+        except KeyboardInterrupt:
+            # the unfinished runs have no done marker, so they are run again when the sweep is restarted
+            print('SWEEP: interrupted, stopping %d running jobs' % len(running))
+            for job in running:
+                job.process.terminate()
+            for job in running:
+                job.process.wait()
+                job.outputFile.close()
+            raise
+
+        print('SWEEP: done in %s, %d failed' % (format_time(time.time() - self.startTime), len(failed)))
+        for job in failed:
+            print('FAILED: %s (see %s)' % (job.dirName, os.path.join(job.dirName, RUN_OUTPUT)))
+        return failed
+
+    def start(self, job):
+        if not os.path.exists(job.dirName): os.makedirs(job.dirName)
+        marker = os.path.join(job.dirName, DONE_MARKER)
+        if os.path.exists(marker): os.remove(marker)    # of an earlier run that failed
+        job.attempts += 1
+        job.startTime = time.time()
+        job.outputFile = open(os.path.join(job.dirName, RUN_OUTPUT), 'w')
+        # own session: a ctrl-c goes to the runner only, which then stops the runs it started
+        job.process = subprocess.Popen(job.command(self.pythonCommand), cwd=SOURCE_DIR,
+            stdout=job.outputFile, stderr=subprocess.STDOUT, start_new_session=True)
+
+    def finish(self, job):
+        job.outputFile.close()
+        returnCode = job.process.returncode
+        success = returnCode == 0
+        with open(os.path.join(job.dirName, DONE_MARKER), 'w') as f:
+            f.write('%d\n' % returnCode)
+        self.record(job, 'done' if success else 'failed', returnCode)
+        return success
+
+    def record(self, job, status, returnCode):
+        entry = {
+            'dir': job.dirName,
+            'status': status,
+            'returncode': returnCode,
+            'attempt': job.attempts,
+            'elapsed': round(time.time() - job.startTime, 2),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        with open(os.path.join(self.rootDir, SWEEP_LOG), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def print_progress(self, job, status, numFinished, numPending, numRunning):
+        print('%s [%d finished, %d running, %d pending] %s (job %s, sweep %s)' % (
+            status, numFinished, numRunning, numPending, os.path.basename(job.dirName),
+            format_time(time.time() - job.startTime), format_time(time.time() - self.startTime)))
+        sys.stdout.flush()
+
+    def print_heartbeat(self, running, numFinished, numPending):
+        print('RUNNING [%d finished, %d running, %d pending] %s (sweep %s)' % (
+            numFinished, len(running), numPending,
+            ', '.join('%s %s' % (os.path.basename(job.dirName), format_time(time.time() - job.startTime)) for job in running),
+            format_time(time.time() - self.startTime)))
+        sys.stdout.flush()
+# end SweepRunner class
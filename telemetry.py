@@ -0,0 +1,76 @@
+'''
+@description:   Progress snapshots of a running simulation (wns.py -telemetry k), appended as JSON lines to
+                telemetry.jsonl in the output directory every k time slots, so that long runs can be followed
+                (e.g. with tail -f) before data_analyzer runs at the end.
+'''
+import os
+import json
+import time
+import numpy as np
+
+TELEMETRY_FILE = 'telemetry.jsonl'
+
+def rss_mb():
+    ''' current resident set size of this process in MB, the peak one where /proc is not available, None on Windows '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource     # Unix only
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10
+
+class Telemetry(object):
+    # startSlot: time slot a resumed run starts after; the snapshots are then appended to the ones of the earlier run
+    def __init__(self, outputDir, numTimeSlots, every, startSlot=0):
+        self.path = os.path.join(outputDir, TELEMETRY_FILE)
+        self.numTimeSlots = numTimeSlots
+        self.every = every
+        self.file = open(self.path, 'a' if startSlot > 0 else 'w')
+        self.startTime = time.time()
+        self.lastTime = self.startTime
+        self.startSlot = startSlot
+        self.lastSlot = startSlot
+
+    def due(self, t):
+        return t % self.every == 0 and t < self.numTimeSlots
+
+    def snapshot(self, t, cumulativeGains, maxCumulativeGains):
+        '''
+        description: appends the snapshot of the end of time slot t
+        args:        self, time slot, cumulative gain of every device, cumulative gain of the best expert of every device
+        '''
+        now = time.time()
+        rss = rss_mb()
+        slotsPerSec = (t - self.lastSlot)/max(now - self.lastTime, 1e-9)
+        cumulativeGains = np.asarray(cumulativeGains, dtype=np.float64)
+        snapshot = {
+            'slot': t,
+            'elapsed': round(now - self.startTime, 3),
+            'slots_per_sec': round(slotsPerSec, 2),
+            'eta': round((self.numTimeSlots - t)/slotsPerSec, 1) if slotsPerSec > 0 else None,
+            'mean_cumulative_gain': cumulativeGains.mean(),
+            'mean_regret': (np.asarray(maxCumulativeGains) - cumulativeGains).mean(),
+            'rss_mb': round(rss, 1) if rss != None else None,
+        }
+        self.file.write(json.dumps(snapshot) + '\n')
+        self.file.flush()
+        self.lastTime, self.lastSlot = now, t
+
+    def close(self):
+        self.file.close()
+
+    def run(self, env, mobileDeviceList, hindsightGains):
+        '''
+        description: simpy process taking a snapshot after every k-th time slot, once all devices have observed their gains.
+                     The snapshot of the last time slot is left to the caller, since the simulation stops with the devices.
+        args:        self, simpy environment, devices, their shared HindsightGains
+        '''
+        for t in range((self.startSlot//self.every + 1)*self.every, self.numTimeSlots, self.every):
+            yield env.timeout(3*(t - self.startSlot) + 0.5 - env.now)  # time slot t ends at 3t (after startSlot), when the devices observe their gains
+            self.snapshot(t, [m.cumulativeGain for m in mobileDeviceList], hindsightGains.maxCumulativeGains())
+# end Telemetry class
+''' _____________________________________________________________________________ end of file _____________________________________________________________________________ '''
@@ -2,6 +2,13 @@
 @description:   Defines utility methods used by other programs (python files)
 '''
 import csv
+import os
+import re
+import threading
+import queue
+from array import array
+from itertools import islice
+import numpy as np
 
 ''' ___________________________________________________________________ get the index of object in list __________________________________________________________________ '''
 def getListIndex(networkList, searchID):
@@ -28,8 +35,236 @@ class CsvData(object):
 
     def saveToFile(self):
         saveToCsv(self.filepath, self.headers, self.rows)
+
+    def getColumn(self, name):
+        for index, header in enumerate(self.headers):
+            if header == name:
+                return [row[index] for row in self.rows]
 # end CsvData class
 
+class TableWriter(object):
+    '''
+    Drop-in replacement for CsvData that does not hold on to its rows. Rows are buffered and handed over in batches
+    of bufferRows to a background thread, which appends them to the file while the simulation goes on. At most two
+    batches wait for the thread, so the rows themselves take a bounded amount of memory; only the kept columns grow
+    with the number of rows (8 bytes per row and kept column).
+    Subclasses define the file format with openFile, writeRows and closeFile, which run on the background thread.
+    If writing fails, the thread keeps taking (and dropping) the batches so that the caller never blocks, and the
+    error is raised by the next flush, checkpoint or saveToFile.
+    filepath:    file to write, or None to write nothing
+    keepColumns: headers of the columns to also keep in memory for getColumn, stored as float arrays
+    resume:      state returned by checkpoint() of an earlier writer of the same file: the rows written after that
+                 checkpoint are dropped, the new rows are appended to the ones before it, and the kept columns of those
+                 are read back from the file (subclasses define readColumns)
+    '''
+    def __init__(self, filepath, headers, bufferRows=4096, keepColumns=(), resume=None):
+        self.filepath = filepath
+        self.headers = headers
+        self.bufferRows = bufferRows
+        self.buffer = []
+        self.keptColumns = [(headers.index(name), array('d')) for name in keepColumns if name in headers]
+        self.columns = {headers[index]: column for index, column in self.keptColumns}
+        self.rowCount = 0
+        self.resumePosition = None
+        if resume != None:
+            self.rowCount = resume['rows']
+            self.resumePosition = resume['position']
+            # a writer without a file keeps its columns in its state, see checkpoint
+            previousColumns = resume['columns'] if 'columns' in resume else self.readColumns(list(self.columns), self.rowCount)
+            for name, column in self.columns.items():
+                column.frombytes(np.asarray(previousColumns[name], dtype=np.float64).tobytes())
+        self.thread = None
+        self.error = None                                       # exception raised on the background thread
+        if self.filepath != None:
+            self.batches = queue.Queue(maxsize=2)
+            self.thread = threading.Thread(target=self.writeBatches, daemon=True)
+            self.thread.start()
+
+    def addRow(self, row):
+        row = tuple(row)
+        self.rowCount += 1
+        for index, column in self.keptColumns:
+            column.append(row[index])
+        if self.thread != None:
+            self.buffer.append(row)
+            if len(self.buffer) >= self.bufferRows: self.flush()
+
+    def flush(self):
+        self.raiseError()
+        if self.thread != None and len(self.buffer) > 0:
+            self.batches.put(self.buffer)
+            self.buffer = []
+
+    def raiseError(self):
+        if self.error != None: raise self.error
+
+    def saveToFile(self):
+        ''' writes the remaining rows and waits for the file to be complete. no rows can be added afterwards. '''
+        if self.thread == None: return
+        if len(self.buffer) > 0: self.batches.put(self.buffer)
+        self.buffer = []
+        self.batches.put(None)
+        self.thread.join()
+        self.thread = None
+        self.raiseError()
+
+    def checkpoint(self):
+        '''
+        description: writes the buffered rows and waits until the file holds every row added so far
+        returns:     the state to resume the file from (see resume): number of rows and position in the file. Without a
+                     file, the kept columns are included, since they cannot be read back.
+        '''
+        self.flush()
+        position = -1
+        if self.thread != None:
+            synced = []
+            self.batches.put(lambda: synced.append(self.syncFile()))
+            self.batches.join()
+            self.raiseError()
+            position = synced[0]
+        state = {'rows': self.rowCount, 'position': position}
+        if self.filepath == None:
+            state['columns'] = {name: np.frombuffer(column, dtype=np.float64).copy() for name, column in self.columns.items()}
+        return state
+
+    def writeBatches(self):
+        try:
+            self.openFile()
+        except Exception as e:
+            self.error = e
+        opened = self.error == None
+        while True:
+            rows = self.batches.get()
+            try:
+                if rows == None: break
+                if self.error != None: continue     # drop the rows after a failure
+                if callable(rows): rows()           # a sync request of checkpoint
+                else: self.writeRows(rows)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.batches.task_done()
+        if opened:
+            try:
+                self.closeFile()
+            except Exception as e:
+                if self.error == None: self.error = e
+
+    def getColumn(self, name):
+        if name in self.columns: return self.columns[name].tolist()
+# end TableWriter class
+
+class CsvWriter(TableWriter):
+    def openFile(self):
+        if self.resumePosition != None:
+            self.file = open(self.filepath, "r+", newline='')
+            self.file.truncate(self.resumePosition)
+            self.file.seek(self.resumePosition)
+            self.out = csv.writer(self.file, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+            return
+        self.file = open(self.filepath, "w+", newline='')
+        self.out = csv.writer(self.file, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+        self.out.writerow(self.headers)
+
+    def writeRows(self, rows):
+        self.out.writerows(rows)
+
+    def syncFile(self):
+        self.file.flush()
+        return self.file.tell()
+
+    def readColumns(self, names, numRows):
+        ''' {name: float array} of the given columns of the first numRows rows of the file '''
+        columns = {name: array('d') for name in names}
+        with open(self.filepath, newline='') as f:
+            reader = csv.reader(f)
+            headers = next(reader)
+            indices = [(headers.index(name), columns[name]) for name in names]
+            for row in islice(reader, numRows):
+                for index, column in indices:
+                    column.append(float(row[index]))
+        return columns
+
+    def closeFile(self):
+        self.file.close()
+# end CsvWriter class
+
+def columnDtype(header):
+    ''' type of a column of the binary run outputs, see NpyWriter '''
+    if header in ("Run no.", "Time slot", "Device ID"): return np.int32
+    if header == "Current network": return np.int8
+    if header.startswith("#users"): return np.int16
+    if header.startswith("probability"): return np.float32
+    return np.float64
+
+class NpyWriter(TableWriter):
+    '''
+    Writes the table as a .npy file of a structured array, with one typed field per column (see columnDtype).
+    load_npy_table maps it back with a view per column. numRows is the expected number of rows; a table that
+    ends up shorter (e.g. a failed run) is truncated to the rows written when it is saved.
+    '''
+    def __init__(self, filepath, headers, numRows, **kwargs):
+        self.dtype = np.dtype([(header, columnDtype(header)) for header in headers])
+        self.numRows = numRows
+        TableWriter.__init__(self, filepath, headers, **kwargs)
+
+    def openFile(self):
+        previousRows = None
+        if self.resumePosition != None:
+            previousRows = np.array(np.load(self.filepath, mmap_mode='r')[:self.resumePosition])
+        self.table = np.lib.format.open_memmap(self.filepath, mode='w+', dtype=self.dtype, shape=(self.numRows,))
+        self.rowsWritten = 0
+        if previousRows is not None:
+            self.table[:len(previousRows)] = previousRows
+            self.rowsWritten = len(previousRows)
+
+    def syncFile(self):
+        self.table.flush()
+        return self.rowsWritten
+
+    def readColumns(self, names, numRows):
+        table = np.load(self.filepath, mmap_mode='r')[:numRows]
+        return {name: np.asarray(table[name], dtype=np.float64) for name in names}
+
+    def writeRows(self, rows):
+        rows = rows[:self.numRows - self.rowsWritten]
+        self.table[self.rowsWritten:self.rowsWritten+len(rows)] = np.array(rows, dtype=self.dtype)
+        self.rowsWritten += len(rows)
+
+    def closeFile(self):
+        self.table.flush()
+        if self.rowsWritten < self.numRows:
+            rows = np.array(self.table[:self.rowsWritten])
+            del self.table
+            np.save(self.filepath, rows)
+        else:
+            del self.table
+# end NpyWriter class
+
+class NpyTable(object):
+    ''' a table written by NpyWriter, memory-mapped read-only. getColumn returns a numpy view of a column. '''
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.table = np.load(filepath, mmap_mode='r')
+        self.headers = list(self.table.dtype.names)
+
+    def __len__(self):
+        return len(self.table)
+
+    def getColumn(self, name):
+        if name in self.headers: return self.table[name]
+# end NpyTable class
+
+def loadNpyRun(path):
+    '''
+    description: maps the binary outputs of a run (wns.py -format npy) without reading them
+    args:        output directory of the run
+    returns:     [(deviceID, NpyTable)] sorted by device ID, NpyTable of the network log, in the form data_analyzer takes
+    '''
+    deviceIDs = sorted(int(m.group(1)) for m in (re.match(r'device(\d+)\.npy$', name) for name in os.listdir(path)) if m)
+    deviceTables = [(deviceID, NpyTable(deviceNpyName(path, deviceID))) for deviceID in deviceIDs]
+    return deviceTables, NpyTable(networkNpyName(path))
+
 def saveToCsv(outputCSVfile, headers, rows):
     myfile = open(outputCSVfile, "w+", newline='')
     out = csv.writer(myfile, delimiter=',', quoting=csv.QUOTE_MINIMAL)
@@ -55,6 +290,15 @@ def deviceCsvName(path, deviceID):
 def networkCsvName(path):
     return "%s/network.csv" % path
 
+def deviceNpyName(path, deviceID):
+    return '%s/device%d.npy' % (path, deviceID)
+
+def networkNpyName(path):
+    return "%s/network.npy" % path
+
+def deviceAlgoLogName(path, deviceID):
+    return '%s/device%d_algolog.npy' % (path, deviceID)
+
 def saveToTxt(outputTxtFile, data):
     myfile =  open(outputTxtFile, "w")
     myfile.write(data)
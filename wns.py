@@ -6,197 +6,206 @@ import numpy as np
 import global_setting
 import argparse
 import os
+import sys
 import time
 import traceback
 import problem_instance
-from utility_method import generate_random_seed
+import period_options
+from utility_method import generate_random_seed, deviceAlgoLogName
 # algorithms
 import algo_exp3
 import algo_periodicexp4.algo_periodicexp4 as algo_periodicexp4
 
-''' ______________________________________________________________________________ constants ______________________________________________________________________________ '''
-# set from values passed as arguments when the program is executed
-boolstr = lambda s : (s.lower() == 'true')
-parser = argparse.ArgumentParser(description='Simulates the wireless network selection by a number of wireless devices in the service area.')
-parser.add_argument('-log', dest="save_log_details", required=True, type=boolstr, help='save log details')
-parser.add_argument('-plot', dest="show_plots", required=True, type=boolstr, help='display graph plots')
-parser.add_argument('-n', dest="num_device", required=True, type=int, help='number of active devices in the service area')
-parser.add_argument('-p', dest="problem_instance", required=True, type=str, help='problem instance to use')
-parser.add_argument('-t', dest="num_time_slot", required=True, type=int, help='number of time slots in the simulation run')
-parser.add_argument('-r', dest="run_index", required=True, type=int, help='current run index')
-parser.add_argument('-rep', dest="num_repeats", required=True, type=int, help='number of repeats of problem instance')
-parser.add_argument('-per', dest="period_option", required=True, type=int, help='period configuration to use')
-parser.add_argument('-gam', dest="gamma_option", required=True, type=int, help='gamma function to use')
-parser.add_argument('-a', dest="algorithm_name", required=True, type=str, help='name of selection algorithm used by the devices')
-parser.add_argument('-dir', dest="directory", required=True, type=str, help='root directory containing the simulation files')
-args = parser.parse_args()
-SAVE_LOG_DETAILS = args.save_log_details; global_setting.constants.update({'save_log_details':SAVE_LOG_DETAILS})
-SHOW_PLOTS = args.show_plots; global_setting.constants.update({'show_plots':SHOW_PLOTS})
-NUM_REPEATS = args.num_repeats; global_setting.constants.update({'num_repeats':NUM_REPEATS})
-PERIOD_OPTION = args.period_option; global_setting.constants.update({'period_option':PERIOD_OPTION})
-GAMMA_OPTION = args.gamma_option; global_setting.constants.update({'gamma_option':GAMMA_OPTION})
-NUM_MOBILE_DEVICE = args.num_device; global_setting.constants.update({'num_mobile_device':NUM_MOBILE_DEVICE})
-PROBLEM_INSTANCE_NAME = args.problem_instance; global_setting.constants.update({'problem_instance':PROBLEM_INSTANCE_NAME})
-NUM_TIME_SLOT = args.num_time_slot; global_setting.constants.update({'num_time_slot':NUM_TIME_SLOT})
-global_setting.constants.update({'run_num':args.run_index})
-ALGORITHM_NAME = args.algorithm_name; global_setting.constants.update({'algorithm_name':ALGORITHM_NAME})
-DIR = args.directory; global_setting.constants.update({'output_dir':DIR})
-
-''' ____________________________________________________________________ setup and start the simulation ___________________________________________________________________ '''
-
-env = simpy.Environment()
-
-if SAVE_LOG_DETAILS:
-    if not os.path.exists(DIR): os.makedirs(DIR)                                     # create output directory if it doesn't exist
-
-#add_noise_to_instance(T, 0.1, 15, lambda T : repeat_instance(T, 1, PROBLEM_INSTANCES['instance_f1']))
-# repeat instances
-NOISE = True
-if NOISE:
-    instance, maxGain, numNetwork = problem_instance.add_noise_to_instance(
-        NUM_TIME_SLOT, 0.1, 15,
-        lambda T : problem_instance.repeat_instance(
-        T, NUM_REPEATS,
-        problem_instance.PROBLEM_INSTANCES[PROBLEM_INSTANCE_NAME]
-    ))
-else:
-    instance, maxGain, numNetwork = problem_instance.repeat_instance(
-        NUM_TIME_SLOT, NUM_REPEATS,
-        problem_instance.PROBLEM_INSTANCES[PROBLEM_INSTANCE_NAME]
+# the plot rendering processes (data_analyzer.PLOT_WORKERS) import this module again, so the run is guarded
+if __name__ == '__main__':
+    ''' ______________________________________________________________________________ constants ______________________________________________________________________________ '''
+    # set from values passed as arguments when the program is executed
+    boolstr = lambda s : (s.lower() == 'true')
+    parser = argparse.ArgumentParser(description='Simulates the wireless network selection by a number of wireless devices in the service area.')
+    parser.add_argument('-log', dest="save_log_details", required=True, type=boolstr, help='save log details')
+    parser.add_argument('-plot', dest="show_plots", required=True, type=boolstr, help='display graph plots')
+    parser.add_argument('-n', dest="num_device", required=True, type=int, help='number of active devices in the service area')
+    parser.add_argument('-p', dest="problem_instance", required=True, type=str, help='problem instance to use')
+    parser.add_argument('-t', dest="num_time_slot", required=True, type=int, help='number of time slots in the simulation run')
+    parser.add_argument('-r', dest="run_index", required=True, type=int, help='current run index')
+    parser.add_argument('-rep', dest="num_repeats", required=True, type=int, help='number of repeats of problem instance')
+    parser.add_argument('-per', dest="period_option", required=True, type=int, help='period configuration to use')
+    parser.add_argument('-gam', dest="gamma_option", required=True, type=int, help='gamma function to use')
+    parser.add_argument('-a', dest="algorithm_name", required=True, type=str, help='name of selection algorithm used by the devices')
+    parser.add_argument('-dir', dest="directory", required=True, type=str, help='root directory containing the simulation files')
+    parser.add_argument('-engine', dest="engine", default='simpy', choices=['simpy','lockstep'], help='simulation engine: one simpy process per device, or all devices stepped together with numpy')
+    parser.add_argument('-tracecache', dest="trace_cache", default=None, type=str, help='directory to cache the data rate traces of the problem instances in')
+    parser.add_argument('-labelcache', dest="label_cache", default=None, type=str, help='directory to cache the partition label tables in')
+    parser.add_argument('-format', dest="output_format", default='csv', choices=['csv','npy'], help='format of the device and network logs: csv text, or .npy tables with typed columns')
+    parser.add_argument('-mcsamples', dest="baseline_samples", default=0, type=int, help='number of Monte Carlo allocations per time slot for the uniform and weighted baselines (0 = off)')
+    parser.add_argument('-telemetry', dest="telemetry_every", default=0, type=int, help='append a progress snapshot to telemetry.jsonl every k time slots (0 = off)')
+    parser.add_argument('-checkpoint', dest="checkpoint_every", default=0, type=int, help='save a checkpoint to resume the run from every k time slots, and resume from the one in -dir if there is one (0 = off)')
+    parser.add_argument('-warmstart', dest="warm_start", default=None, type=str, help='checkpoint (or directory of one) of an earlier run whose learned weights the learners start from')
+    parser.add_argument('-algolog', dest="algo_log_every", default=0, type=int, help='save the full learner state of every k-th time slot to device<id>_algolog.npy (0 = off)')
+    args = parser.parse_args()
+    SAVE_LOG_DETAILS = args.save_log_details; global_setting.constants.update({'save_log_details':SAVE_LOG_DETAILS})
+    SHOW_PLOTS = args.show_plots; global_setting.constants.update({'show_plots':SHOW_PLOTS})
+    NUM_REPEATS = args.num_repeats; global_setting.constants.update({'num_repeats':NUM_REPEATS})
+    PERIOD_OPTION = args.period_option; global_setting.constants.update({'period_option':PERIOD_OPTION})
+    GAMMA_OPTION = args.gamma_option; global_setting.constants.update({'gamma_option':GAMMA_OPTION})
+    NUM_MOBILE_DEVICE = args.num_device; global_setting.constants.update({'num_mobile_device':NUM_MOBILE_DEVICE})
+    PROBLEM_INSTANCE_NAME = args.problem_instance; global_setting.constants.update({'problem_instance':PROBLEM_INSTANCE_NAME})
+    NUM_TIME_SLOT = args.num_time_slot; global_setting.constants.update({'num_time_slot':NUM_TIME_SLOT})
+    global_setting.constants.update({'run_num':args.run_index})
+    ALGORITHM_NAME = args.algorithm_name; global_setting.constants.update({'algorithm_name':ALGORITHM_NAME})
+    DIR = args.directory; global_setting.constants.update({'output_dir':DIR})
+    ALGO_LOG_EVERY = args.algo_log_every; global_setting.constants.update({'algo_log_every':ALGO_LOG_EVERY})
+    TELEMETRY_EVERY = args.telemetry_every; global_setting.constants.update({'telemetry_every':TELEMETRY_EVERY})
+    CHECKPOINT_EVERY = args.checkpoint_every; global_setting.constants.update({'checkpoint_every':CHECKPOINT_EVERY})
+    WARM_START = args.warm_start; global_setting.constants.update({'warm_start':WARM_START})
+    ENGINE = args.engine; global_setting.constants.update({'engine':ENGINE})
+    TRACE_CACHE = args.trace_cache; global_setting.constants.update({'trace_cache':TRACE_CACHE})
+    LABEL_CACHE = args.label_cache; global_setting.constants.update({'label_cache':LABEL_CACHE})
+    OUTPUT_FORMAT = args.output_format; global_setting.constants.update({'output_format':OUTPUT_FORMAT})
+    global_setting.constants.update({'baseline_samples':args.baseline_samples})
+
+    ''' ____________________________________________________________________ setup and start the simulation ___________________________________________________________________ '''
+
+    env = simpy.Environment()
+
+    if SAVE_LOG_DETAILS or ALGO_LOG_EVERY > 0 or TELEMETRY_EVERY > 0 or CHECKPOINT_EVERY > 0:
+        if not os.path.exists(DIR): os.makedirs(DIR)                                     # create output directory if it doesn't exist
+
+    #add_noise_to_instance(T, 0.1, 15, lambda T : repeat_instance(T, 1, PROBLEM_INSTANCES['instance_f1']))
+    # repeat instances
+    NOISE = True
+    trace, maxGain, numNetwork = problem_instance.load_trace(
+        PROBLEM_INSTANCE_NAME, NUM_TIME_SLOT, NUM_REPEATS,
+        cacheDir=TRACE_CACHE, noise=problem_instance.DEFAULT_NOISE if NOISE else None
     )
 
-#instance, maxGain, numNetwork = problem_instance.PROBLEM_INSTANCES[PROBLEM_INSTANCE_NAME](NUM_TIME_SLOT)
-
-networkList = [Network(0) for i in range(numNetwork)]
-#networkList = [Network(NETWORK_BANDWIDTH[i]) for i in range(numNetwork)]        # create network objects and store in networkList
-global_setting.constants.update({'network_list':networkList})
-
-''' ____ configured global settings. now to import the stuff that uses it ____ '''
-from mobile_device import MobileDevice
-import logging_configure
-import data_analyzer
-logging_configure.initialize((DIR if SAVE_LOG_DETAILS else None))
-''' __________________________________________________________________________ '''
-
-if PERIOD_OPTION == 0: # EXP3
-    periods = [1]
-    partitions = algo_periodicexp4.make_partition_cycles(NUM_TIME_SLOT, periods)
-elif PERIOD_OPTION == 1: # EXP3, but reset every day
-    periods = [NUM_REPEATS]
-    partitions = algo_periodicexp4.make_partition_cycles(NUM_TIME_SLOT, periods)
-elif PERIOD_OPTION == 2: # unused
-    periods = list(range(1,15))
-    partitions = algo_periodicexp4.make_partition_cycles(NUM_TIME_SLOT, periods)
-elif PERIOD_OPTION == 3: # unused
-    periods = list(range(1,15))
-    periods = [i*NUM_REPEATS for i in periods]
-    partitions = algo_periodicexp4.make_partition_cycles(NUM_TIME_SLOT, periods)
-elif PERIOD_OPTION == 4:
-    pass #DISABLED
-elif PERIOD_OPTION == 5:
-    periods = list(range(1,15))
-    partitions = algo_periodicexp4.make_repeating_partition_cycles(NUM_TIME_SLOT, NUM_REPEATS, periods)
-elif PERIOD_OPTION == 6:
-    periods = list(range(1,40))
-    partitions = algo_periodicexp4.make_repeating_partition_cycles(NUM_TIME_SLOT, NUM_REPEATS, periods)
-elif PERIOD_OPTION == 7: #primes below 15
-    periods = [1,2,3,5,7,11,13]
-    partitions = algo_periodicexp4.make_repeating_partition_cycles(NUM_TIME_SLOT, NUM_REPEATS, periods)
-elif PERIOD_OPTION == 8: #primes below 40
-    periods = [1,2,3,5,7,11,13,17,19,23,29,31,37]
-    partitions = algo_periodicexp4.make_repeating_partition_cycles(NUM_TIME_SLOT, NUM_REPEATS, periods)
-elif PERIOD_OPTION == 9: #powers of 2 up to 16
-    periods = [1,2,4,8,16]
-    partitions = algo_periodicexp4.make_repeating_partition_cycles(NUM_TIME_SLOT, NUM_REPEATS, periods)
-elif PERIOD_OPTION == 10: #powers of 2 up to 1024
-    periods = [1,2,4,8,16,32,64,128,256,512,1024]
-    partitions = algo_periodicexp4.make_repeating_partition_cycles(NUM_TIME_SLOT, NUM_REPEATS, periods)
-elif PERIOD_OPTION == 11: # all numbers up to 100
-    periods = list(range(100))
-    partitions = algo_periodicexp4.make_repeating_partition_cycles(NUM_TIME_SLOT, NUM_REPEATS, periods)
-elif PERIOD_OPTION == 12: # primes below 100
-    periods = [2,3,5,7,11,13,17,19,23,29,31,37,41,43,47,53,59,61,67,71,73,79,83,89,97]
-    partitions = algo_periodicexp4.make_repeating_partition_cycles(NUM_TIME_SLOT, NUM_REPEATS, periods)
-elif PERIOD_OPTION == 13: # large primes only
-    periods = [53,59,61,67,71,73,79,83,89,97]
-    partitions = algo_periodicexp4.make_repeating_partition_cycles(NUM_TIME_SLOT, NUM_REPEATS, periods)
-
-
-#elif PERIOD_OPTION >= 14: # temp, delete
-#    # 14 --> 1
-#    periods = [PERIOD_OPTION-13]
-#    partitions = algo_periodicexp4.make_repeating_partition_cycles(NUM_TIME_SLOT, NUM_REPEATS, periods)
-
-elif PERIOD_OPTION == 14:
-    periods = [4]
-    partitions = algo_periodicexp4.make_repeating_partition_cycles(NUM_TIME_SLOT, NUM_REPEATS, periods)
-elif PERIOD_OPTION == 15:
-    periods = list(range(1,15+1)) # 15 periods
-    partitions = algo_periodicexp4.make_repeating_partition_cycles(NUM_TIME_SLOT, NUM_REPEATS, periods)
-elif PERIOD_OPTION == 16:
-    periods = list(range(1,23+1)) # 23 periods
-    partitions = algo_periodicexp4.make_repeating_partition_cycles(NUM_TIME_SLOT, NUM_REPEATS, periods)
-elif PERIOD_OPTION == 17:
-    periods = list(range(1,45+1)) # 45 periods
-    partitions = algo_periodicexp4.make_repeating_partition_cycles(NUM_TIME_SLOT, NUM_REPEATS, periods)
-elif PERIOD_OPTION == 18:
-    periods = list(range(23,45+1)) # 23 periods
-    partitions = algo_periodicexp4.make_repeating_partition_cycles(NUM_TIME_SLOT, NUM_REPEATS, periods)
-elif PERIOD_OPTION == 19:
-    periods = [1,2,3,5,7,11,13,17,19,23,29,31,37,41,43] # 15 periods
-    partitions = algo_periodicexp4.make_repeating_partition_cycles(NUM_TIME_SLOT, NUM_REPEATS, periods)
-elif PERIOD_OPTION == 20:
-    periods = list(range(1,24+1)) # 24 periods
-    partitions = algo_periodicexp4.make_repeating_partition_cycles(NUM_TIME_SLOT, NUM_REPEATS, periods)
-
-
-
-gamma_function = {
-    1: lambda t,T : 0.3,
-    2: lambda t,T : 0.8,
-    3: lambda t,T : min((t)**(-1/3),0.9),
-    4: lambda t,T : min((t)**(-1/8),0.9),
-    5: lambda t,T : min((t)**(-1/10),0.99),
-    6: lambda t,T : min((t*100/T)**(-1/3),0.9),
-    7: lambda t,T : min((t*1000/T)**(-1/3),0.9),
-}[GAMMA_OPTION]
-
-
-
-mobileDeviceList = [MobileDevice(networkList, trackDetailedStats=True,
-                    maxGain=maxGain, partitions=partitions)
-                    for i in range(NUM_MOBILE_DEVICE)] # create mobile device objects and store in mobileDeviceList
-
-seed = generate_random_seed()
-#seed = 5
-np.random.seed(seed)
-
-results = []
-
-# print("nashEquilibriumStateList:", nashEquilibriumStateList); input()
-try:
-    proc = env.process(problem_instance.run_instance(env, networkList, instance))
-    for i in range(NUM_MOBILE_DEVICE):
+    #instance, maxGain, numNetwork = problem_instance.PROBLEM_INSTANCES[PROBLEM_INSTANCE_NAME](NUM_TIME_SLOT)
+
+    networkList = [Network(0) for i in range(numNetwork)]
+    #networkList = [Network(NETWORK_BANDWIDTH[i]) for i in range(numNetwork)]        # create network objects and store in networkList
+    global_setting.constants.update({'network_list':networkList})
+
+    ''' ____ configured global settings. now to import the stuff that uses it ____ '''
+    from mobile_device import MobileDevice, HindsightGains
+    if TELEMETRY_EVERY > 0: from telemetry import Telemetry
+    from checkpoint import Checkpointer, restore_learners, load_learner_states
+    import logging_configure
+    import data_analyzer
+    logging_configure.initialize((DIR if SAVE_LOG_DETAILS else None))
+    ''' __________________________________________________________________________ '''
+
+    partitions = period_options.make_partitions(PERIOD_OPTION, NUM_TIME_SLOT, NUM_REPEATS)
+    partitions.materialize(partitions.cache_name(LABEL_CACHE) if LABEL_CACHE != None else None) # label table shared by every device
+
+    gamma_function = {
+        1: lambda t,T : 0.3,
+        2: lambda t,T : 0.8,
+        3: lambda t,T : min((t)**(-1/3),0.9),
+        4: lambda t,T : min((t)**(-1/8),0.9),
+        5: lambda t,T : min((t)**(-1/10),0.99),
+        6: lambda t,T : min((t*100/T)**(-1/3),0.9),
+        7: lambda t,T : min((t*1000/T)**(-1/3),0.9),
+    }[GAMMA_OPTION]
+
+
+
+    hindsightGains = HindsightGains(partitions, numNetwork, NUM_MOBILE_DEVICE) # best expert gains of all devices, updated once per slot
+    mobileDeviceList = [MobileDevice(networkList, trackDetailedStats=True,
+                        maxGain=maxGain, partitions=partitions, hindsightGains=hindsightGains)
+                        for i in range(NUM_MOBILE_DEVICE)] # create mobile device objects and store in mobileDeviceList
+
+    seed = generate_random_seed()
+    #seed = 5
+
+    # resume from the checkpoint of an interrupted run of the same arguments, if there is one
+    checkpointer, resumed = None, None
+    if CHECKPOINT_EVERY > 0:
+        config = {name: value for name, value in vars(args).items()
+                  if name not in ('show_plots', 'engine', 'trace_cache', 'label_cache', 'telemetry_every', 'checkpoint_every')}
+        checkpointer = Checkpointer(DIR, NUM_TIME_SLOT, CHECKPOINT_EVERY, config, seed)
+        resumed = checkpointer.load()
+    if resumed != None:
+        seed = checkpointer.seed = resumed.seed
+        resumed.restoreDevices(mobileDeviceList, networkList)
+        resumed.restoreHindsightGains(hindsightGains)
+        resumed.restoreLogs(mobileDeviceList)
+        print("----- resuming from time slot %d -----" % resumed.slot)
+    START_SLOT = resumed.slot if resumed != None else 0
+
+    np.random.seed(seed)
+    global_setting.constants.update({'seed':seed})
+
+    results = []
+    telemetry = Telemetry(DIR, NUM_TIME_SLOT, TELEMETRY_EVERY, START_SLOT) if TELEMETRY_EVERY > 0 else None
+    learners = None # learner of every device (simpy) or batch learner (lockstep), for the final checkpoint
+
+    def prepare_learners(algorithm):
+        if resumed != None:
+            resumed.restoreLearners(algorithm)
+        elif WARM_START != None:
+            restore_learners(algorithm, load_learner_states(WARM_START), warmStart=True)
+
+    def run_simpy():
+        global learners
+        learners = []
+        proc = env.process(problem_instance.run_instance(env, networkList, problem_instance.trace_instance(trace[START_SLOT:])))
+        for i in range(NUM_MOBILE_DEVICE):
+            if ALGORITHM_NAME == "EXP3":
+                algorithm = algo_exp3.Exp3Algo(numNetwork, NUM_TIME_SLOT, seed=seed, device=i)
+            elif ALGORITHM_NAME == "EXP4":
+                algorithm = algo_periodicexp4.PeriodicExp4(NUM_TIME_SLOT, numNetwork, partitions, gamma=0.3, seed=seed, device=i)
+                if ALGO_LOG_EVERY > 0:
+                    algorithm.enable_log(every=ALGO_LOG_EVERY, path=deviceAlgoLogName(DIR, mobileDeviceList[i].deviceID), append=resumed != None)
+                #algorithm = algo_periodicexp4.algo_partition_cycles(NUM_TIME_SLOT, numNetwork, [1], gamma=0.5)
+            learners.append(algorithm)
+            proc = env.process(mobileDeviceList[i].runAlgorithm(env, algorithm, results, gamma_function, START_SLOT))
+        prepare_learners(learners)
+        if telemetry != None: env.process(telemetry.run(env, mobileDeviceList, hindsightGains))
+        if checkpointer != None: env.process(checkpointer.run(env, START_SLOT, learners, mobileDeviceList, hindsightGains))
+        env.run(until=proc)  # SIM_TIME)
+
+    def run_lockstep():
+        global learners
+        import lockstep_engine
+        # device i draws the uniforms of device i of run_simpy
         if ALGORITHM_NAME == "EXP3":
-            algorithm = algo_exp3.Exp3Algo(numNetwork, NUM_TIME_SLOT)
+            algorithm = algo_exp3.Exp3Batch(NUM_MOBILE_DEVICE, numNetwork, NUM_TIME_SLOT, seed=seed)
         elif ALGORITHM_NAME == "EXP4":
-            algorithm = algo_periodicexp4.PeriodicExp4(NUM_TIME_SLOT, numNetwork, partitions, gamma=0.3, seed=seed+i)
-            #algorithm = algo_periodicexp4.algo_partition_cycles(NUM_TIME_SLOT, numNetwork, [1], gamma=0.5)
-        proc = env.process(mobileDeviceList[i].runAlgorithm(env, algorithm, results, gamma_function))
-    env.run(until=proc)  # SIM_TIME)
-except Exception:
-    traceback.print_exc()
-
-print("----- simulation completed -----")
-
-# analysis
-data_analyzer.analyze(results, [(m.deviceID, m.csvData) for m in mobileDeviceList], mobileDeviceList[0].networkCsvData)
-
-# do processing
-# write csvs
-if SAVE_LOG_DETAILS:
-    for mobileDevice in mobileDeviceList:
-        mobileDevice.writeCsv()
-    print("----- csvs written -----")
+            algorithm = algo_periodicexp4.PeriodicExp4Batch(NUM_MOBILE_DEVICE, NUM_TIME_SLOT, numNetwork, partitions, gamma=0.3, seed=seed)
+            if ALGO_LOG_EVERY > 0:
+                algorithm.enable_log(every=ALGO_LOG_EVERY, paths=[deviceAlgoLogName(DIR, m.deviceID) for m in mobileDeviceList], append=resumed != None)
+        learners = algorithm
+        prepare_learners(algorithm)
+        lockstep_engine.run(mobileDeviceList, algorithm, trace, hindsightGains, results, gamma_function, telemetry, checkpointer, START_SLOT)
+
+    # print("nashEquilibriumStateList:", nashEquilibriumStateList); input()
+    simulationFailed = False
+    try:
+        if ENGINE == 'lockstep':
+            run_lockstep()
+        else:
+            run_simpy()
+    except Exception:
+        traceback.print_exc()
+        simulationFailed = True
+
+    print("----- simulation completed -----")
+    if telemetry != None:
+        if not simulationFailed: telemetry.snapshot(NUM_TIME_SLOT, [r[1] for r in results], [r[2] for r in results])
+        telemetry.close()
+    if checkpointer != None and not simulationFailed:
+        checkpointer.save(NUM_TIME_SLOT, learners, mobileDeviceList, hindsightGains) # learned weights, for -warmstart
+
+    # do processing
+    # write csvs (the writers are finished before the analysis, which may start plot rendering processes)
+    if SAVE_LOG_DETAILS:
+        for mobileDevice in mobileDeviceList:
+            mobileDevice.writeCsv()
+        print("----- csvs written -----")
+
+    # analysis
+    data_analyzer.analyze(results, [(m.deviceID, m.csvData) for m in mobileDeviceList], mobileDeviceList[0].networkCsvData)
+
+    if simulationFailed: sys.exit(1)                                                    # let the sweep runner record the failure
 
 ''' _____________________________________________________________________________ end of file _____________________________________________________________________________ '''
\ No newline at end of file